@@ -0,0 +1,161 @@
+"""End-to-end throughput of the downloaders and scrapers against FakeClient.
+
+Each scenario runs in its own subprocess and temporary directory, so peak
+RSS and on-disk state are per scenario:
+
+    download_file   download_file.main() over every fake dialog
+    practice_5      practice_5.TelegramScraper.run() on one channel (CSV)
+    practice_6      practice_6.TelegramScraper.run() on one channel (SQLite)
+
+    python benchmarks/bench_end_to_end.py [--messages 2000] [--flood-wait-rate 0.01] [--rate 1000]
+
+Reports messages/s, MB/s, peak RSS and event-loop lag (p99/max).
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = os.path.dirname(HERE)
+SCENARIOS = ('download_file', 'practice_5', 'practice_6')
+
+
+def _prepare_environment(workdir: str) -> None:
+    os.chdir(workdir)
+    os.environ.update({
+        # parallel_download's multi-connection path needs real MTProto senders
+        'TELEGRAM_DOWNLOAD_CONNECTIONS': '1',
+        'telegram_api_id': '1', 'telegram_api_hash': 'bench',
+        'TELEGRAM_API_ID': '1', 'TELEGRAM_APP_API_HASH': 'bench',
+        'TELEGRAM_SESSION': os.path.join(workdir, 'bench'),
+        'TELEGRAM_DOWNLOAD_DIR': os.path.join(workdir, 'download'),
+        'CHANNEL_NAME': 'channel-0',
+    })
+    sys.path[:0] = [PACKAGE, HERE]
+
+
+def _tune_limiter(limiter, rate) -> None:
+    if rate:
+        limiter.rate = limiter.max_rate = limiter.burst = rate
+
+
+async def _run_download_file(client, args) -> None:
+    import download_file
+    download_file.client = client
+    _tune_limiter(download_file.limiter, args.rate)
+    await download_file.main()
+
+
+async def _run_practice_5(client, args) -> None:
+    import practice_5
+    scraper = practice_5.TelegramScraper(
+        api_id=1, api_hash='bench', target_channel='channel-0', telegram_session=os.environ['TELEGRAM_SESSION'],
+        download_folder='download', csv_file='messages.csv', state_db='state.db',
+    )
+    scraper.telegram_client = client
+    _tune_limiter(scraper.limiter, args.rate)
+    await scraper.run(limit=None)
+
+
+async def _run_practice_6(client, args) -> None:
+    import practice_6
+    scraper = practice_6.TelegramScraper(
+        api_id=1, api_hash='bench', session_name=os.environ['TELEGRAM_SESSION'],
+        target_channel='channel-0', download_folder='download',
+    )
+    scraper.client = client
+    _tune_limiter(scraper.limiter, args.rate)
+    await scraper.run(limit=None, concurrent_limit=args.workers)
+
+
+RUNNERS = {'download_file': _run_download_file, 'practice_5': _run_practice_5, 'practice_6': _run_practice_6}
+
+
+def run_scenario(scenario: str, args) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f'bench-{scenario}-')
+    _prepare_environment(workdir)
+    from fake_client import FakeClient, FakeConfig
+    from io_writer import LoopLagMonitor
+    import logging
+
+    client = FakeClient(FakeConfig(
+        dialogs=args.dialogs, messages_per_dialog=args.messages, media_ratio=args.media_ratio,
+        max_file_size=int(args.max_file_mb * 1024 * 1024), page_latency=args.page_latency,
+        bandwidth=args.bandwidth_mb * 1024 * 1024, flood_wait_rate=args.flood_wait_rate, seed=args.seed,
+    ))
+
+    async def main() -> tuple[float, LoopLagMonitor]:
+        async with LoopLagMonitor(interval=0.05) as lag:
+            started = time.perf_counter()
+            await RUNNERS[scenario](client, args)
+            return time.perf_counter() - started, lag
+
+    elapsed, lag = asyncio.run(main())
+    logging.disable(logging.CRITICAL)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    stats = client.stats
+    return {
+        'scenario': scenario,
+        'seconds': elapsed,
+        'messages': stats.messages_served,
+        'messages_per_s': stats.messages_served / elapsed,
+        'downloads': stats.downloads,
+        'mb_per_s': stats.bytes_served / elapsed / (1024 * 1024),
+        'flood_waits': stats.flood_waits,
+        'peak_rss_mb': peak_rss / (1024 * 1024),
+        'lag_p99_ms': lag.p99 * 1000,
+        'lag_max_ms': lag.max_lag * 1000,
+        'workdir': workdir,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+                        help='run only these (repeatable); default: all')
+    parser.add_argument('--dialogs', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=2000, help='messages per dialog')
+    parser.add_argument('--media-ratio', type=float, default=0.2)
+    parser.add_argument('--max-file-mb', type=float, default=4.0)
+    parser.add_argument('--page-latency', type=float, default=0.03)
+    parser.add_argument('--bandwidth-mb', type=float, default=20.0, help='per-file transfer rate')
+    parser.add_argument('--flood-wait-rate', type=float, default=0.0)
+    parser.add_argument('--rate', type=float, default=0.0, help='override the limiter rate (req/s)')
+    parser.add_argument('--workers', type=int, default=4, help='practice_6 download workers')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.scenario[0], args)))
+        return
+
+    forwarded = [f"--{name.replace('_', '-')}={value}" for name, value in vars(args).items()
+                 if name not in ('scenario', 'child')]
+    print(f"{'scenario':<14} {'seconds':>8} {'msg/s':>9} {'MB/s':>7} {'files':>6} {'floods':>6} "
+          f"{'RSS MB':>7} {'lag p99':>8} {'lag max':>8}")
+    for scenario in args.scenario or SCENARIOS:
+        # The scripts log to stderr; only show it when a scenario fails
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', '--scenario', scenario, *forwarded],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        if child.returncode:
+            sys.stderr.write(child.stderr)
+            raise SystemExit(f'{scenario} failed with exit status {child.returncode}')
+        r = json.loads(child.stdout.strip().splitlines()[-1])
+        print(f"{r['scenario']:<14} {r['seconds']:>8.2f} {r['messages_per_s']:>9,.0f} {r['mb_per_s']:>7.1f} "
+              f"{r['downloads']:>6} {r['flood_waits']:>6} {r['peak_rss_mb']:>7.1f} "
+              f"{r['lag_p99_ms']:>6.1f}ms {r['lag_max_ms']:>6.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
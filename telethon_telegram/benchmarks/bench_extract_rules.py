@@ -0,0 +1,91 @@
+"""Throughput of RuleSet.scan versus one re.search per rule, for a growing number of rules.
+
+"alternation" is the naive single-pass alternative (all rules joined into one
+regex) for reference; with CPython's backtracking ``re`` it is slower than
+separate searches, which is why RuleSet prefilters on literals instead.
+
+    python benchmarks/bench_extract_rules.py [--messages 20000]
+"""
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract_rules import DEFAULT_RULES, Rule, RuleSet  # noqa: E402
+
+
+def make_rules(count: int) -> list[Rule]:
+    rules = list(DEFAULT_RULES)
+    templates = [
+        r'https?://({word}\S*)', r'#({word}\w*)', r'{word}:\s*(\w+)', r'\b({word}-\d{{3,}})\b',
+    ]
+    while len(rules) < count:
+        word = ''.join(random.choices(string.ascii_lowercase, k=5))
+        template = templates[len(rules) % len(templates)]
+        rules.append(Rule(f'rule_{len(rules)}', template.format(word=word)))
+    return rules
+
+
+def make_messages(count: int) -> list[str]:
+    words = [''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(500)]
+    messages = []
+    for i in range(count):
+        text = ' '.join(random.choices(words, k=random.randint(5, 60)))
+        if i % 3 == 0:
+            text += f' ```pw{i}``` '
+        messages.append(text)
+    return messages
+
+
+def bench_separate(rules: list[Rule], messages: list[str]) -> float:
+    compiled = [(re.compile(rule.pattern), rule.group) for rule in rules]
+    started = time.perf_counter()
+    for text in messages:
+        for pattern, group in compiled:
+            match = pattern.search(text)
+            if match:
+                match.group(group)
+    return len(messages) / (time.perf_counter() - started)
+
+
+def bench_alternation(rules: list[Rule], messages: list[str]) -> float:
+    combined = re.compile('|'.join(f'(?:{rule.pattern})' for rule in rules))
+    started = time.perf_counter()
+    for text in messages:
+        for match in combined.finditer(text):
+            match.group(0)
+    return len(messages) / (time.perf_counter() - started)
+
+
+def bench_ruleset(rules: list[Rule], messages: list[str]) -> float:
+    ruleset = RuleSet(rules)
+    started = time.perf_counter()
+    for text in messages:
+        ruleset.scan(text)
+    return len(messages) / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    messages = make_messages(args.messages)
+    print(f"{'rules':>6} {'separate msg/s':>15} {'alternation msg/s':>18} {'ruleset msg/s':>14} {'speedup':>8}")
+    for count in (1, 2, 4, 8, 16, 32, 64):
+        rules = make_rules(count)
+        separate = bench_separate(rules, messages)
+        alternation = bench_alternation(rules, messages)
+        combined = bench_ruleset(rules, messages)
+        print(f"{count:>6} {separate:>15,.0f} {alternation:>18,.0f} {combined:>14,.0f} {combined / separate:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Parse throughput of every column versus a metadata-only projection, on real Telethon messages.
+
+``message.text`` re-renders formatting entities as markdown on every
+access, so projections that leave out the text columns (and the rules
+that scan them) skip the most expensive accessor.
+
+    python benchmarks/bench_projection.py [--messages 20000]
+"""
+import argparse
+import datetime
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telethon.extensions import markdown  # noqa: E402
+from telethon.tl import types  # noqa: E402
+
+from message_fields import DEFAULT_RULESET, MessageRecord, extract, row_getter  # noqa: E402
+
+PROJECTIONS = {
+    'all': None,
+    'text': ('channel_id', 'message_id', 'date', 'text'),
+    'metadata': ('channel_id', 'message_id', 'date', 'file_size'),
+    'ids': ('channel_id', 'message_id'),
+}
+
+
+class _Client:
+    """Just enough of a client for ``Message.text`` to render markdown, as it does in a real run."""
+    parse_mode = markdown
+
+
+def make_messages(count: int) -> list:
+    words = [''.join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(500)]
+    peer = types.PeerChannel(1)
+    date = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    messages = []
+    for i in range(count):
+        text = ' '.join(random.choices(words, k=random.randint(5, 60)))
+        entities = [types.MessageEntityBold(offset=0, length=min(5, len(text))),
+                    types.MessageEntityUrl(offset=max(len(text) - 5, 0), length=min(5, len(text)))]
+        media = None
+        if i % 4 == 0:
+            document = types.Document(
+                id=i, access_hash=0, file_reference=b'', date=date, mime_type='application/zip', size=1024 * i,
+                dc_id=1, attributes=[types.DocumentAttributeFilename(f'file_{i}.zip')])
+            media = types.MessageMediaDocument(document=document)
+        message = types.Message(id=i + 1, peer_id=peer, date=date + datetime.timedelta(seconds=i),
+                                message=text, entities=entities, media=media)
+        message._client = _Client()
+        messages.append(message)
+    return messages
+
+
+def bench(messages: list, fields) -> float:
+    names = fields or MessageRecord._fields[:-1] + DEFAULT_RULESET.names
+    to_row = row_getter(list(names), DEFAULT_RULESET)
+    wanted = frozenset(fields) if fields else None
+    started = time.perf_counter()
+    for message in messages:
+        to_row(extract(message, 'channel', 1, DEFAULT_RULESET, fields=wanted))
+    return len(messages) / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'projection':>10} {'msg/s':>12} {'speedup':>8}")
+    for name, fields in PROJECTIONS.items():
+        # Fresh messages each time: Telethon caches text and file on the message after the first access
+        random.seed(args.seed)
+        rate = bench(make_messages(args.messages), fields)
+        baseline = baseline or rate
+        print(f"{name:>10} {rate:>12,.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
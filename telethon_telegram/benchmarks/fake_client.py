@@ -0,0 +1,299 @@
+"""Offline stand-in for ``TelegramClient`` with synthetic dialogs, history and media.
+
+Covers what the downloaders and scrapers call: ``iter_dialogs``,
+``iter_messages`` (``limit``/``offset_id``/``min_id``/``reverse``, served in
+pages of 100), ``get_messages``, ``get_entity``, ``get_me``,
+``download_media`` and ``NewMessage`` handlers (fed by ``publish()``). Latency, file sizes and injected ``FloodWaitError``s are
+set through ``FakeConfig``; everything is seeded, so runs are reproducible.
+
+Media are real ``MessageMediaDocument``/``Document`` objects, so
+``media_store`` keys them like live ones. The multi-connection path of
+``parallel_download`` needs real MTProto senders; set
+``TELEGRAM_DOWNLOAD_CONNECTIONS=1`` before importing the code under test so
+everything goes through ``FakeClient.download_media``.
+"""
+import asyncio
+import datetime
+import os
+import random
+from dataclasses import dataclass, field
+from typing import Optional
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Channel, ChatPhotoEmpty, Document, DocumentAttributeFilename, MessageMediaDocument, User
+from telethon.utils import get_peer_id
+
+PAGE_SIZE = 100
+CHUNK_SIZE = 128 * 1024
+MB = 1024 * 1024
+
+
+@dataclass
+class FakeConfig:
+    dialogs: int = 3
+    messages_per_dialog: int = 2000
+    # Share of messages carrying a document
+    media_ratio: float = 0.2
+    min_file_size: int = 64 * 1024
+    max_file_size: int = 4 * MB
+    # Share of messages whose sender entity is left out of the page (only sender_id is set)
+    missing_sender_ratio: float = 0.0
+    # Share of documents that are forwards of a document already posted in another dialog
+    duplicate_ratio: float = 0.1
+    # Seconds per history page / per other API request
+    page_latency: float = 0.03
+    request_latency: float = 0.01
+    # Per-file transfer rate in bytes/s (0 = as fast as the disk allows)
+    bandwidth: float = 20 * MB
+    # Probability that a request raises FloodWaitError, and the wait it asks for
+    flood_wait_rate: float = 0.0
+    flood_wait_seconds: int = 1
+    # Write real bytes (True) or just size the file (False)
+    write_data: bool = True
+    seed: int = 1
+
+
+@dataclass
+class FakeFile:
+    name: Optional[str]
+    size: int
+    ext: str
+    mime_type: str
+
+
+@dataclass
+class FakeMessage:
+    id: int
+    text: str
+    date: datetime.datetime
+    sender: Optional[User] = None
+    sender_id: Optional[int] = None
+    media: Optional[MessageMediaDocument] = None
+    file: Optional[FakeFile] = None
+
+    @property
+    def raw_text(self) -> str:
+        return self.text
+
+    @property
+    def document(self) -> Optional[Document]:
+        return self.media.document if self.media is not None else None
+
+
+def _make_channel(index: int, rnd: random.Random) -> Channel:
+    return Channel(id=1000000000 + index, title=f'channel-{index}', photo=ChatPhotoEmpty(), date=None,
+                   access_hash=rnd.getrandbits(62), username=f'channel_{index}', broadcast=True)
+
+
+@dataclass
+class FakeDialog:
+    entity: Channel
+    is_channel: bool = True
+    is_group: bool = False
+    pinned: bool = False
+    date: Optional[datetime.datetime] = None
+
+    @property
+    def id(self) -> int:
+        # Marked id, like Telethon's Dialog.id
+        return get_peer_id(self.entity)
+
+    @property
+    def name(self) -> str:
+        return self.entity.title
+
+    @property
+    def title(self) -> str:
+        return self.entity.title
+
+
+@dataclass
+class FakeEvent:
+    message: FakeMessage
+
+
+@dataclass
+class FakeStats:
+    requests: int = 0
+    pages: int = 0
+    messages_served: int = 0
+    downloads: int = 0
+    bytes_served: int = 0
+    flood_waits: int = 0
+    files_by_document: dict = field(default_factory=dict)
+
+
+class FakeClient:
+    """Synthetic ``TelegramClient``; see the module docstring for what it supports."""
+
+    def __init__(self, config: Optional[FakeConfig] = None) -> None:
+        self.config = config or FakeConfig()
+        self.stats = FakeStats()
+        self._random = random.Random(self.config.seed)
+        self.channels = [_make_channel(i, self._random) for i in range(self.config.dialogs)]
+        self._senders = [User(id=1000 + i, username=f'user{i}') for i in range(50)]
+        self._history = {channel.id: self._make_history(channel) for channel in self.channels}
+        self._handlers: list = []
+
+    def _make_history(self, channel: Channel) -> list[FakeMessage]:
+        # Snapshot: duplicates are forwards of documents from earlier dialogs
+        documents = list(self.stats.files_by_document.values())
+        return [self._make_message(channel, message_id, documents)
+                for message_id in range(1, self.config.messages_per_dialog + 1)]
+
+    def _make_message(self, channel: Channel, message_id: int, documents: list) -> FakeMessage:
+        cfg = self.config
+        rnd = self._random
+        text = f'message {message_id} in {channel.title}'
+        if message_id % 7 == 0:
+            text += f' ```pw{message_id}```'
+        start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        sender = rnd.choice(self._senders)
+        message = FakeMessage(message_id, text, start + datetime.timedelta(minutes=message_id),
+                              sender=sender, sender_id=sender.id)
+        if cfg.missing_sender_ratio and rnd.random() < cfg.missing_sender_ratio:
+            message.sender = None
+        if rnd.random() < cfg.media_ratio:
+            if documents and rnd.random() < cfg.duplicate_ratio:
+                document = rnd.choice(documents)
+            else:
+                document = self._make_document(rnd)
+                self.stats.files_by_document[document.id] = document
+            name = document.attributes[0].file_name
+            message.media = MessageMediaDocument(document=document)
+            message.file = FakeFile(name, document.size, os.path.splitext(name)[1], document.mime_type)
+        return message
+
+    def _make_document(self, rnd: random.Random) -> Document:
+        cfg = self.config
+        document_id = rnd.getrandbits(62)
+        return Document(
+            id=document_id, access_hash=rnd.getrandbits(62), file_reference=b'',
+            date=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc), mime_type='application/octet-stream',
+            size=rnd.randint(cfg.min_file_size, cfg.max_file_size), dc_id=2,
+            attributes=[DocumentAttributeFilename(f'file_{document_id:x}.bin')],
+        )
+
+    async def _request(self, latency: float) -> None:
+        self.stats.requests += 1
+        await asyncio.sleep(latency)
+        if self.config.flood_wait_rate and self._random.random() < self.config.flood_wait_rate:
+            self.stats.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.config.flood_wait_seconds)
+
+    async def __aenter__(self) -> "FakeClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    async def connect(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def get_me(self) -> User:
+        await self._request(self.config.request_latency)
+        return User(id=1, username='bench', first_name='Bench', last_name='User')
+
+    async def iter_dialogs(self):
+        await self._request(self.config.request_latency)
+        for channel in self.channels:
+            history = self._history[channel.id]
+            yield FakeDialog(channel, date=history[-1].date if history else None)
+
+    async def get_input_entity(self, peer):
+        for user in self._senders:
+            if peer in (user.id, user):
+                return user
+        return await self.get_entity(peer)
+
+    async def get_entity(self, name):
+        if isinstance(name, list):
+            # One request for the whole batch, like GetUsersRequest
+            await self._request(self.config.request_latency)
+            return [await self.get_input_entity(peer) for peer in name]
+        await self._request(self.config.request_latency)
+        for channel in self.channels:
+            if name in (channel.id, get_peer_id(channel), channel.title, channel.username):
+                return channel
+        raise ValueError(f'No channel {name!r}')
+
+    async def get_messages(self, entity, ids=None, limit: Optional[int] = None, **kwargs):
+        if ids is None:
+            return [message async for message in self.iter_messages(entity, limit=limit, **kwargs)]
+        await self._request(self.config.request_latency)
+        history = self._history[entity.id]
+        single = isinstance(ids, int)
+        found = [history[i - 1] if 0 < i <= len(history) else None for i in ([ids] if single else ids)]
+        return found[0] if single else found
+
+    def add_event_handler(self, callback, event=None) -> None:
+        chats = getattr(event, 'chats', None)
+        self._handlers.append((callback, None if chats is None else {chat.id for chat in chats}))
+
+    def remove_event_handler(self, callback, event=None) -> int:
+        before = len(self._handlers)
+        self._handlers = [(cb, chats) for cb, chats in self._handlers if cb is not callback]
+        return before - len(self._handlers)
+
+    async def publish(self, channel: Channel, count: int = 1) -> list[FakeMessage]:
+        """Post ``count`` new messages to ``channel`` and run the ``NewMessage`` handlers for each."""
+        history = self._history[channel.id]
+        documents = list(self.stats.files_by_document.values())
+        posted = []
+        for _ in range(count):
+            message = self._make_message(channel, len(history) + 1, documents)
+            history.append(message)
+            posted.append(message)
+            for callback, chats in list(self._handlers):
+                if chats is None or channel.id in chats:
+                    await callback(FakeEvent(message))
+        return posted
+
+    async def iter_messages(self, entity, limit: Optional[int] = None, offset_id: int = 0, min_id: int = 0,
+                            max_id: int = 0, reverse: bool = False, **kwargs):
+        history = self._history[entity.id]
+        if reverse:
+            low = max(min_id, offset_id)
+            selected = [m for m in history if m.id > low and (not max_id or m.id < max_id)]
+        else:
+            selected = [m for m in reversed(history)
+                        if m.id > min_id and (not offset_id or m.id < offset_id) and (not max_id or m.id < max_id)]
+        if limit is not None:
+            selected = selected[:limit]
+        for start in range(0, len(selected), PAGE_SIZE):
+            await self._request(self.config.page_latency)
+            self.stats.pages += 1
+            for message in selected[start:start + PAGE_SIZE]:
+                self.stats.messages_served += 1
+                yield message
+
+    async def download_media(self, message, file=None, progress_callback=None):
+        media = getattr(message, 'media', message)
+        document = media.document
+        await self._request(self.config.request_latency)
+        path = file
+        if path is None or os.path.isdir(path):
+            path = os.path.join(path or '.', document.attributes[0].file_name)
+        size = document.size
+        chunk = b'\0' * CHUNK_SIZE
+        delay = CHUNK_SIZE / self.config.bandwidth if self.config.bandwidth else 0
+        with open(path, 'wb') as f:
+            if not self.config.write_data:
+                f.truncate(size)
+            received = 0
+            while received < size:
+                step = min(CHUNK_SIZE, size - received)
+                if self.config.write_data:
+                    f.write(chunk[:step])
+                received += step
+                await asyncio.sleep(delay)
+                if progress_callback is not None:
+                    result = progress_callback(received, size)
+                    if asyncio.iscoroutine(result):
+                        await result
+        self.stats.downloads += 1
+        self.stats.bytes_served += size
+        return path
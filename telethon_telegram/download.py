@@ -8,6 +8,9 @@ from decouple import config
 from telethon import TelegramClient, functions
 from telethon.errors.rpcerrorlist import FloodWaitError
 
+from io_writer import BackgroundWriter
+from progress import ProgressTracker
+
 api_id = config("telegram_api_id", cast=int)
 api_hash = config("telegram_api_hash")
 
@@ -16,6 +19,10 @@ base_download_dir = Path(os.getenv("TELEGRAM_DOWNLOAD_DIR", "telegram_download")
 include_groups = os.getenv("TELEGRAM_INCLUDE_GROUPS", "0").strip() in {"1", "true", "yes", "on"}
 
 client = TelegramClient(session_name, api_id, api_hash)
+# Index reads/appends and folder creation run on this thread, not the event loop
+writer = BackgroundWriter()
+# Shared download dashboard, redrawn at a fixed rate
+progress = ProgressTracker()
 
 def _safe_name(name: str) -> str:
     name = re.sub(r"[\\/:*?\"<>|]", "_", name)
@@ -23,7 +30,7 @@ def _safe_name(name: str) -> str:
     return name or "unnamed"
 
 
-async def _load_downloaded_set(folder: Path) -> set[int]:
+def _load_downloaded_set(folder: Path) -> set[int]:
     idx_file = folder / ".download_ids.txt"
     if not idx_file.exists():
         return set()
@@ -41,14 +48,9 @@ def _append_downloaded_id(folder: Path, mid: int) -> None:
 
 async def download_from_dialog(entity, dialog_name: str) -> None:
     channel_dir = base_download_dir / _safe_name(dialog_name)
-    channel_dir.mkdir(parents=True, exist_ok=True)
-
-    downloaded = await _load_downloaded_set(channel_dir)
+    await writer.run(channel_dir.mkdir, parents=True, exist_ok=True)
 
-    async def progress(current: int, total: int):
-        if total:
-            pct = current / total
-            print(f"[{dialog_name} Downloaded {current}/{total} bytes ({pct:.2f})%", end='\r')
+    downloaded = await writer.run(_load_downloaded_set, channel_dir)
 
     async for message in client.iter_messages(entity):
         if not message.file:
@@ -56,14 +58,14 @@ async def download_from_dialog(entity, dialog_name: str) -> None:
         if message.id in downloaded:
             continue
         try:
-            path = await client.download_media(
-                message,
-                file=str(channel_dir),
-                progress_callback=progress,
-            )
+            with progress.track(f"{dialog_name}/{message.id}", message.file.size) as transfer:
+                path = await client.download_media(
+                    message,
+                    file=str(channel_dir),
+                    progress_callback=transfer.update,
+                )
             if path:
-                print()  # newline after progress\r
-                _append_downloaded_id(channel_dir, message.id)
+                writer.submit(_append_downloaded_id, channel_dir, message.id)
         except FloodWaitError as fw:
             # Respect Telegram rate limits
             wait = int(getattr(fw, "seconds", 5))
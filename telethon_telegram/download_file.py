@@ -2,12 +2,26 @@ import asyncio
 import logging
 import os
 import re
+import time
 from pathlib import Path
+from typing import Optional
 
 from decouple import config
-from telethon import TelegramClient
+from telethon import TelegramClient, utils
 from telethon.errors.rpcerrorlist import FloodWaitError
 
+from download_scheduler import DownloadOrder, DownloadScheduler
+from download_state import STATUS_QUEUED, STATUS_SKIPPED, DownloadState, SQLiteDownloadState
+from incremental import iter_incremental
+from io_writer import BackgroundWriter, LoopLagMonitor
+from media_filter import MediaFilter
+from media_store import MediaStore
+import metrics
+from parallel_download import download_media
+from progress import ProgressTracker
+from rate_limit import AdaptiveRateLimiter
+from session_pool import Session, SessionPool
+
 # Basic logging (WARNING by default, override with TELEGRAM_LOG_LEVEL if desired)
 log_level_name = os.getenv("TELEGRAM_LOG_LEVEL", "WARNING").upper()
 log_level = getattr(logging, log_level_name, logging.WARNING)
@@ -23,11 +37,36 @@ api_hash = config("telegram_api_hash")
 
 # Optional overrides
 session_name = os.getenv("TELEGRAM_SESSION", "session_name")
+# Comma-separated session files; with more than one, dialogs are spread over all of those accounts
+session_names = [name.strip() for name in os.getenv("TELEGRAM_SESSIONS", "").split(",") if name.strip()]
+# Flood waits longer than this (seconds) hand the dialog to another session instead of waiting
+session_max_wait = float(os.getenv("TELEGRAM_SESSION_MAX_WAIT", "60"))
 base_download_dir = Path(os.getenv("TELEGRAM_DOWNLOAD_DIR", "telegram_download")).resolve()
 # If true, will also process regular small group chats; by default we stick to channels (incl. megagroups)
 include_groups = os.getenv("TELEGRAM_INCLUDE_GROUPS", "0").strip() in {"1", "true", "yes", "on"}
-
-client = TelegramClient(session_name, api_id, api_hash)
+# Downloads running at once across all dialogs / within a single dialog
+max_concurrent = int(os.getenv("TELEGRAM_MAX_CONCURRENT", "8"))
+per_dialog_concurrent = int(os.getenv("TELEGRAM_PER_DIALOG_CONCURRENT", "2"))
+# Which of a dialog's queued files goes next: shortest (smallest first), newest or fifo
+download_order = DownloadOrder(os.getenv("TELEGRAM_DOWNLOAD_ORDER", "shortest"))
+# Resume index shared by all dialogs (replaces the per-folder .downloaded_ids.txt files)
+state_db_path = Path(os.getenv("TELEGRAM_STATE_DB", str(base_download_dir / ".download_state.db"))).resolve()
+# Files forwarded into several channels are downloaded once and hardlinked into each folder
+hash_content = os.getenv("TELEGRAM_HASH_CONTENT", "0").strip() in {"1", "true", "yes", "on"}
+media_store = MediaStore(base_download_dir, hash_content=hash_content)
+# TELEGRAM_MEDIA_KINDS / _MIME_TYPES / _EXTENSIONS / _MIN_SIZE / _MAX_SIZE / _SINCE / _UNTIL / _SENDERS;
+# checked before anything is queued, and a kinds list such as "video" is also filtered server-side
+media_filter = MediaFilter.from_env()
+
+# flood_sleep_threshold=0: every flood wait goes through the shared limiter, which pauses all workers
+client = TelegramClient(session_name, api_id, api_hash, flood_sleep_threshold=0)
+limiter = AdaptiveRateLimiter(session=session_name)
+# State commits, index migration and folder creation run here instead of on the event loop
+writer = BackgroundWriter()
+# All concurrent downloads share one dashboard instead of each printing its own \r line
+progress = ProgressTracker()
+# (dialog id, message id) of downloads submitted to the scheduler and not finished yet, across sessions
+scheduled: set[tuple[int, int]] = set()
 
 
 def _safe_name(name: str) -> str:
@@ -38,80 +77,148 @@ def _safe_name(name: str) -> str:
     return name or "unnamed"
 
 
-async def _load_downloaded_set(folder: Path) -> set[int]:
-    """Read the set of already-downloaded message IDs for this folder."""
-    idx_file = folder / ".downloaded_ids.txt"
-    if not idx_file.exists():
-        return set()
-    try:
-        with idx_file.open("r", encoding="utf-8") as f:
-            return {int(line.strip()) for line in f if line.strip().isdigit()}
-    except Exception as e:
-        logger.warning("Failed to read index file %s: %s", idx_file, e)
-        return set()
-
-
-def _append_downloaded_id(folder: Path, mid: int) -> None:
-    idx_file = folder / ".downloaded_ids.txt"
-    with idx_file.open("a", encoding="utf-8") as f:
-        f.write(f"{mid}\n")
-
-
-async def download_from_dialog(entity, dialog_name: str) -> None:
+async def download_from_dialog(entity, dialog_name: str, scheduler: DownloadScheduler, state: DownloadState,
+                               session: Optional[Session] = None, pool: Optional[SessionPool] = None) -> None:
+    # A session pool passes the account that owns ``entity``; otherwise use the module's client
+    api = session.client if session else client
+    api_limiter = session.limiter if session else limiter
+    dialog_id = utils.get_peer_id(entity)
     channel_dir = base_download_dir / _safe_name(dialog_name)
-    channel_dir.mkdir(parents=True, exist_ok=True)
+    await writer.run(channel_dir.mkdir, parents=True, exist_ok=True)
 
-    downloaded = await _load_downloaded_set(channel_dir)
+    await writer.run(state.migrate_text_index, entity.id, channel_dir)
 
-    async def progress(current: int, total: int):
-        if total:
-            pct = current / total * 100
-            print(f"[{dialog_name}] Downloaded {current}/{total} bytes ({pct:.2f}%)", end="\r")
+    async def fetch(message, api, api_limiter) -> bool:
+        file_name = _safe_name(message.file.name or f"media_{message.id}{message.file.ext or ''}")
+        with progress.track(f"{dialog_name}/{file_name}", message.file.size) as transfer:
+            path, sha256 = await media_store.fetch(
+                message,
+                channel_dir / file_name,
+                lambda path: api_limiter.call(download_media, api, message, path, progress_callback=transfer.update),
+            )
+        if path:
+            logger.info("[%s] Saved: %s (message id=%s)", dialog_name, path, message.id)
+            state.record(entity.id, message.id, size=message.file.size, sha256=sha256)
+        return bool(path)
+
+    async def download(message) -> None:
+        started = time.perf_counter()
+        result = 'failed'
+        current = session
+        try:
+            while True:
+                try:
+                    if current is session:
+                        saved = await fetch(message, api, api_limiter)
+                    else:
+                        # File references are per account: fetch the message again through the new session
+                        moved = await current.limiter.call(current.client.get_messages,
+                                                           current.dialogs[dialog_id].entity, ids=message.id)
+                        if moved is None or moved.file is None:
+                            state.record(entity.id, message.id, status=STATUS_SKIPPED)
+                            return
+                        saved = await fetch(moved, current.client, current.limiter)
+                    if saved:
+                        result = 'ok'
+                    return
+                except FloodWaitError as fw:
+                    # Benched after the history scan: another session takes the file instead of failing it here
+                    other = pool.handoff(current, dialog_id, fw.seconds) if pool and current else None
+                    if other is None:
+                        # Still queued in the state store, so the next run picks it up
+                        logger.error("Flood wait of %ss on '%s' message id=%s; leaving it for the next run",
+                                     fw.seconds, dialog_name, message.id)
+                        return
+                    logger.warning("Session %s flood-waited %ss; handing '%s' message id=%s to session %s",
+                                   current.name, fw.seconds, dialog_name, message.id, other.name)
+                    current = other
+        except Exception as e:
+            logger.exception("Failed to download media from '%s' message id=%s: %s", dialog_name, message.id, e)
+        finally:
+            scheduled.discard((entity.id, message.id))
+            metrics.downloads.labels(result).inc()
+            metrics.download_seconds.observe(time.perf_counter() - started)
+
+    async def enqueue(message) -> None:
+        if (entity.id, message.id) in scheduled:
+            return
+        scheduled.add((entity.id, message.id))
+        state.record(entity.id, message.id, size=message.file.size, status=STATUS_QUEUED)
+        # Blocks while this dialog already has a full queue of pending downloads
+        await scheduler.submit(entity.id, lambda: download(message),
+                               priority=download_order.key(message.file.size, message.id))
+
+    # Downloads that were queued when a previous run stopped; when a session pool hands this dialog
+    # over, the ones the previous session already scheduled are still queued, but not lost
+    queued = [message_id for message_id in await writer.run(state.queued_ids, entity.id)
+              if (entity.id, message_id) not in scheduled]
+    if queued:
+        logger.info("[%s] Re-queuing %d unfinished downloads", dialog_name, len(queued))
+        for message_id, message in zip(queued, await api_limiter.call(api.get_messages, entity, ids=queued)):
+            if message and media_filter.matches(message):
+                await enqueue(message)
+            else:
+                # Deleted since, or filtered out now: stop fetching it on every run
+                state.record(entity.id, message_id, status=STATUS_SKIPPED)
 
     logger.info("Scanning messages in '%s'...", dialog_name)
 
-    async for message in client.iter_messages(entity):
-        if not message.file:
+    # Watermarks are kept per filter: a changed TELEGRAM_MEDIA_* setting rescans the dialog
+    async for message in iter_incremental(api, entity, state, limiter=api_limiter,
+                                          message_filter=media_filter.server_filter(), scope=media_filter.scope()):
+        if not media_filter.matches(message):
             continue
-        if message.id in downloaded:
+        # One indexed SELECT, but per scanned message: run it off the event loop
+        if await asyncio.to_thread(state.contains, entity.id, message.id):
             continue
-        try:
-            path = await client.download_media(
-                message,
-                file=str(channel_dir),
-                progress_callback=progress,
-            )
-            if path:
-                print()  # newline after progress\r
-                logger.info("[%s] Saved: %s (message id=%s)", dialog_name, path, message.id)
-                _append_downloaded_id(channel_dir, message.id)
-        except FloodWaitError as fw:
-            # Respect Telegram rate limits
-            wait = int(getattr(fw, "seconds", 5))
-            logger.warning("Flood wait for %s seconds while downloading from '%s'", wait, dialog_name)
-            await asyncio.sleep(wait)
-        except Exception as e:
-            logger.exception("Failed to download media from '%s' message id=%s: %s", dialog_name, message.id, e)
+        await enqueue(message)
+
+
+def _wanted_dialog(dialog) -> bool:
+    # dialog.is_channel includes broadcast channels and megagroups
+    is_channel = getattr(dialog, "is_channel", False)
+    is_group = getattr(dialog, "is_group", False)
+    return is_channel or (include_groups and is_group)
+
+
+async def _scan_dialog(dialog, scheduler: DownloadScheduler, state: DownloadState) -> None:
+    name = dialog.name or str(dialog.id)
+    try:
+        await download_from_dialog(dialog.entity, name, scheduler, state)
+    except Exception as e:
+        logger.exception("Error processing '%s': %s", name, e)
 
 
 async def main():
     base_download_dir.mkdir(parents=True, exist_ok=True)
 
     # Using async context to ensure proper connection lifecycle
-    async with client:
-        logger.info("Fetching your dialogs (chats/channels)...")
-        async for dialog in client.iter_dialogs():
-            # dialog.is_channel includes broadcast channels and megagroups
-            is_channel = getattr(dialog, "is_channel", False)
-            is_group = getattr(dialog, "is_group", False)
-
-            if is_channel or (include_groups and is_group):
-                name = dialog.name or str(dialog.id)
-                try:
-                    await download_from_dialog(dialog.entity, name)
-                except Exception as e:
-                    logger.exception("Error processing '%s': %s", name, e)
+    with writer, SQLiteDownloadState(state_db_path, writer=writer) as state:
+        # TELEGRAM_METRICS_PORT / TELEGRAM_METRICS_JSON expose counters while the sync runs
+        async with client, LoopLagMonitor(), progress, metrics.MetricsReporter.from_env():
+            logger.info("Fetching your dialogs (chats/channels)...")
+            async with DownloadScheduler(max_concurrent, per_dialog_concurrent) as scheduler:
+                scans = []
+                async for dialog in client.iter_dialogs():
+                    if _wanted_dialog(dialog):
+                        scans.append(asyncio.create_task(_scan_dialog(dialog, scheduler, state)))
+                await asyncio.gather(*scans)
+
+
+async def main_pool(names: list[str]) -> None:
+    """Like ``main`` but with one client per session in ``names``, sharing the state store and media store."""
+    base_download_dir.mkdir(parents=True, exist_ok=True)
+
+    async def scan(session: Session, dialog) -> None:
+        await download_from_dialog(dialog.entity, dialog.name or str(dialog.id), scheduler, state, session, pool)
+
+    with writer, SQLiteDownloadState(state_db_path, writer=writer) as state:
+        async with SessionPool(names, api_id, api_hash, max_wait=session_max_wait) as pool, \
+                LoopLagMonitor(), progress, metrics.MetricsReporter.from_env():
+            logger.info("Spreading dialogs over %d sessions...", len(names))
+            async with DownloadScheduler(max_concurrent, per_dialog_concurrent) as scheduler:
+                await pool.run(scan, _wanted_dialog)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main_pool(session_names) if len(session_names) > 1 else main())
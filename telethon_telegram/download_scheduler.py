@@ -0,0 +1,142 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Hashable, Optional
+
+logger = logging.getLogger("downloader.scheduler")
+
+Job = Callable[[], Awaitable[None]]
+
+POLICIES = ('fifo', 'shortest', 'newest')
+
+
+class DownloadOrder:
+    """Sort keys for queued downloads under ``policy``; the smallest key runs first.
+
+    ``fifo`` keeps arrival order, ``newest`` prefers the highest message
+    id, and ``shortest`` prefers small files so a multi-GB video doesn't
+    hold a worker while hundreds of photos wait. To keep a large file from
+    waiting forever behind a stream of small ones, every later arrival
+    counts ``aging_bytes`` larger under ``shortest``.
+    """
+
+    def __init__(self, policy: str = 'shortest', aging_bytes: int = 64 * 1024) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown download order {policy!r}; expected one of {POLICIES}")
+        self.policy = policy
+        self.aging_bytes = aging_bytes
+        self._seq = itertools.count()
+
+    def key(self, size: Optional[int], message_id: int) -> tuple:
+        seq = next(self._seq)
+        if self.policy == 'shortest':
+            return (size or 0) + seq * self.aging_bytes, seq
+        if self.policy == 'newest':
+            return -message_id, seq
+        return seq, seq
+
+
+class DownloadScheduler:
+    """Run download jobs from many dialogs at once.
+
+    Jobs are queued per dialog and handed to a fixed pool of workers in
+    round-robin order, so one huge channel can't starve the others.
+    ``max_concurrent`` caps downloads overall, ``per_dialog`` caps them per
+    dialog and ``max_pending`` bounds each dialog's queue (``submit`` waits
+    when it is full, which keeps history paging from running ahead).
+    Within a dialog, jobs run in ``priority`` order (e.g. a
+    ``DownloadOrder.key``), arrival order among equal ones.
+    """
+
+    def __init__(self, max_concurrent: int = 8, per_dialog: int = 2, max_pending: int = 32) -> None:
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_dialog = max(1, per_dialog)
+        self.max_pending = max(1, max_pending)
+        # Per dialog: heap of (priority, arrival, job)
+        self._pending: dict[Hashable, list[tuple]] = {}
+        self._arrivals = itertools.count()
+        self._active: dict[Hashable, int] = defaultdict(int)
+        self._ring: deque[Hashable] = deque()
+        self._cond: Optional[asyncio.Condition] = None
+        self._workers: list[asyncio.Task] = []
+        self._closed = False
+
+    async def __aenter__(self) -> "DownloadScheduler":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.cancel()
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._cond = asyncio.Condition()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+
+    async def submit(self, key: Hashable, job: Job, priority: tuple = ()) -> None:
+        """Queue ``job`` for dialog ``key``, waiting while that dialog's queue is full."""
+        assert self._cond is not None, "scheduler not started"
+        async with self._cond:
+            await self._cond.wait_for(lambda: len(self._pending.get(key, ())) < self.max_pending)
+            if key not in self._pending:
+                self._pending[key] = []
+                self._ring.append(key)
+            heapq.heappush(self._pending[key], (priority, next(self._arrivals), job))
+            self._cond.notify_all()
+
+    def _next_job(self) -> Optional[tuple[Hashable, Job]]:
+        for _ in range(len(self._ring)):
+            key = self._ring[0]
+            self._ring.rotate(-1)
+            queue = self._pending[key]
+            if queue and self._active[key] < self.per_dialog:
+                self._active[key] += 1
+                return key, heapq.heappop(queue)[2]
+        return None
+
+    def _drained(self) -> bool:
+        return self._closed and not any(self._pending.values())
+
+    async def _worker(self) -> None:
+        while True:
+            async with self._cond:
+                picked = self._next_job()
+                while picked is None and not self._drained():
+                    await self._cond.wait()
+                    picked = self._next_job()
+                if picked is None:
+                    return
+                # A queue slot was freed, wake any producer waiting in submit()
+                self._cond.notify_all()
+
+            key, job = picked
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Download job for %s failed: %s", key, e)
+            finally:
+                async with self._cond:
+                    self._active[key] -= 1
+                    self._cond.notify_all()
+
+    async def close(self) -> None:
+        """Stop accepting work and wait until every queued job has run."""
+        if self._cond is None:
+            return
+        async with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        await asyncio.gather(*self._workers)
+
+    async def cancel(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
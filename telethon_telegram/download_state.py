@@ -0,0 +1,246 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger("downloader.state")
+
+STATUS_DONE = "done"
+STATUS_QUEUED = "queued"
+# Queued once but no longer wanted (deleted, or rejected by the current media filter)
+STATUS_SKIPPED = "skipped"
+
+LEGACY_INDEX_NAME = ".downloaded_ids.txt"
+
+
+@dataclass
+class Watermarks:
+    """Scan progress for one dialog.
+
+    Every message with ``low_id <= id <= high_id`` has been scanned. New
+    messages are read upwards from ``high_id``; history below ``low_id`` is
+    backfilled until ``backfill_done`` is set. ``scope`` names the filter
+    the scan was made with (None: unfiltered); the marks only hold for it.
+    """
+    high_id: Optional[int] = None
+    low_id: Optional[int] = None
+    backfill_done: bool = False
+    scope: Optional[str] = None
+
+
+class DownloadState(ABC):
+    """Persistent record of downloaded messages, keyed by (dialog_id, message_id)."""
+
+    @abstractmethod
+    def contains(self, dialog_id: int, message_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def record(self, dialog_id: int, message_id: int, size: Optional[int] = None,
+               sha256: Optional[str] = None, status: str = STATUS_DONE) -> None:
+        ...
+
+    @abstractmethod
+    def queued_ids(self, dialog_id: int) -> list[int]:
+        """Message ids recorded as queued but never finished (e.g. after a crash)."""
+
+    @abstractmethod
+    def get_watermarks(self, dialog_id: int) -> Watermarks:
+        ...
+
+    @abstractmethod
+    def set_watermarks(self, dialog_id: int, marks: Watermarks) -> None:
+        ...
+
+    @abstractmethod
+    def commit(self) -> None:
+        ...
+
+    @abstractmethod
+    def close(self) -> None:
+        ...
+
+    def __enter__(self) -> "DownloadState":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def migrate_text_index(self, dialog_id: int, folder: Path) -> int:
+        """Import a legacy ``.downloaded_ids.txt`` file once, then rename it out of the way."""
+        idx_file = folder / LEGACY_INDEX_NAME
+        if not idx_file.exists():
+            return 0
+        try:
+            with idx_file.open("r", encoding="utf-8") as f:
+                ids = [int(line.strip()) for line in f if line.strip().isdigit()]
+        except Exception as e:
+            logger.warning("Failed to read index file %s: %s", idx_file, e)
+            return 0
+        for mid in ids:
+            self.record(dialog_id, mid)
+        self.commit()
+        os.replace(idx_file, idx_file.with_name(LEGACY_INDEX_NAME + ".migrated"))
+        logger.info("Migrated %d ids from %s", len(ids), idx_file)
+        return len(ids)
+
+
+class SQLiteDownloadState(DownloadState):
+    """SQLite (WAL) backend; lookups use the (dialog_id, message_id) primary key.
+
+    Writes are committed every ``batch_size`` records or ``commit_interval``
+    seconds; pass ``None`` for both to commit only when ``commit()`` is called.
+    With a ``writer`` (``io_writer.BackgroundWriter``) those automatic commits
+    run on the writer thread; lookups use a separate read connection, so
+    they don't wait for a commit in progress.
+    """
+
+    def __init__(self, db_path: Path, batch_size: Optional[int] = 100, commit_interval: Optional[float] = 5.0,
+                 writer=None) -> None:
+        self.db_path = Path(db_path)
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.writer = writer
+        self._pending: dict[tuple[int, int], tuple] = {}
+        self._pending_marks: dict[int, tuple] = {}
+        # Batch being written by commit(), still visible to lookups until it lands
+        self._committing: dict[tuple[int, int], tuple] = {}
+        self._committing_marks: dict[int, tuple] = {}
+        self._swap_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._commit_scheduled = False
+        self._last_commit = time.monotonic()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                dialog_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                size INTEGER,
+                sha256 TEXT,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (dialog_id, message_id)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                dialog_id INTEGER PRIMARY KEY,
+                high_id INTEGER,
+                low_id INTEGER,
+                backfill_done INTEGER NOT NULL DEFAULT 0,
+                scope TEXT
+            )
+        """)
+        # Stores created before scopes existed
+        if 'scope' not in {row[1] for row in self.conn.execute("PRAGMA table_info(watermarks)")}:
+            self.conn.execute("ALTER TABLE watermarks ADD COLUMN scope TEXT")
+        self.conn.commit()
+        self._read_conn = sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def contains(self, dialog_id: int, message_id: int) -> bool:
+        key = (dialog_id, message_id)
+        with self._swap_lock:
+            pending = self._pending.get(key) or self._committing.get(key)
+        if pending is not None:
+            return pending[4] == STATUS_DONE
+        row = self._read_conn.execute(
+            "SELECT 1 FROM downloads WHERE dialog_id = ? AND message_id = ? AND status = ?",
+            (dialog_id, message_id, STATUS_DONE),
+        ).fetchone()
+        return row is not None
+
+    def record(self, dialog_id: int, message_id: int, size: Optional[int] = None,
+               sha256: Optional[str] = None, status: str = STATUS_DONE) -> None:
+        with self._swap_lock:
+            self._pending[(dialog_id, message_id)] = (dialog_id, message_id, size, sha256, status, time.time())
+        self._maybe_commit()
+
+    def queued_ids(self, dialog_id: int) -> list[int]:
+        self.commit()
+        rows = self._read_conn.execute(
+            "SELECT message_id FROM downloads WHERE dialog_id = ? AND status = ? ORDER BY message_id",
+            (dialog_id, STATUS_QUEUED),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_watermarks(self, dialog_id: int) -> Watermarks:
+        with self._swap_lock:
+            row = self._pending_marks.get(dialog_id) or self._committing_marks.get(dialog_id)
+        if row is None:
+            row = self._read_conn.execute(
+                "SELECT dialog_id, high_id, low_id, backfill_done, scope FROM watermarks WHERE dialog_id = ?",
+                (dialog_id,),
+            ).fetchone()
+        if row is None:
+            return Watermarks()
+        return Watermarks(high_id=row[1], low_id=row[2], backfill_done=bool(row[3]), scope=row[4])
+
+    def set_watermarks(self, dialog_id: int, marks: Watermarks) -> None:
+        with self._swap_lock:
+            self._pending_marks[dialog_id] = (dialog_id, marks.high_id, marks.low_id, int(marks.backfill_done),
+                                              marks.scope)
+        self._maybe_commit()
+
+    def _maybe_commit(self) -> None:
+        if ((self.batch_size is not None and len(self._pending) + len(self._pending_marks) >= self.batch_size)
+                or (self.commit_interval is not None and time.monotonic() - self._last_commit >= self.commit_interval)):
+            if self.writer is None:
+                self.commit()
+            elif not self._commit_scheduled:
+                self._commit_scheduled = True
+                self._last_commit = time.monotonic()
+                self.writer.submit(self.commit)
+
+    def commit(self) -> None:
+        with self._commit_lock:
+            self._commit_scheduled = False
+            self._last_commit = time.monotonic()
+            with self._swap_lock:
+                if not self._pending and not self._pending_marks:
+                    return
+                self._committing, self._pending = self._pending, {}
+                self._committing_marks, self._pending_marks = self._pending_marks, {}
+            try:
+                self._write(list(self._committing.values()), list(self._committing_marks.values()))
+            except Exception:
+                # Put the batch back (newer records win) so a later commit retries it
+                with self._swap_lock:
+                    self._pending = {**self._committing, **self._pending}
+                    self._pending_marks = {**self._committing_marks, **self._pending_marks}
+                raise
+            finally:
+                with self._swap_lock:
+                    self._committing, self._committing_marks = {}, {}
+
+    def _write(self, downloads: list[tuple], marks: list[tuple]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO watermarks (dialog_id, high_id, low_id, backfill_done, scope)"
+                " VALUES (?, ?, ?, ?, ?)",
+                marks,
+            )
+            self.conn.executemany("""
+                INSERT INTO downloads (dialog_id, message_id, size, sha256, status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (dialog_id, message_id) DO UPDATE SET
+                    size = COALESCE(excluded.size, size),
+                    sha256 = COALESCE(excluded.sha256, sha256),
+                    status = excluded.status,
+                    updated_at = excluded.updated_at
+            """, downloads)
+
+    def close(self) -> None:
+        try:
+            self.commit()
+        finally:
+            self._read_conn.close()
+            self.conn.close()
@@ -0,0 +1,234 @@
+import logging
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from telethon import utils
+from telethon.tl import types
+
+import metrics
+from rate_limit import AdaptiveRateLimiter
+
+logger = logging.getLogger("scraper.entity_cache")
+
+# One day: titles and usernames change rarely, access hashes practically never
+DEFAULT_TTL = 24 * 3600.0
+
+_USERNAME = re.compile(r'^(@|(?:https?://)?(?:t\.me|telegram\.me)/)?([A-Za-z][A-Za-z0-9_]{3,31})/?$')
+
+
+def _normalize(target: Union[str, int]) -> tuple[Optional[int], Optional[str], Optional[str]]:
+    """``target`` as (peer id, lower-case username, title); the ones that don't apply are None.
+
+    A bare word such as ``Crypto`` is both a possible username and a
+    possible title; only ``@name`` and t.me links are usernames for sure
+    (see ``_is_explicit``).
+    """
+    if isinstance(target, int):
+        return target, None, None
+    text = target.strip()
+    if re.fullmatch(r'-?\d+', text):
+        return int(text), None, None
+    match = _USERNAME.match(text)
+    return None, match.group(2).lower() if match else None, text
+
+
+def _is_explicit(target: Union[str, int]) -> bool:
+    """Whether ``target`` is an id, ``@name`` or t.me link, i.e. safe to hand to ``get_entity``."""
+    if isinstance(target, int) or re.fullmatch(r'\s*-?\d+\s*', target):
+        return True
+    match = _USERNAME.match(target.strip())
+    return bool(match and match.group(1))
+
+
+def _describe(entity) -> tuple[int, str, int, Optional[int], str, Optional[str]]:
+    """(peer id, kind, bare id, access hash, title, username) of a Telethon User/Chat/Channel."""
+    if isinstance(entity, types.User):
+        kind = 'user'
+        title = ' '.join(filter(None, (entity.first_name, entity.last_name))) or entity.username or str(entity.id)
+    elif isinstance(entity, (types.Chat, types.ChatForbidden)):
+        kind, title = 'chat', entity.title
+    else:
+        kind, title = 'channel', entity.title
+    return (utils.get_peer_id(entity), kind, entity.id, getattr(entity, 'access_hash', None), title,
+            getattr(entity, 'username', None))
+
+
+def _rebuild(kind: str, entity_id: int, access_hash: Optional[int], title: str, username: Optional[str]):
+    """Minimal Telethon entity: enough for ``.id``/``.title`` and for the client to build an input peer."""
+    if kind == 'user':
+        return types.User(id=entity_id, access_hash=access_hash, first_name=title, username=username)
+    if kind == 'chat':
+        return types.Chat(id=entity_id, title=title, photo=types.ChatPhotoEmpty(), participants_count=0,
+                          date=None, version=0)
+    return types.Channel(id=entity_id, title=title, photo=types.ChatPhotoEmpty(), date=None,
+                         access_hash=access_hash, username=username)
+
+
+class EntityCache:
+    """Persistent id / access hash / title / username cache, so targets resolve without API calls.
+
+    Access hashes are only valid for the account that fetched them, so
+    use one cache per session (``for_session``). Entries older than
+    ``ttl`` seconds count as misses. ``resolve`` looks a target up
+    locally first; on a miss it asks ``get_entity`` (usernames, links,
+    ids) and falls back to ``refresh_dialogs`` for dialog titles. Dialog
+    listings are refreshed incrementally: only dialogs with activity
+    since the last listing are fetched, with a full listing once ``ttl``
+    has passed. Call ``invalidate`` when a cached entity stops working
+    (e.g. ``ChannelInvalidError``). ``hits``/``misses`` of ``get`` are also
+    exported as ``scraper_cache_lookups_total{cache="entity_cache"}``.
+    """
+
+    def __init__(self, path: Union[str, Path], ttl: float = DEFAULT_TTL) -> None:
+        self.path = Path(path)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit: a handful of rows per run, and nothing to lose if the process dies
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entities (
+                peer_id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                entity_id INTEGER NOT NULL,
+                access_hash INTEGER,
+                title TEXT,
+                username TEXT COLLATE NOCASE,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entities_username ON entities (username)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entities_title ON entities (title)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+    @classmethod
+    def for_session(cls, session: str, ttl: float = DEFAULT_TTL) -> "EntityCache":
+        """Cache stored next to a Telethon session file (``<session>.entities.db``)."""
+        return cls(f'{session}.entities.db', ttl=ttl)
+
+    def __enter__(self) -> "EntityCache":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def put(self, *entities) -> None:
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(*_describe(entity), now) for entity in entities],
+        )
+
+    def get(self, target: Union[str, int]):
+        """Fresh cached entity for a peer id, username, t.me link or exact title, else None."""
+        peer_id, username, title = _normalize(target)
+        columns = "kind, entity_id, access_hash, title, username"
+        cutoff = time.time() - self.ttl
+        if peer_id is not None:
+            row = self.conn.execute(
+                f"SELECT {columns} FROM entities WHERE (peer_id = ? OR entity_id = ?) AND updated_at >= ? "
+                "ORDER BY peer_id = ? DESC LIMIT 1", (peer_id, peer_id, cutoff, peer_id)).fetchone()
+        else:
+            by_username = (f"SELECT {columns} FROM entities WHERE username = ? AND updated_at >= ?",
+                           (username, cutoff))
+            by_title = (f"SELECT {columns} FROM entities WHERE title = ? AND updated_at >= ? "
+                        "ORDER BY updated_at DESC LIMIT 1", (title, cutoff))
+            # A bare word is a dialog title first: "Crypto" needn't be @crypto
+            queries = (by_username, by_title) if _is_explicit(target) else (by_title, by_username)
+            row = None
+            for sql, params in queries:
+                if params[0] is not None:
+                    row = self.conn.execute(sql, params).fetchone()
+                    if row is not None:
+                        break
+        if row is None:
+            self.misses += 1
+            metrics.cache_lookups.labels('entity_cache', 'miss').inc()
+            return None
+        self.hits += 1
+        metrics.cache_lookups.labels('entity_cache', 'hit').inc()
+        return _rebuild(*row)
+
+    def invalidate(self, target: Union[str, int, None] = None) -> None:
+        """Forget one target (as accepted by ``get``), or everything when ``target`` is None."""
+        if target is None:
+            self.conn.execute("DELETE FROM entities")
+            self.conn.execute("DELETE FROM meta")
+            return
+        peer_id, username, title = _normalize(target)
+        if peer_id is not None:
+            self.conn.execute("DELETE FROM entities WHERE peer_id = ? OR entity_id = ?", (peer_id, peer_id))
+        else:
+            self.conn.execute("DELETE FROM entities WHERE username = ? OR title = ?", (username, title))
+
+    def _meta(self, key: str) -> float:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0.0
+
+    def _set_meta(self, key: str, value: float) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    async def refresh_dialogs(self, client, full: bool = False) -> int:
+        """Store the account's dialogs; returns how many were listed.
+
+        Dialogs come newest activity first, so an incremental refresh stops
+        at the first unpinned dialog with nothing new since the last listing.
+        """
+        started = time.time()
+        last_full = self._meta('dialogs_full')
+        full = full or started - last_full >= self.ttl
+        since = None if full else max(last_full, self._meta('dialogs_incremental'))
+        listed = []
+        async for dialog in client.iter_dialogs():
+            if since is not None and not dialog.pinned and dialog.date is not None \
+                    and dialog.date.timestamp() < since:
+                break
+            listed.append(dialog.entity)
+        if listed:
+            self.put(*listed)
+        self._set_meta('dialogs_full' if full else 'dialogs_incremental', started)
+        logger.info("Listed %d dialogs (%s refresh)", len(listed), 'full' if full else 'incremental')
+        return len(listed)
+
+    async def resolve(self, client, target: Union[str, int], limiter: Optional[AdaptiveRateLimiter] = None):
+        """Entity for ``target`` from the cache, else from the API (and cached for next time).
+
+        Ids, ``@name`` and t.me links go to ``get_entity``. Anything else is
+        a dialog title (or the username of a joined dialog) and is only
+        looked for in the dialog listing, so a title like "Crypto" never
+        resolves to whichever public @crypto exists.
+        """
+        entity = self.get(target)
+        if entity is not None:
+            return entity
+        if not _is_explicit(target):
+            return await self._resolve_from_dialogs(client, target)
+        peer_id, _, _ = _normalize(target)
+        lookup = peer_id if peer_id is not None else target
+        try:
+            if limiter is not None:
+                entity = await limiter.call(client.get_entity, lookup)
+            else:
+                entity = await client.get_entity(lookup)
+        except ValueError:
+            # An id only the dialog listing can resolve (no access hash in the session yet)
+            return await self._resolve_from_dialogs(client, target)
+        self.put(entity)
+        return entity
+
+    async def _resolve_from_dialogs(self, client, target: Union[str, int]):
+        # A quiet dialog is missed by the incremental listing, so try a full one before giving up
+        for full in (False, True):
+            await self.refresh_dialogs(client, full=full)
+            entity = self.get(target)
+            if entity is not None:
+                return entity
+        raise ValueError(f"No dialog matches {target!r}")
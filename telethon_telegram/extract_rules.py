@@ -0,0 +1,140 @@
+import json
+import logging
+import re
+from typing import NamedTuple, Optional, Sequence
+
+try:
+    from re import _constants, _parser
+except ImportError:  # Python < 3.11
+    import sre_constants as _constants
+    import sre_parse as _parser
+
+logger = logging.getLogger("scraper.rules")
+
+_REPEATS = tuple(
+    getattr(_constants, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(_constants, name)
+)
+
+
+class Rule(NamedTuple):
+    """One extraction rule; ``group`` is the capture group whose text becomes the column value."""
+    name: str
+    pattern: str
+    group: int = 1
+    # Inline regex flags applied to this rule only, e.g. "i"
+    flags: str = ''
+
+
+DEFAULT_RULES = (
+    Rule('pass_value', r'```\s*([^\s`]+)\s*```'),
+)
+
+
+def _required_literal(pattern: str) -> Optional[str]:
+    """Longest literal substring every match of ``pattern`` must contain, if any."""
+    try:
+        parsed = _parser.parse(pattern)
+    except re.error:
+        return None
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+    best = ''
+
+    def walk(items) -> None:
+        nonlocal best
+        run: list[str] = []
+        for op, av in items:
+            if op is _constants.LITERAL:
+                run.append(chr(av))
+                continue
+            if op is _constants.AT:
+                # Zero-width (^, $, \b) doesn't split a literal run
+                continue
+            if len(run) > len(best):
+                best = ''.join(run)
+            run = []
+            if op is _constants.SUBPATTERN and not av[1] & re.IGNORECASE:
+                walk(av[3])
+            elif op in _REPEATS and av[0] >= 1:
+                walk(av[2])
+        if len(run) > len(best):
+            best = ''.join(run)
+
+    walk(parsed)
+    return best or None
+
+
+class RuleSet:
+    """Runs many extraction rules with a cheap literal prefilter.
+
+    For every rule the longest literal its matches must contain (e.g.
+    "```" or "http") is derived from the pattern. ``scan`` checks those
+    literals with plain substring search and only runs the regexes whose
+    literal occurs in the text, so most rules cost a ``str.__contains__``
+    per message. Rules without a usable literal (case-insensitive ones, or
+    patterns like ``\\d+``) always run.
+    """
+
+    def __init__(self, rules: Sequence[Rule] = DEFAULT_RULES) -> None:
+        self.rules = tuple(Rule(*rule) if not isinstance(rule, Rule) else rule for rule in rules)
+        self.names = tuple(rule.name for rule in self.rules)
+        if len(set(self.names)) != len(self.names):
+            raise ValueError(f"Duplicate rule names: {self.names}")
+        # Names become table columns
+        invalid = [name for name in self.names if not name.isidentifier()]
+        if invalid:
+            raise ValueError(f"Rule names must be identifiers (letters, digits, _): {invalid}")
+
+        # Rules grouped by their literal; several rules sharing one literal cost a single check
+        self._by_literal: dict[str, list[tuple]] = {}
+        self._always: list[tuple] = []
+        for position, rule in enumerate(self.rules):
+            # Leading global flags rather than a (?x:...) group, which a trailing verbose comment would swallow
+            body = f'(?{rule.flags}){rule.pattern}' if rule.flags else rule.pattern
+            compiled = re.compile(body)
+            if rule.group > compiled.groups:
+                raise ValueError(f"Rule {rule.name!r} has no group {rule.group}")
+            entry = (position, compiled.search, rule.group)
+            # From the flagged body, so verbose whitespace and case-insensitive flags are accounted for
+            literal = _required_literal(body)
+            if literal is None:
+                self._always.append(entry)
+            else:
+                self._by_literal.setdefault(literal, []).append(entry)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def scan(self, text: Optional[str]) -> tuple:
+        """Return one value per rule (``None`` where it didn't match), in ``names`` order."""
+        values = [None] * len(self.rules)
+        if not text:
+            return tuple(values)
+        for literal, entries in self._by_literal.items():
+            if literal in text:
+                for position, search, group in entries:
+                    match = search(text)
+                    if match:
+                        values[position] = match.group(group)
+        for position, search, group in self._always:
+            match = search(text)
+            if match:
+                values[position] = match.group(group)
+        return tuple(values)
+
+    @classmethod
+    def from_file(cls, path: str) -> "RuleSet":
+        """Load rules from a JSON list of ``{"name", "pattern", "group"?, "flags"?}`` objects."""
+        with open(path, encoding='utf-8') as f:
+            entries = json.load(f)
+        rules = [Rule(entry['name'], entry['pattern'], entry.get('group', 1), entry.get('flags', ''))
+                 for entry in entries]
+        logger.info("Loaded %d extraction rules from %s", len(rules), path)
+        return cls(rules)
+
+
+def load_rules(path: Optional[str] = None) -> RuleSet:
+    """Rules from ``path`` if given, otherwise the built-in ``pass_value`` rule."""
+    if path:
+        return RuleSet.from_file(path)
+    return RuleSet(DEFAULT_RULES)
@@ -0,0 +1,129 @@
+import logging
+from dataclasses import replace
+from typing import AsyncIterator, Optional
+
+from download_state import DownloadState, Watermarks
+from rate_limit import AdaptiveRateLimiter
+
+logger = logging.getLogger("downloader.incremental")
+
+
+async def iter_incremental(client, entity, state: DownloadState, limit: Optional[int] = None,
+                           limiter: Optional[AdaptiveRateLimiter] = None, message_filter=None,
+                           scope: Optional[str] = None) -> AsyncIterator:
+    """Yield only messages not scanned by a previous run.
+
+    First pages forward from the dialog's high-water mark (oldest first, so
+    the mark can advance message by message), then continues the backfill
+    below the low-water mark until the start of history is reached.
+    Watermarks move only after the caller has handled a message, so an
+    interrupted run resumes where it stopped. History requests go through
+    ``limiter`` when one is given. ``message_filter`` (an
+    ``InputMessagesFilter``) has the server return only matching messages;
+    the watermarks then track that filtered history. ``scope`` names
+    whatever narrows the scan (server filter or a filter the caller applies
+    to what is yielded) and is stored with the watermarks: when it differs
+    from the stored one, the dialog is scanned again from scratch, so
+    widening a filter never leaves older history unseen.
+    """
+    iter_messages = client.iter_messages if limiter is None else (
+        lambda entity, **kwargs: limiter.iter_messages(client, entity, **kwargs))
+    if message_filter is not None:
+        unfiltered = iter_messages
+        iter_messages = lambda entity, **kwargs: unfiltered(entity, filter=message_filter, **kwargs)
+    marks = state.get_watermarks(entity.id)
+    if marks.scope != scope:
+        if marks.high_id is not None or marks.backfill_done:
+            logger.info("Filter of %s changed from %s to %s; rescanning its history", entity.id, marks.scope, scope)
+        marks = Watermarks(scope=scope)
+    seen = 0
+
+    if marks.high_id is not None or marks.backfill_done:
+        logger.info("Fetching messages newer than %s in %s", marks.high_id, entity.id)
+        async for message in iter_messages(entity, min_id=marks.high_id or 0, reverse=True, limit=limit):
+            yield message
+            seen += 1
+            marks.high_id = max(marks.high_id or 0, message.id)
+            state.set_watermarks(entity.id, marks)
+
+    if marks.backfill_done:
+        return
+
+    remaining = None if limit is None else limit - seen
+    if remaining is not None and remaining <= 0:
+        return
+
+    logger.info("Backfilling messages older than %s in %s", marks.low_id or "latest", entity.id)
+    backfilled = 0
+    async for message in iter_messages(entity, offset_id=marks.low_id or 0, limit=remaining):
+        yield message
+        backfilled += 1
+        if marks.high_id is None:
+            marks.high_id = message.id
+        marks.low_id = message.id
+        state.set_watermarks(entity.id, marks)
+
+    if remaining is None or backfilled < remaining:
+        marks.backfill_done = True
+        state.set_watermarks(entity.id, marks)
+
+
+class DeferredWatermarks:
+    """State wrapper that holds back watermarks until the messages they cover are persisted.
+
+    Pass it to ``iter_incremental`` in place of the real state when messages
+    are handed to a queue (see ``pipeline.MessagePipeline``) rather than
+    handled before the next one is requested. ``release(count)`` applies the
+    watermarks recorded after the first ``count`` yielded messages;
+    ``release(None)`` applies everything, including the final backfill flag.
+    ``take`` and ``apply`` are the two halves of ``release``, for sinks that
+    write rows on another thread: apply there, after the rows are written.
+    """
+
+    def __init__(self, state: DownloadState) -> None:
+        self.state = state
+        self._staged: list[tuple[int, Watermarks]] = []
+        self._latest: dict[int, Watermarks] = {}
+        self._released = 0
+
+    def get_watermarks(self, dialog_id: int) -> Watermarks:
+        # Staged marks are newer than the state's; a second reader of the same dialog must build on them
+        marks = self._latest.get(dialog_id)
+        return replace(marks) if marks is not None else self.state.get_watermarks(dialog_id)
+
+    def set_watermarks(self, dialog_id: int, marks: Watermarks) -> None:
+        marks = replace(marks)
+        previous = self.get_watermarks(dialog_id)
+        self._latest[dialog_id] = marks
+        if ((previous.high_id, previous.low_id, previous.scope) == (marks.high_id, marks.low_id, marks.scope)
+                and previous.backfill_done != marks.backfill_done):
+            # Only the backfill_done flag: no new message behind this update, so it must not
+            # take a slot of its own: amend the dialog's last staged entry, or apply it directly
+            for i in range(len(self._staged) - 1, -1, -1):
+                if self._staged[i][0] == dialog_id:
+                    self._staged[i] = (dialog_id, marks)
+                    return
+            self.state.set_watermarks(dialog_id, marks)
+            return
+        # Anything else stands for one yielded message, even if no mark moved (see live.iter_live)
+        self._staged.append((dialog_id, marks))
+
+    def take(self, count: Optional[int] = None) -> dict[int, Watermarks]:
+        """Unstage what ``release(count)`` would apply, for ``apply`` to write later (e.g. on a writer thread)."""
+        # Staged entries before self._released have already been taken and dropped
+        pending = len(self._staged) if count is None else min(count - self._released, len(self._staged))
+        if pending <= 0:
+            return {}
+        latest: dict[int, Watermarks] = {}
+        for dialog_id, marks in self._staged[:pending]:
+            latest[dialog_id] = marks
+        del self._staged[:pending]
+        self._released += pending
+        return latest
+
+    def apply(self, latest: dict[int, Watermarks]) -> None:
+        for dialog_id, marks in latest.items():
+            self.state.set_watermarks(dialog_id, marks)
+
+    def release(self, count: Optional[int] = None) -> None:
+        self.apply(self.take(count))
@@ -0,0 +1,191 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional, Sequence, TypeVar
+
+logger = logging.getLogger("scraper.io_writer")
+
+T = TypeVar("T")
+
+
+class BackgroundWriter:
+    """A single worker thread that runs filesystem and database side effects in submission order.
+
+    Jobs submitted from the event loop queue up and return immediately
+    (``submit``) or can be awaited (``run``) without blocking the loop.
+    Because there is only one thread, jobs never overtake each other, e.g.
+    a checkpoint always sees every row written before it. Objects holding
+    SQLite connections should be created on the writer (``call``) so the
+    connection belongs to its thread.
+    """
+
+    def __init__(self, name: str = 'io-writer') -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        # Jobs queued or running; raised on the submitting thread, lowered on the writer thread
+        self.pending = 0
+        self._pending_lock = threading.Lock()
+
+    def submit(self, func: Callable[..., T], *args, **kwargs) -> Future:
+        """Queue ``func(*args, **kwargs)``; failures are logged and kept on the returned future."""
+        with self._pending_lock:
+            self.pending += 1
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._pending_lock:
+            self.pending -= 1
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Background write failed: %s", future.exception())
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Queue ``func`` and wait for its result without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def call(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Run ``func`` on the writer thread and block until it returns (setup and shutdown only)."""
+        return self.submit(func, *args, **kwargs).result()
+
+    def close(self) -> None:
+        """Finish every queued job, then stop the thread."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "BackgroundWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+def _write_rows(sink, rows: Sequence[Sequence]) -> None:
+    for row in rows:
+        sink.write(row)
+
+
+class ThreadedSink:
+    """Runs any sink (``CsvSink``, ``SqliteSink``, ...) on a ``BackgroundWriter``.
+
+    ``factory()`` builds the sink on the writer thread. ``write`` only
+    appends to a local list; every ``batch_rows`` rows the batch is handed
+    to the writer. ``acheckpoint()`` waits until everything written so far
+    is checkpointed, without blocking the loop. ``then()`` runs a callback
+    on the writer once the rows before it are in the sink, e.g. to stage
+    state that a sink flush may commit. A failed background write
+    is raised from the next call.
+    """
+
+    def __init__(self, writer: BackgroundWriter, factory: Callable[[], Any], batch_rows: int = 256) -> None:
+        self.writer = writer
+        self.batch_rows = batch_rows
+        self.sink = writer.call(factory)
+        self.columns = getattr(self.sink, 'columns', None)
+        self._rows: list[Sequence] = []
+        self._last: Optional[Future] = None
+        self.closed = False
+
+    def __enter__(self) -> "ThreadedSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def _raise_failed(self) -> None:
+        if self._last is not None and self._last.done() and self._last.exception() is not None:
+            raise self._last.exception()
+
+    def _submit(self, func: Optional[Callable[[], None]] = None) -> Future:
+        self._raise_failed()
+        rows, self._rows = self._rows, []
+        sink = self.sink
+
+        def job() -> None:
+            _write_rows(sink, rows)
+            if func is not None:
+                func()
+
+        self._last = self.writer.submit(job)
+        return self._last
+
+    def write(self, row: Sequence) -> None:
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_rows:
+            self._submit()
+
+    def flush(self) -> Future:
+        return self._submit(self.sink.flush)
+
+    def then(self, func: Callable[..., None], *args) -> Future:
+        """Hand the rows written so far to the writer and run ``func(*args)`` there right after them."""
+        return self._submit(functools.partial(func, *args))
+
+    def checkpoint(self) -> Future:
+        return self._submit(self.sink.checkpoint)
+
+    async def acheckpoint(self) -> None:
+        await asyncio.wrap_future(self.checkpoint())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._submit(self.sink.close).result()
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task that sleeps ``interval`` seconds.
+
+    A responsive loop shows lag close to zero; blocking calls on the loop
+    show up directly as lag. ``max_lag`` and ``p99`` cover the samples kept
+    (the last ``window``), and a summary is logged on ``stop()``.
+    """
+
+    def __init__(self, interval: float = 0.1, window: int = 3000, warn_after: float = 0.25) -> None:
+        self.interval = interval
+        self.warn_after = warn_after
+        self.samples: deque[float] = deque(maxlen=window)
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name='loop-lag-monitor')
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        logger.info("Event loop lag: mean %.1f ms, p99 %.1f ms, max %.1f ms",
+                    self.mean * 1000, self.p99 * 1000, self.max_lag * 1000)
+
+    async def __aenter__(self) -> "LoopLagMonitor":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.stop()
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.warn_after:
+                logger.warning("Event loop was blocked for %.0f ms", lag * 1000)
+
+    @property
+    def mean(self) -> float:
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    @property
+    def p99(self) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Optional, Sequence
+
+from telethon import events
+
+from download_state import DownloadState
+from incremental import iter_incremental
+from rate_limit import AdaptiveRateLimiter
+
+logger = logging.getLogger("scraper.live")
+
+
+async def iter_live(client, entities: Sequence, state: DownloadState, limit: Optional[int] = None,
+                    limiter: Optional[AdaptiveRateLimiter] = None, queue_size: int = 1000) -> AsyncIterator:
+    """Yield messages from ``entities`` as they are posted, until cancelled.
+
+    A ``NewMessage`` handler is registered first, then each dialog is
+    caught up with ``iter_incremental`` (up to ``limit`` messages), so
+    nothing posted while catching up is missed; live messages at or below
+    what the catch-up already returned are dropped. Each live message
+    raises the dialog's high-water mark, so the next polling run starts
+    after it, unless ``limit`` cut the catch-up short: the messages between
+    it and the live ones were never yielded, so the mark stays where the
+    catch-up left it and the next run fetches them. Updates wait in a queue of ``queue_size`` messages; when it
+    is full the handler blocks, which holds back Telethon's update loop
+    rather than buffering without bound.
+    """
+    queue: asyncio.Queue = asyncio.Queue(queue_size)
+    handlers = []
+    for entity in entities:
+        async def on_message(event, entity=entity) -> None:
+            await queue.put((entity, event.message))
+        client.add_event_handler(on_message, events.NewMessage(chats=[entity]))
+        handlers.append(on_message)
+
+    try:
+        last_seen: dict[int, int] = {}
+        truncated: set[int] = set()
+        for entity in entities:
+            count = 0
+            async for message in iter_incremental(client, entity, state, limit=limit, limiter=limiter):
+                last_seen[entity.id] = max(last_seen.get(entity.id, 0), message.id)
+                count += 1
+                yield message
+            if limit is not None and count >= limit:
+                truncated.add(entity.id)
+        logger.info("Caught up with %d dialogs; listening for new messages", len(entities))
+
+        while True:
+            entity, message = await queue.get()
+            if message.id <= last_seen.get(entity.id, 0):
+                continue
+            last_seen[entity.id] = message.id
+            # One watermark per message, like iter_incremental, so DeferredWatermarks can count them;
+            # an unchanged mark (after a truncated catch-up) still takes that message's slot.
+            # Staged before the yield: the generator may be cancelled while waiting for the next update.
+            marks = state.get_watermarks(entity.id)
+            if entity.id not in truncated:
+                marks.high_id = max(marks.high_id or 0, message.id)
+            state.set_watermarks(entity.id, marks)
+            yield message
+    finally:
+        for on_message in handlers:
+            client.remove_event_handler(on_message)
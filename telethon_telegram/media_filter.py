@@ -0,0 +1,174 @@
+import datetime
+import fnmatch
+import json
+import os
+from dataclasses import dataclass
+from typing import AsyncIterable, AsyncIterator, Optional
+
+from telethon.tl import types
+
+from senders import bare_id
+
+# Everything worth downloading by default: stickers and link previews are left out
+DEFAULT_KINDS = frozenset({'photo', 'video', 'document', 'audio', 'voice', 'gif', 'round'})
+
+# Kinds the server can pre-filter on exactly, and the filter that does it
+_SERVER_FILTERS = {
+    frozenset({'photo'}): types.InputMessagesFilterPhotos,
+    frozenset({'video'}): types.InputMessagesFilterVideo,
+    frozenset({'photo', 'video'}): types.InputMessagesFilterPhotoVideo,
+    frozenset({'document'}): types.InputMessagesFilterDocument,
+    frozenset({'audio'}): types.InputMessagesFilterMusic,
+    frozenset({'voice'}): types.InputMessagesFilterVoice,
+    frozenset({'round'}): types.InputMessagesFilterRoundVideo,
+    frozenset({'voice', 'round'}): types.InputMessagesFilterRoundVoice,
+    frozenset({'gif'}): types.InputMessagesFilterGif,
+}
+
+
+def media_kind(message) -> Optional[str]:
+    """'photo', 'video', 'document', 'audio', 'voice', 'gif', 'round', 'sticker' or 'webpage'; None without media.
+
+    Read from the raw media and document attributes, so it costs no more
+    than an ``isinstance`` and a scan of a few attributes.
+    """
+    media = message.media
+    if isinstance(media, types.MessageMediaPhoto):
+        return 'photo' if isinstance(media.photo, types.Photo) else None
+    if isinstance(media, types.MessageMediaWebPage):
+        return 'webpage'
+    if not isinstance(media, types.MessageMediaDocument) or not isinstance(media.document, types.Document):
+        return None
+    animated = False
+    video = audio = None
+    for attr in media.document.attributes:
+        if isinstance(attr, types.DocumentAttributeSticker):
+            return 'sticker'
+        if isinstance(attr, types.DocumentAttributeAnimated):
+            animated = True
+        elif isinstance(attr, types.DocumentAttributeVideo):
+            video = attr
+        elif isinstance(attr, types.DocumentAttributeAudio):
+            audio = attr
+    if animated:
+        return 'gif'
+    if video is not None:
+        return 'round' if video.round_message else 'video'
+    if audio is not None:
+        return 'voice' if audio.voice else 'audio'
+    return 'document'
+
+
+def _split(value: str) -> tuple[str, ...]:
+    return tuple(part.strip() for part in value.split(',') if part.strip())
+
+
+def _parse_date(value: str) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    date = datetime.datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=datetime.timezone.utc)
+
+
+@dataclass(frozen=True)
+class MediaFilter:
+    """Which media to download, decided from message metadata alone.
+
+    ``kinds`` are ``media_kind`` values. ``mime_types`` are patterns such
+    as ``video/*``; ``extensions`` are matched case-insensitively with or
+    without the dot. Sizes are in bytes; ``since`` is inclusive and
+    ``until`` exclusive. ``senders`` are user/chat ids, marked or bare.
+    Empty or None means "any". ``matches`` touches no disk and makes no
+    request, so rejected media costs neither bandwidth nor quota.
+
+    ``server_filter()`` is the ``InputMessagesFilter`` for
+    ``iter_messages(filter=...)`` when ``kinds`` map onto one exactly, so
+    Telegram leaves out other messages too. A server filter turns history
+    paging into a search, and resume watermarks then only cover what it
+    returned. ``scope()`` identifies the filter for those watermarks, so a
+    changed filter rescans the history instead of skipping it.
+    """
+    kinds: frozenset = DEFAULT_KINDS
+    mime_types: tuple[str, ...] = ()
+    extensions: tuple[str, ...] = ()
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    since: Optional[datetime.datetime] = None
+    until: Optional[datetime.datetime] = None
+    senders: frozenset = frozenset()
+
+    def __post_init__(self) -> None:
+        unknown = set(self.kinds) - DEFAULT_KINDS - {'sticker', 'webpage'}
+        if unknown:
+            raise ValueError(f"Unknown media kinds {sorted(unknown)}")
+        object.__setattr__(self, 'kinds', frozenset(self.kinds))
+        object.__setattr__(self, 'mime_types', tuple(pattern.lower() for pattern in self.mime_types))
+        object.__setattr__(self, 'extensions', tuple(
+            '.' + ext.lower().lstrip('.') for ext in self.extensions))
+        object.__setattr__(self, 'senders', frozenset(bare_id(sender) for sender in self.senders))
+
+    @classmethod
+    def from_env(cls) -> "MediaFilter":
+        """Filter from the TELEGRAM_MEDIA_* variables (comma-separated lists, ISO dates)."""
+        kinds = _split(os.getenv("TELEGRAM_MEDIA_KINDS", ""))
+        return cls(
+            kinds=frozenset(kinds) if kinds else DEFAULT_KINDS,
+            mime_types=_split(os.getenv("TELEGRAM_MEDIA_MIME_TYPES", "")),
+            extensions=_split(os.getenv("TELEGRAM_MEDIA_EXTENSIONS", "")),
+            min_size=int(os.getenv("TELEGRAM_MEDIA_MIN_SIZE")) if os.getenv("TELEGRAM_MEDIA_MIN_SIZE") else None,
+            max_size=int(os.getenv("TELEGRAM_MEDIA_MAX_SIZE")) if os.getenv("TELEGRAM_MEDIA_MAX_SIZE") else None,
+            since=_parse_date(os.getenv("TELEGRAM_MEDIA_SINCE", "")),
+            until=_parse_date(os.getenv("TELEGRAM_MEDIA_UNTIL", "")),
+            senders=frozenset(int(sender) for sender in _split(os.getenv("TELEGRAM_MEDIA_SENDERS", ""))),
+        )
+
+    def scope(self) -> Optional[str]:
+        """Stable description of this filter for ``iter_incremental(scope=...)``; None for the default filter."""
+        if self == MediaFilter():
+            return None
+        return json.dumps({
+            'kinds': sorted(self.kinds), 'mime_types': sorted(self.mime_types),
+            'extensions': sorted(self.extensions), 'min_size': self.min_size, 'max_size': self.max_size,
+            'since': self.since.isoformat() if self.since else None,
+            'until': self.until.isoformat() if self.until else None, 'senders': sorted(self.senders),
+        }, sort_keys=True)
+
+    def server_filter(self) -> Optional[types.TypeMessagesFilter]:
+        server_filter = _SERVER_FILTERS.get(self.kinds)
+        return server_filter() if server_filter is not None else None
+
+    def matches(self, message) -> bool:
+        """Whether ``message`` has media this filter wants downloaded."""
+        if media_kind(message) not in self.kinds:
+            return False
+        if self.senders and (message.sender_id is None or bare_id(message.sender_id) not in self.senders):
+            return False
+        if self.since is not None or self.until is not None:
+            date = message.date
+            if date is None or (self.since is not None and date < self.since) \
+                    or (self.until is not None and date >= self.until):
+                return False
+        file = message.file
+        if file is None:
+            # Link previews without a photo or document
+            return False
+        if self.min_size is not None and (file.size or 0) < self.min_size:
+            return False
+        if self.max_size is not None and file.size is not None and file.size > self.max_size:
+            return False
+        if self.mime_types:
+            mime_type = (file.mime_type or '').lower()
+            if not any(fnmatch.fnmatchcase(mime_type, pattern) for pattern in self.mime_types):
+                return False
+        if self.extensions:
+            name = (file.name or '').lower()
+            ext = os.path.splitext(name)[1] if name else (file.ext or '').lower()
+            if ext not in self.extensions:
+                return False
+        return True
+
+    async def select(self, messages: AsyncIterable) -> AsyncIterator:
+        """Only the messages of ``messages`` that match, for sources that keep nothing else."""
+        async for message in messages:
+            if self.matches(message):
+                yield message
@@ -0,0 +1,172 @@
+import asyncio
+import filecmp
+import hashlib
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from telethon import utils
+from telethon.tl.types import Document, Photo
+
+import metrics
+
+logger = logging.getLogger("downloader.media_store")
+
+# Linux ioctl for copy-on-write clones (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def media_key(media) -> Optional[str]:
+    """Stable id of the file behind a message or media object.
+
+    Document and photo ids identify the file itself, so every forward of it
+    into any channel maps to the same key (the access hash only differs per
+    account, not per copy).
+    """
+    media = getattr(media, 'media', media)
+    document = getattr(media, 'document', None)
+    if isinstance(document, Document):
+        return f'doc-{document.id}'
+    photo = getattr(media, 'photo', None)
+    if isinstance(photo, Photo):
+        return f'photo-{photo.id}'
+    return None
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(src: Path, dest: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, 'rb') as s, open(dest, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        dest.unlink(missing_ok=True)
+        return False
+
+
+def _holds(dest: Path, blob: Path) -> bool:
+    """Whether ``dest`` already is ``blob``: the same inode, or (after a copy fallback) the same bytes."""
+    if os.path.samefile(dest, blob):
+        return True
+    return dest.stat().st_size == blob.stat().st_size and filecmp.cmp(dest, blob, shallow=False)
+
+
+def place(blob: Path, dest: Path) -> None:
+    """Expose ``blob`` at ``dest`` as a hardlink, else a reflink, else a copy."""
+    try:
+        os.link(blob, dest)
+        return
+    except OSError:
+        pass
+    if not _reflink(blob, dest):
+        shutil.copyfile(blob, dest)
+
+
+class MediaStore:
+    """Content-addressed store that downloads each Telegram file once.
+
+    Blobs live under ``root/.blobs/<xx>/<key><ext>`` keyed by ``media_key``;
+    per-channel paths are hardlinks (or reflinks/copies) to them. With
+    ``hash_content`` identical bytes under different ids are also collapsed
+    onto one blob via ``root/.blobs/sha256/<hex>``. ``hits`` and ``misses``
+    (fetches served from the store / downloaded into it) are also exported
+    as ``scraper_cache_lookups_total{cache="media_store"}``.
+    """
+
+    def __init__(self, root: Path, hash_content: bool = False) -> None:
+        self.blob_dir = Path(root) / '.blobs'
+        self.hash_content = hash_content
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def blob_path(self, key: str, ext: str) -> Path:
+        return self.blob_dir / key[-2:] / f'{key}{ext}'
+
+    async def fetch(self, media, dest: Path, download: Callable[[str], Awaitable[Optional[str]]]) -> tuple[Optional[Path], Optional[str]]:
+        """Place the file of ``media`` at ``dest``, downloading it only if no channel has it yet.
+
+        ``download(path)`` must save the file to ``path`` and return the path
+        written. Returns ``(path, sha256)``; the hash is only known when
+        ``hash_content`` is on and this call downloaded or hashed the blob.
+        """
+        key = media_key(media)
+        if key is None:
+            path = await download(str(dest))
+            return (Path(path) if path else None), None
+
+        blob = self.blob_path(key, utils.get_extension(getattr(media, 'media', media)))
+        sha256 = None
+        downloaded = False
+        # Every filesystem call runs on a worker thread; a slow disk must not stall the event loop
+        while not await asyncio.to_thread(blob.exists):
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                sha256 = await self._download_blob(key, blob, download)
+                if not await asyncio.to_thread(blob.exists):
+                    return None, None
+                downloaded = True
+                break
+            # Another channel is downloading the same file right now; if that fails, download it here
+            await inflight
+        if not downloaded:
+            self.hits += 1
+            metrics.cache_lookups.labels('media_store', 'hit').inc()
+
+        return await asyncio.to_thread(self._place_at, blob, Path(dest), key), sha256
+
+    @staticmethod
+    def _place_at(blob: Path, dest: Path, key: str) -> Path:
+        if dest.exists() and not _holds(dest, blob):
+            # A different file already uses this name in the channel folder
+            dest = dest.with_name(f'{dest.stem}_{key}{dest.suffix}')
+        if not dest.exists():
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            place(blob, dest)
+        return dest
+
+    async def _download_blob(self, key: str, blob: Path, download) -> Optional[str]:
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            self.misses += 1
+            metrics.cache_lookups.labels('media_store', 'miss').inc()
+            await asyncio.to_thread(blob.parent.mkdir, parents=True, exist_ok=True)
+            tmp = blob.with_name(f'{blob.stem}.tmp{blob.suffix}')
+            path = await download(str(tmp))
+            if not path:
+                return None
+            await asyncio.to_thread(os.replace, path, blob)
+            sha256 = None
+            if self.hash_content:
+                sha256 = await asyncio.to_thread(_sha256, blob)
+                await asyncio.to_thread(self._dedupe_content, blob, sha256)
+            logger.info("Stored %s (%s)", key, blob)
+            return sha256
+        finally:
+            del self._inflight[key]
+            future.set_result(None)
+
+    def _dedupe_content(self, blob: Path, sha256: str) -> None:
+        by_hash = self.blob_dir / 'sha256' / sha256
+        if by_hash.exists():
+            # Same bytes under another id: point this key at the existing blob
+            tmp = blob.with_name(blob.name + '.link')
+            os.link(by_hash, tmp)
+            os.replace(tmp, blob)
+        else:
+            by_hash.parent.mkdir(parents=True, exist_ok=True)
+            os.link(blob, by_hash)
@@ -0,0 +1,143 @@
+from operator import itemgetter
+from typing import AbstractSet, Callable, Iterable, NamedTuple, Optional, Sequence
+
+from telethon.tl.types import User
+
+from extract_rules import RuleSet
+from senders import SenderCache
+
+DEFAULT_RULESET = RuleSet()
+
+
+class MessageRecord(NamedTuple):
+    """Every field the scrapers export, in a fixed order."""
+    channel_name: Optional[str]
+    channel_id: Optional[int]
+    message_id: int
+    sender_id: Optional[int]
+    sender_username: Optional[str]
+    # username for users, title for channels
+    sender_name: Optional[str]
+    date: Optional[str]
+    text: Optional[str]
+    raw_text: Optional[str]
+    file_name: Optional[str]
+    file_size: Optional[int]
+    # One value per extraction rule, in RuleSet.names order
+    extracted: tuple
+
+
+class _Everything:
+    """Stands in for "every field" (including any rule name) when ``extract`` gets no ``fields``."""
+
+    def __contains__(self, field: str) -> bool:
+        return True
+
+    def isdisjoint(self, other: Iterable[str]) -> bool:
+        return False
+
+
+_ALL_FIELDS = _Everything()
+_FILE_FIELDS = frozenset({'file_name', 'file_size'})
+SENDER_FIELDS = frozenset({'sender_id', 'sender_username', 'sender_name'})
+# Integer-valued fields; every other field (and every rule) holds strings
+INT_FIELDS = frozenset({'channel_id', 'message_id', 'sender_id', 'file_size'})
+
+
+def extract(message, channel_name, channel_id, rules: RuleSet = DEFAULT_RULESET,
+            senders: Optional[SenderCache] = None, fields: Optional[AbstractSet[str]] = None) -> MessageRecord:
+    """Read each (lazily computed) Telethon attribute once and build a record.
+
+    With ``senders`` the sender comes from (and is added to) that cache,
+    which also covers messages whose sender entity wasn't sent along.
+    ``fields`` (``MessageRecord`` fields and rule names) limits which
+    attributes are read at all; the others are left None. ``message.text``
+    re-renders the message as markdown, so skipping it (and the rules,
+    which scan it) is most of the saving for metadata-only crawls.
+    """
+    if fields is None:
+        fields = _ALL_FIELDS
+    scan = bool(rules.names) and not fields.isdisjoint(rules.names)
+    text = message.text if scan or 'text' in fields else None
+    raw_text = message.raw_text if 'raw_text' in fields else None
+    file = message.file if not fields.isdisjoint(_FILE_FIELDS) else None
+    date = message.date if 'date' in fields else None
+
+    sender_id = sender_username = sender_name = None
+    if not fields.isdisjoint(SENDER_FIELDS):
+        sender = message.sender
+        if senders is not None:
+            info = senders.remember(sender) if sender is not None else senders.get(getattr(message, 'sender_id', None))
+            if info is not None:
+                sender_id, sender_username = info.sender_id, info.username
+                sender_name = info.username if info.kind == 'user' else info.name
+        elif sender is not None:
+            sender_id = sender.id
+            sender_username = getattr(sender, 'username', None)
+            sender_name = sender_username if isinstance(sender, User) else getattr(sender, 'title', None)
+
+    return MessageRecord(
+        channel_name,
+        channel_id,
+        message.id,
+        sender_id,
+        sender_username,
+        sender_name,
+        date.isoformat() if date else None,
+        text if 'text' in fields else None,
+        raw_text,
+        file.name if file else None,
+        file.size if file else None,
+        rules.scan(text) if scan else (None,) * len(rules),
+    )
+
+
+def extract_batch(messages: Iterable, channel_name, channel_id, rules: RuleSet = DEFAULT_RULESET,
+                  senders: Optional[SenderCache] = None,
+                  fields: Optional[AbstractSet[str]] = None) -> list[MessageRecord]:
+    """Parse a page of messages at once."""
+    return [extract(message, channel_name, channel_id, rules, senders, fields) for message in messages]
+
+
+def row_getter(fields: Sequence[str], rules: RuleSet = DEFAULT_RULESET) -> Callable[[MessageRecord], tuple]:
+    """Return a function mapping a record to a tuple of ``fields``, in that order.
+
+    A field is either a ``MessageRecord`` field or the name of a rule in ``rules``.
+    """
+    base = MessageRecord._fields[:-1]
+    indexes = [base.index(field) if field in base else len(base) + rules.names.index(field) for field in fields]
+    getter = itemgetter(*indexes)
+    if len(indexes) == 1:
+        return lambda record: (getter(record[:-1] + record.extracted),)
+    return lambda record: getter(record[:-1] + record.extracted)
+
+
+def column_fields(base: dict[str, str], rules: RuleSet) -> dict[str, str]:
+    """Output column -> field mapping for ``rules``.
+
+    Columns of ``base`` that point at a rule missing from ``rules`` are
+    dropped, and a column is appended for every rule ``base`` doesn't cover.
+    """
+    known = set(MessageRecord._fields[:-1]) | set(rules.names)
+    columns = {column: field for column, field in base.items() if field in known}
+    used = set(columns.values())
+    for name in rules.names:
+        if name not in used:
+            columns[name] = name
+    return columns
+
+
+def select_columns(columns: dict[str, str], wanted: Optional[Sequence[str]],
+                   required: Sequence[str] = ()) -> dict[str, str]:
+    """The part of a column -> field mapping a caller asked for, in the mapping's order.
+
+    ``wanted`` None keeps every column. ``required`` columns (e.g. the keys
+    a sink upserts on) are kept either way. Unknown names raise ValueError.
+    """
+    if wanted is None:
+        return dict(columns)
+    unknown = [column for column in wanted if column not in columns]
+    if unknown:
+        raise ValueError(f"Unknown columns {unknown}; available: {list(columns)}")
+    keep = set(wanted) | set(required)
+    return {column: field for column, field in columns.items() if column in keep}
@@ -0,0 +1,290 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+from typing import Callable, Optional, Sequence
+
+logger = logging.getLogger("scraper.metrics")
+
+# Seconds; covers fast parses (~10us) up to slow API calls and downloads
+DEFAULT_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    """Label value escaping required by the Prometheus text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names: Sequence[str], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, "_Metric"] = {}
+
+    def labels(self, *values) -> "_Metric":
+        """Child metric for one combination of label values (cached, so keep a reference in hot paths)."""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = type(self)(self.name, self.help)
+            if isinstance(self, Histogram):
+                child.buckets = self.buckets
+                child.counts = [0] * len(self.buckets)
+        return child
+
+    def _series(self):
+        if self.labelnames:
+            return [(values, child) for values, child in sorted(self._children.items())]
+        return [((), self)]
+
+
+class Counter(_Metric):
+    """Monotonically increasing total."""
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def samples(self):
+        for values, child in self._series():
+            yield self.name, _label_text(self.labelnames, values), child.value
+
+
+class Gauge(_Metric):
+    """Current value; either ``set`` directly or read from ``set_function`` at collection time."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def get(self) -> float:
+        return self._function() if self._function is not None else self.value
+
+    def samples(self):
+        for values, child in self._series():
+            yield self.name, _label_text(self.labelnames, values), child.get()
+
+
+class Histogram(_Metric):
+    """Bucketed distribution with sum and count, e.g. of latencies in seconds."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "_Timer":
+        return _Timer(self)
+
+    def samples(self):
+        for values, child in self._series():
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                yield f'{self.name}_bucket', _label_text(self.labelnames, values, f'le="{bound}"'), cumulative
+            yield f'{self.name}_bucket', _label_text(self.labelnames, values, 'le="+Inf"'), child.count
+            yield f'{self.name}_sum', _label_text(self.labelnames, values), child.sum
+            yield f'{self.name}_count', _label_text(self.labelnames, values), child.count
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    """Holds metrics by name; ``counter``/``gauge``/``histogram`` return the existing one if registered."""
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, _Metric] = {}
+
+    def _get(self, cls, name: str, help: str, labelnames: Sequence[str], **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """Plain-JSON view: counters and gauges as numbers, histograms as count/sum/mean."""
+        data: dict = {'timestamp': time.time()}
+        for metric in self.metrics.values():
+            series = {}
+            for values, child in metric._series():
+                key = ','.join(f'{n}={v}' for n, v in zip(metric.labelnames, values)) or 'value'
+                if isinstance(child, Histogram):
+                    series[key] = {'count': child.count, 'sum': child.sum,
+                                   'mean': child.sum / child.count if child.count else 0.0}
+                elif isinstance(child, Gauge):
+                    series[key] = child.get()
+                else:
+                    series[key] = child.value
+            data[metric.name] = series if metric.labelnames else series.get('value')
+        return data
+
+
+REGISTRY = Registry()
+
+# Shared metrics; modules look them up once at import time
+messages_paged = REGISTRY.counter('scraper_messages_paged_total', 'Messages received from history paging')
+parse_seconds = REGISTRY.histogram('scraper_parse_seconds', 'Time to turn one message into a row')
+rows_persisted = REGISTRY.counter('scraper_rows_persisted_total', 'Rows handed to a sink')
+persist_batch_seconds = REGISTRY.histogram('scraper_persist_batch_seconds', 'Time to write one batch of rows')
+queue_depth = REGISTRY.gauge('scraper_queue_depth', 'Items waiting in a pipeline queue', ['queue'])
+downloads = REGISTRY.counter('downloader_files_total', 'Finished downloads', ['result'])
+download_seconds = REGISTRY.histogram('downloader_file_seconds', 'Wall time per downloaded file')
+downloaded_bytes = REGISTRY.counter('downloader_bytes_total', 'Bytes downloaded')
+api_seconds = REGISTRY.histogram('telegram_api_request_seconds', 'Latency of Telegram API calls', ['method'])
+# Whole file transfers through the limiter; kept out of api_seconds so they don't skew request latency
+transfer_seconds = REGISTRY.histogram('telegram_transfer_seconds', 'Duration of file transfers', ['method'])
+flood_waits = REGISTRY.counter('telegram_flood_waits_total', 'FloodWait errors received')
+flood_wait_seconds = REGISTRY.counter('telegram_flood_wait_seconds_total', 'Seconds of FloodWait imposed')
+cache_lookups = REGISTRY.counter('scraper_cache_lookups_total', 'Lookups in the media, entity and sender caches',
+                                 ['cache', 'result'])
+limiter_rate = REGISTRY.gauge('telegram_limiter_rate', 'Current request rate allowed by the limiter (req/s)', ['session'])
+
+
+class MetricsReporter:
+    """Publishes ``registry`` while a run is in progress.
+
+    With ``port`` a minimal HTTP endpoint serves the Prometheus text format
+    on ``/metrics`` (bound to localhost); with ``json_path`` a snapshot is
+    written there every ``interval`` seconds (atomically replaced) and once
+    more on exit. ``from_env()`` reads ``TELEGRAM_METRICS_PORT`` and
+    ``TELEGRAM_METRICS_JSON``.
+    """
+
+    def __init__(self, port: Optional[int] = None, json_path: Optional[str] = None, interval: float = 15.0,
+                 host: str = '127.0.0.1', registry: Registry = REGISTRY) -> None:
+        self.port = port
+        self.json_path = json_path
+        self.interval = interval
+        self.host = host
+        self.registry = registry
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls) -> "MetricsReporter":
+        port = os.getenv("TELEGRAM_METRICS_PORT")
+        return cls(port=int(port) if port else None, json_path=os.getenv("TELEGRAM_METRICS_JSON") or None,
+                   interval=float(os.getenv("TELEGRAM_METRICS_INTERVAL", "15")))
+
+    async def start(self) -> None:
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+        if self.json_path:
+            self._task = asyncio.create_task(self._write_periodically(), name='metrics-json')
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self.write_json()
+
+    async def __aenter__(self) -> "MetricsReporter":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.stop()
+
+    def write_json(self) -> None:
+        tmp = f'{self.json_path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.registry.snapshot(), f, indent=1)
+        os.replace(tmp, self.json_path)
+
+    async def _write_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            # Small file; not worth a trip to the writer thread
+            self.write_json()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            path = request.split()[1] if len(request.split()) > 1 else b'/'
+            if path == b'/metrics':
+                body = self.registry.render_prometheus().encode()
+                status, content_type = '200 OK', 'text/plain; version=0.0.4'
+            else:
+                body, status, content_type = b'not found\n', '404 Not Found', 'text/plain'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
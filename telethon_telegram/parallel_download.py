@@ -0,0 +1,201 @@
+import asyncio
+import inspect
+import logging
+import math
+import os
+import time
+from typing import Callable, Optional
+
+from telethon import utils
+from telethon.network import MTProtoSender
+from telethon.tl.alltlobjects import LAYER
+from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
+from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.types import Document
+from telethon.tl.types.upload import FileCdnRedirect
+
+import metrics
+
+logger = logging.getLogger("downloader.parallel")
+
+# GetFileRequest needs limit to divide 1 MiB and offset to be a multiple of limit
+PART_SIZE = 512 * 1024
+# Below this size a single stream is just as fast as opening extra connections
+MIN_PARALLEL_SIZE = 20 * 1024 * 1024
+DEFAULT_CONNECTIONS = int(os.getenv("TELEGRAM_DOWNLOAD_CONNECTIONS", "4"))
+BITMAP_FLUSH_INTERVAL = 2.0
+
+
+class CdnRedirectError(Exception):
+    """The file lives on a CDN DC; fall back to Telethon's own downloader."""
+
+
+def _pwrite(fd: int, data: bytes, offset: int) -> None:
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:
+        # No pwrite on Windows; seek+write is still atomic between awaits
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+class _PartBitmap:
+    """One bit per part, persisted next to the file so a crashed download can resume."""
+
+    def __init__(self, path: str, part_count: int) -> None:
+        self.path = path
+        self.part_count = part_count
+        self.bits = bytearray((part_count + 7) // 8)
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if len(data) == len(self.bits):
+            self.bits[:] = data
+
+    def save(self, bits: Optional[bytes] = None) -> None:
+        """Write ``bits`` (a snapshot taken on the event loop), or the current bits."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.bits if bits is None else bits)
+        os.replace(tmp, self.path)
+
+    def is_set(self, index: int) -> bool:
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def set(self, index: int) -> None:
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def missing(self) -> list[int]:
+        return [i for i in range(self.part_count) if not self.is_set(i)]
+
+
+async def _create_sender(client, dc_id: int) -> MTProtoSender:
+    dc = await client._get_dc(dc_id)
+    same_dc = dc_id == client.session.dc_id
+    sender = MTProtoSender(client.session.auth_key if same_dc else None, loggers=client._log)
+    await sender.connect(client._connection(
+        dc.ip_address, dc.port, dc.id, loggers=client._log, proxy=client._proxy,
+    ))
+    if not same_dc:
+        auth = await client(ExportAuthorizationRequest(dc_id))
+        client._init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+        await sender.send(InvokeWithLayerRequest(LAYER, client._init_request))
+    return sender
+
+
+async def _report(progress_callback: Optional[Callable], current: int, total: int) -> None:
+    if progress_callback is None:
+        return
+    result = progress_callback(current, total)
+    if inspect.isawaitable(result):
+        await result
+
+
+async def download_parallel(client, document, file_path: str, connections: int = DEFAULT_CONNECTIONS,
+                            progress_callback: Optional[Callable] = None) -> str:
+    """Fetch ``document`` in parts over several connections, writing each part in place.
+
+    Data goes to ``<file_path>.part`` (preallocated to the full size) and
+    finished parts are tracked in ``<file_path>.parts``; both are reused if
+    the download is restarted, and the file is renamed into place once
+    every part has arrived.
+    """
+    size = document.size
+    dc_id, location = utils.get_input_location(document)
+    part_count = math.ceil(size / PART_SIZE)
+    tmp_path = file_path + ".part"
+    bitmap = _PartBitmap(file_path + ".parts", part_count)
+    if os.path.exists(tmp_path) and os.path.getsize(tmp_path) == size:
+        bitmap.load()
+
+    pending = bitmap.missing()
+    received = (part_count - len(pending)) * PART_SIZE
+    if pending:
+        logger.info("Downloading %s in %d parts over %d connections (%d already done)",
+                    file_path, part_count, connections, part_count - len(pending))
+
+    fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0))
+    senders: list[MTProtoSender] = []
+    last_flush = time.monotonic()
+    flush: Optional[asyncio.Future] = None
+
+    def checkpoint(bits: bytes) -> None:
+        # Only mark parts done once their bytes are on disk
+        os.fsync(fd)
+        bitmap.save(bits)
+
+    async def worker(sender: MTProtoSender) -> None:
+        nonlocal received, last_flush, flush
+        while pending:
+            index = pending.pop()
+            result = await client._call(sender, GetFileRequest(location, offset=index * PART_SIZE, limit=PART_SIZE))
+            if isinstance(result, FileCdnRedirect):
+                raise CdnRedirectError(file_path)
+            _pwrite(fd, result.bytes, index * PART_SIZE)
+            bitmap.set(index)
+            received += len(result.bytes)
+            metrics.downloaded_bytes.inc(len(result.bytes))
+            await _report(progress_callback, min(received, size), size)
+            if time.monotonic() - last_flush >= BITMAP_FLUSH_INTERVAL and (flush is None or flush.done()):
+                # On a thread, so other downloads keep going during the fsync; every part in the
+                # snapshot was written before it was taken
+                flush = asyncio.ensure_future(asyncio.to_thread(checkpoint, bytes(bitmap.bits)))
+                last_flush = time.monotonic()
+
+    try:
+        os.ftruncate(fd, size)
+        pending.reverse()  # pop() from the end -> fetch parts in file order
+        if pending:
+            senders = await asyncio.gather(*(_create_sender(client, dc_id) for _ in range(max(1, connections))))
+            tasks = [asyncio.create_task(worker(sender)) for sender in senders]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Don't leave siblings writing to a descriptor we are about to close
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        await asyncio.to_thread(os.fsync, fd)
+    finally:
+        if flush is not None:
+            await asyncio.gather(flush, return_exceptions=True)
+        if bitmap.missing():
+            await asyncio.to_thread(checkpoint, bytes(bitmap.bits))
+        os.close(fd)
+        await asyncio.gather(*(sender.disconnect() for sender in senders), return_exceptions=True)
+
+    os.replace(tmp_path, file_path)
+    try:
+        os.remove(bitmap.path)
+    except FileNotFoundError:
+        pass
+    return file_path
+
+
+async def download_media(client, media, file_path: str, connections: int = DEFAULT_CONNECTIONS,
+                         progress_callback: Optional[Callable] = None) -> Optional[str]:
+    """Drop-in for ``client.download_media(media, file=...)`` that splits large documents across connections.
+
+    ``media`` may be a ``Message`` or its ``.media``.
+    """
+    document = getattr(media, "document", None)
+    if not isinstance(document, Document) or document.size < MIN_PARALLEL_SIZE or connections <= 1:
+        return await _download_single(client, media, file_path, progress_callback)
+    try:
+        return await download_parallel(client, document, file_path, connections, progress_callback)
+    except CdnRedirectError:
+        logger.info("%s is served from a CDN, using a single stream", file_path)
+        return await _download_single(client, media, file_path, progress_callback)
+
+
+async def _download_single(client, media, file_path: str, progress_callback: Optional[Callable]) -> Optional[str]:
+    path = await client.download_media(media, file=file_path, progress_callback=progress_callback)
+    if isinstance(path, str):
+        metrics.downloaded_bytes.inc(os.path.getsize(path))
+    return path
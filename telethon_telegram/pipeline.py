@@ -0,0 +1,222 @@
+import asyncio
+import itertools
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, Awaitable, Callable, Optional, Sequence
+
+import metrics
+
+logger = logging.getLogger("scraper.pipeline")
+
+_DONE = object()
+
+# Messages handed to prepare() at once: one history page
+PREPARE_BATCH = 100
+
+
+@dataclass
+class PipelineStats:
+    messages: int = 0
+    rows: int = 0
+    downloads: int = 0
+    failed_downloads: int = 0
+
+
+class MessagePipeline:
+    """Pager -> parser -> batched persistence -> download pool, joined by bounded queues.
+
+    ``parse(message)`` returns ``(row, job)``; ``job`` is ``None`` for
+    messages without media, otherwise whatever ``download(job)`` needs
+    (keep it small, e.g. the media object rather than the whole message).
+    Rows are written to ``sink`` in batches of up to ``batch_size`` and a
+    batch's download jobs are queued only after ``sink.checkpoint()``, so a
+    file never lands on disk before the row describing it. Each queue is
+    bounded, so a stalled stage eventually pauses the pager instead of
+    buffering history in memory; size ``download_queue_size`` generously
+    so paging only waits when downloads are far behind.
+
+    ``on_persisted(count)`` runs after each batch with the number of
+    messages persisted so far, and once more with ``None`` when the source
+    is exhausted, e.g. to advance resume state.
+
+    ``prepare(messages)``, if given, is awaited with up to a page of paged
+    messages before they are parsed, e.g. to look up in one request what
+    ``parse`` would otherwise miss.
+
+    With ``flush_interval`` (seconds) the pipeline micro-batches for
+    sources that trickle in, such as a live listener: a batch closes after
+    ``batch_size`` rows or ``flush_interval`` after its first row, and is
+    checkpointed right away, so rows reach disk within that interval.
+
+    With ``download_order(job)`` (e.g. a ``DownloadOrder.key`` of the job's
+    size) queued downloads are started smallest key first instead of in
+    paging order; the queue stays bounded by ``download_queue_size``.
+
+    ``pending_jobs`` are download jobs left unfinished by an earlier run;
+    they are queued ahead of the jobs of newly persisted rows.
+    """
+
+    def __init__(self, source: AsyncIterable, parse: Callable[[Any], tuple[tuple, Any]], sink,
+                 download: Optional[Callable[[Any], Awaitable]] = None, download_workers: int = 4,
+                 batch_size: int = 500, parse_queue_size: int = 200, persist_queue_size: int = 1000,
+                 download_queue_size: int = 1000,
+                 on_persisted: Optional[Callable[[Optional[int]], None]] = None,
+                 flush_interval: Optional[float] = None,
+                 prepare: Optional[Callable[[list], Awaitable]] = None,
+                 download_order: Optional[Callable[[Any], tuple]] = None,
+                 pending_jobs: Sequence = ()) -> None:
+        self.source = source
+        self.parse = parse
+        self.sink = sink
+        self.download = download
+        self.download_workers = download_workers if download is not None else 0
+        self.batch_size = batch_size
+        self.on_persisted = on_persisted
+        self.flush_interval = flush_interval
+        self.prepare = prepare
+        self.pending_jobs = list(pending_jobs) if self.download_workers else []
+        self.stats = PipelineStats()
+        self._parse_queue: asyncio.Queue = asyncio.Queue(parse_queue_size)
+        self._persist_queue: asyncio.Queue = asyncio.Queue(persist_queue_size)
+        self.download_order = download_order
+        # Holds (key, arrival, job) when ordered; _DONE sorts after every job
+        self._arrivals = itertools.count()
+        self._download_queue: asyncio.Queue = (
+            asyncio.PriorityQueue(download_queue_size) if download_order is not None
+            else asyncio.Queue(download_queue_size))
+        metrics.queue_depth.labels('parse').set_function(self._parse_queue.qsize)
+        metrics.queue_depth.labels('persist').set_function(self._persist_queue.qsize)
+        metrics.queue_depth.labels('download').set_function(self._download_queue.qsize)
+
+    async def run(self) -> PipelineStats:
+        """Run every stage to completion; the first stage to fail cancels the rest."""
+        tasks = [
+            asyncio.create_task(self._page(), name='pipeline-pager'),
+            asyncio.create_task(self._parse_stage(), name='pipeline-parser'),
+            asyncio.create_task(self._persist_stage(), name='pipeline-persist'),
+        ]
+        tasks += [asyncio.create_task(self._download_stage(), name=f'pipeline-download-{i}')
+                  for i in range(self.download_workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Pipeline finished: %d messages, %d rows, %d downloads (%d failed)",
+                    self.stats.messages, self.stats.rows, self.stats.downloads, self.stats.failed_downloads)
+        return self.stats
+
+    async def _page(self) -> None:
+        async for message in self.source:
+            self.stats.messages += 1
+            metrics.messages_paged.inc()
+            await self._parse_queue.put(message)
+        await self._parse_queue.put(_DONE)
+
+    async def _parse_stage(self) -> None:
+        observe = metrics.parse_seconds.observe
+        done = False
+        while not done:
+            messages = [await self._parse_queue.get()]
+            if self.prepare is not None:
+                # The pager queues a whole page without yielding, so this is usually one page
+                while len(messages) < PREPARE_BATCH and not self._parse_queue.empty():
+                    messages.append(self._parse_queue.get_nowait())
+            if messages[-1] is _DONE:
+                messages.pop()
+                done = True
+            if self.prepare is not None and messages:
+                await self.prepare(messages)
+            for message in messages:
+                started = time.perf_counter()
+                parsed = self.parse(message)
+                observe(time.perf_counter() - started)
+                await self._persist_queue.put(parsed)
+        await self._persist_queue.put(_DONE)
+
+    async def _persist_stage(self) -> None:
+        for job in self.pending_jobs:
+            await self._queue_download(job)
+        persisted = 0
+        done = False
+        while not done:
+            batch = await self._next_batch()
+            if batch[-1] is _DONE:
+                batch.pop()
+                done = True
+
+            jobs = []
+            started = time.perf_counter()
+            for row, job in batch:
+                self.sink.write(row)
+                if job is not None and self.download_workers:
+                    jobs.append(job)
+            metrics.persist_batch_seconds.observe(time.perf_counter() - started)
+            metrics.rows_persisted.inc(len(batch))
+            persisted += len(batch)
+            self.stats.rows += len(batch)
+            if self.on_persisted is not None and batch:
+                self.on_persisted(persisted)
+
+            if jobs or (self.flush_interval is not None and batch):
+                # Rows reach disk before the files they describe
+                if hasattr(self.sink, 'acheckpoint'):
+                    await self.sink.acheckpoint()
+                else:
+                    self.sink.checkpoint()
+                for job in jobs:
+                    await self._queue_download(job)
+
+        if self.on_persisted is not None:
+            self.on_persisted(None)
+        for worker in range(self.download_workers):
+            await self._queue_download(_DONE, worker)
+
+    async def _queue_download(self, job, worker: int = 0) -> None:
+        if self.download_order is None:
+            await self._download_queue.put(job)
+        elif job is _DONE:
+            await self._download_queue.put(((math.inf,), worker, job))
+        else:
+            # The arrival count breaks ties, so jobs themselves are never compared
+            await self._download_queue.put((self.download_order(job), next(self._arrivals), job))
+
+    async def _next_batch(self) -> list:
+        batch = [await self._persist_queue.get()]
+        if self.flush_interval is None:
+            # Take whatever else is already parsed, up to one batch
+            while len(batch) < self.batch_size and not self._persist_queue.empty():
+                batch.append(self._persist_queue.get_nowait())
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not _DONE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._persist_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _download_stage(self) -> None:
+        ok, failed = metrics.downloads.labels('ok'), metrics.downloads.labels('failed')
+        while True:
+            job = await self._download_queue.get()
+            if self.download_order is not None:
+                job = job[-1]
+            if job is _DONE:
+                return
+            started = time.perf_counter()
+            try:
+                await self.download(job)
+                self.stats.downloads += 1
+                ok.inc()
+            except Exception as e:
+                self.stats.failed_downloads += 1
+                failed.inc()
+                logger.error("Download failed for %r: %s", job, e)
+            metrics.download_seconds.observe(time.perf_counter() - started)
@@ -1,43 +1,60 @@
 import os
 import asyncio
-import re
 import polars as pl
 import logging
 import crypt
 
 from decouple import config
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, utils
 from pprint import pprint
 
+from entity_cache import EntityCache
+from extract_rules import load_rules
+from message_fields import extract
+from sinks import ParquetSink
+
 logger = logging.getLogger(__name__)
 
 api_id = config('TELEGRAM_API_ID')
 api_hash = config('TELEGRAM_APP_API_HASH')
 
 client = TelegramClient('telegram_session_tarnybinis', api_id=api_id, api_hash=api_hash)
+# Channel ids/access hashes/titles seen before, so the target is found without listing every dialog
+entity_cache = EntityCache.for_session('telegram_session_tarnybinis')
 
 channels_count = []
 download_folder = r'telegram_download'
 
 target_channel = config('CHANNEL_NAME')
 messages_df = []
+# 'parquet' streams rows into telegram_download/telegram_messages_parquet instead of one big CSV
+export_format = config('EXPORT_FORMAT', default='csv')
 
-pass_regex = r'```\s*([^\s`]+)\s*```'
+rules = load_rules(config('EXTRACT_RULES', default=''))
+# Rules other than pass_value get their own columns at the end
+PARQUET_COLUMNS = ('chanel_name', 'channel_id', 'sender', 'sender s', 'messages', 'pass_match', 'date', 'file', 'file_name') \
+    + tuple(name for name in rules.names if name != 'pass_value')
 
 @events.register(events.NewMessage('hello'))
 async def main():
 
     channel_index = 1
+    sink = None
+    if export_format == 'parquet':
+        sink = ParquetSink(os.path.join(download_folder, 'telegram_messages_parquet'), PARQUET_COLUMNS,
+                           schema={'channel_id': pl.Int64, 'file': pl.Int64})
 
-    async with client:
-        me = await client.get_me()
+    try:
+        async with client:
+            me = await client.get_me()
 
-        logger.info(f'Successfully connected as {me.first_name} {me.last_name}')
+            logger.info(f'Successfully connected as {me.first_name} {me.last_name}')
 
-        async for dialog in client.iter_dialogs():
+            # Resolved from the local cache when the channel was seen before, instead of walking every dialog
+            entity = await entity_cache.resolve(client, target_channel)
 
-            chanel_name = dialog.name
-            channel_id = dialog.id
+            chanel_name = entity.title
+            channel_id = utils.get_peer_id(entity)
             logger.info(f'Successfully connected to channel name {chanel_name} channel ID {channel_id}')
             # channels_count.append({
             #     'channel': channel_index,
@@ -45,25 +62,37 @@ async def main():
             # })
 
             logger.info(f'Started logging massages')
-            if dialog.title == target_channel:
-                async for message in client.iter_messages(dialog.entity, limit=1_000):
-                    pass_match = re.search(pass_regex, message.text) if message.text else None
-
-                    messages_df.append({
-                        'chanel_name': chanel_name,
-                        'channel_id': channel_id,
-                        'sender': message.sender.username if message.sender else None,
-                        'sender s': message.sender.usernames if message.sender else None,
-                        'messages': message.text,
-                        'pass_match': pass_match.group(1) if pass_match else None,
-                        'date': message.date.isoformat(),
-                        'file': message.file.size if message.file else None,
-                        'file_name': message.file.name if message.file else None,
-                    })
-
-        print(pl.DataFrame(messages_df).write_csv('telegram_download/telegram_messages_all.csv'))
-
-        # pl.DataFrame(messages_df).write_csv(download_folder + '/telegram_messages_test.csv')
+            async for message in client.iter_messages(entity, limit=1_000):
+                record = extract(message, chanel_name, channel_id, rules)
+                sender = message.sender
+                extracted = dict(zip(rules.names, record.extracted))
+
+                row = {
+                    'chanel_name': chanel_name,
+                    'channel_id': channel_id,
+                    'sender': record.sender_username,
+                    # Joined: CSV has no nested types, and a string keeps every Parquet file's schema the same
+                    'sender s': ','.join(u.username for u in getattr(sender, 'usernames', None) or []) or None,
+                    'messages': record.text,
+                    'pass_match': extracted.pop('pass_value', None),
+                    'date': record.date,
+                    'file': record.file_size,
+                    'file_name': record.file_name,
+                    **extracted,
+                }
+                if sink is not None:
+                    sink.write(tuple(row.values()))
+                else:
+                    messages_df.append(row)
+
+            if sink is None:
+                print(pl.DataFrame(messages_df).write_csv('telegram_download/telegram_messages_all.csv'))
+
+            # pl.DataFrame(messages_df).write_csv(download_folder + '/telegram_messages_test.csv')
+    finally:
+        # Rows buffered so far are written even if scraping failed
+        if sink is not None:
+            sink.close()
 
 
 if __name__ == '__main__':
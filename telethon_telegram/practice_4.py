@@ -1,59 +1,85 @@
 import logging
 import os
 import asyncio
-import re
 
 import polars as pl
 
 from decouple import config
-from telethon import TelegramClient, events
-from typing import List, Dict
+from telethon import TelegramClient, events, utils
+from typing import List, Dict, Optional, Sequence, Union
+
+from entity_cache import EntityCache
+from extract_rules import RuleSet, load_rules
+from io_writer import BackgroundWriter, ThreadedSink
+from message_fields import DEFAULT_RULESET, INT_FIELDS, column_fields, extract, row_getter, select_columns
+from sinks import ParquetSink
 
 logger = logging.getLogger(__name__)
 
 class TelegramScrapper:
 
-    def __init__(self, api_id: int, api_hash: str, session_name: str, target_channel: str, download_folder: str) -> None:
+    # Output column -> MessageRecord field or extraction rule name
+    COLUMN_FIELDS = {
+        'channel_name': 'channel_name', 'channel_id': 'channel_id', 'message_id': 'message_id',
+        'sender': 'sender_username', 'message_text': 'text', 'message_raw_text': 'raw_text',
+        'message_date': 'date', 'file_name': 'file_name', 'file_size': 'file_size', 'pass_match': 'pass_value',
+    }
+
+    def __init__(self, api_id: int, api_hash: str, session_name: str, target_channel: str, download_folder: str, export_format: str = 'csv', rules: Optional[RuleSet] = None, columns: Optional[Sequence[str]] = None) -> None:
         self.client = TelegramClient(session=session_name, api_id=api_id, api_hash=api_hash)
+        # Finds target_channel without walking every dialog once it has been seen
+        self.entity_cache = EntityCache.for_session(session_name)
         self.target_channel = target_channel
         self.download_folder = download_folder
-        self.pass_regex = r'```\s*([^\s`]+)\s*```'
+        self.rules = rules or DEFAULT_RULESET
+        # columns=[...] keeps only those; the Parquet layout partitions on channel_id and message_date
+        self.column_fields = select_columns(column_fields(self.COLUMN_FIELDS, self.rules), columns,
+                                            required=('channel_id', 'message_id', 'message_date'))
+        self.columns = tuple(self.column_fields)
+        self._fields = frozenset(self.column_fields.values())
+        self._to_row = row_getter(list(self.column_fields.values()), self.rules)
         self.messages = []
+        # 'csv' collects rows in memory and writes one file, 'parquet' streams them into a partitioned dataset
+        self.export_format = export_format
 
-    def _parse_message(self, message, channel_name, channel_id) -> Dict[str, str]:
-        pass_match = re.search(self.pass_regex, message.text) if message.text else None
-
-        return {
-            'channel_name': channel_name,
-            'channel_id': channel_id,
-            'message_id': message.id,
-            'sender': message.sender.username if message.sender else None,
-            'message_text': message.text,
-            'message_raw_text': message.raw_text,
-            'message_date': message.date.isoformat() if message.date else None,
-            'file_name': message.file.name if message.file else None,
-            'file_size': message.file.size if message.file else None,
-            'pass_match': pass_match.group(1) if pass_match else None,
-        }
-
-    async def fetch_messages (self, limit: int=100) -> None:
+    def _parse_message(self, message, channel_name, channel_id) -> tuple:
+        return self._to_row(extract(message, channel_name, channel_id, self.rules, fields=self._fields))
+
+    async def fetch_messages (self, limit: int=100, sink: Optional[Union[ParquetSink, ThreadedSink]] = None) -> None:
         async with self.client:
             me = await self.client.get_me()
 
-            async for dialog in self.client.iter_dialogs():
-                if dialog.title == self.target_channel:
+            entity = await self.entity_cache.resolve(self.client, self.target_channel)
+            # Same name/id as the matching dialog would give (dialog ids are marked peer ids)
+            channel_name, channel_id = entity.title, utils.get_peer_id(entity)
 
-                    async for message in self.client.iter_messages(dialog.entity, limit=limit):
-                        parse_data = self._parse_message(message, dialog.name, dialog.id)
-                        self.messages.append(parse_data)
-                    return
+            async for message in self.client.iter_messages(entity, limit=limit):
+                parse_data = self._parse_message(message, channel_name, channel_id)
+                if sink is not None:
+                    sink.write(parse_data)
+                else:
+                    self.messages.append(parse_data)
 
 
     def save_to_csv(self, file_name: str = 'telegram_messages_test.csv'):
         save_path = os.path.join(self.download_folder, file_name)
-        pl.DataFrame(self.messages).write_csv(save_path)
+        pl.DataFrame(self.messages, schema=self.columns, orient='row').write_csv(save_path)
+
+    def open_parquet_sink(self, folder_name: str = 'telegram_messages_parquet', row_group_size: int = 100_000,
+                          compression: str = 'zstd') -> ParquetSink:
+        root = os.path.join(self.download_folder, folder_name)
+        return ParquetSink(
+            root, self.columns, channel_column='channel_id', date_column='message_date',
+            row_group_size=row_group_size, compression=compression,
+            schema={column: pl.Int64 for column, field in self.column_fields.items() if field in INT_FIELDS},
+        )
 
     async def run(self):
+        if self.export_format == 'parquet':
+            # Parquet encoding and file writes run on a background thread
+            with BackgroundWriter() as writer, ThreadedSink(writer, self.open_parquet_sink) as sink:
+                await self.fetch_messages(limit=100, sink=sink)
+            return
         await self.fetch_messages(limit=100)
         self.save_to_csv()
 
@@ -73,6 +99,9 @@ if __name__ == '__main__':
         session_name=session_name,
         target_channel=target_channel,
         download_folder='telegram_download',
+        export_format=config('EXPORT_FORMAT', default='csv'),
+        rules=load_rules(config('EXTRACT_RULES', default='')),
+        columns=config('COLUMNS', default='', cast=lambda v: [c.strip() for c in v.split(',') if c.strip()]) or None,
     )
 
     asyncio.run(scraper.run())
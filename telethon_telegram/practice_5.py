@@ -1,14 +1,27 @@
 import os
 import asyncio
-import re
-import csv
 import logging
-import time
+import signal
 from telethon import TelegramClient
-from telethon.tl.types import User, Channel
 from telethon.errors import FloodWaitError, ChannelPrivateError
 from decouple import config
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence
+
+from download_state import STATUS_QUEUED, STATUS_SKIPPED, SQLiteDownloadState
+from entity_cache import EntityCache
+from incremental import DeferredWatermarks, iter_incremental
+from live import iter_live
+from io_writer import BackgroundWriter, LoopLagMonitor, ThreadedSink
+from parallel_download import download_media
+from pipeline import MessagePipeline
+from progress import ProgressTracker
+from rate_limit import AdaptiveRateLimiter
+from sharding import ShardCoordinator
+from extract_rules import RuleSet, load_rules
+from message_fields import DEFAULT_RULESET, SENDER_FIELDS, column_fields, extract, row_getter, select_columns
+from metrics import MetricsReporter
+from senders import SENDERS
+from sinks import CsvSink, DuckDBSink
 
 
 # --- Logging setup is unchanged ---
@@ -24,143 +37,210 @@ logging.basicConfig(
 
 class TelegramScraper:
 
-    def __init__(self, api_id: int, api_hash: str, target_channel: str, telegram_session: str, download_folder: str = 'telegram_download', csv_file: str = 'telegram_messages.csv') -> None:
+    def __init__(self, api_id: int, api_hash: str, target_channel: str, telegram_session: str, download_folder: str = 'telegram_download', csv_file: str = 'telegram_messages.csv', state_db: str = 'telegram_state.db', csv_flush_rows: int = 500, csv_fsync: bool = False, output: str = 'csv', duckdb_file: str = 'telegram_messages.duckdb', rules: Optional[RuleSet] = None, download_workers: int = 4, columns: Optional[Sequence[str]] = None) -> None:
         self.telegram_client = TelegramClient(
             session=telegram_session,
             api_id=api_id,
             api_hash=api_hash,
+            flood_sleep_threshold=0,  # flood waits are handled by self.limiter
         )
+        self.limiter = AdaptiveRateLimiter(session=telegram_session)
+        # Channel id/access hash/title from earlier runs, so startup needs no get_entity round-trip
+        self.entity_cache = EntityCache.for_session(telegram_session)
         self.target_channel = target_channel
         self.csv_file = csv_file
+        self.csv_flush_rows = csv_flush_rows
+        self.csv_fsync = csv_fsync
+        # 'csv' appends to csv_file, 'duckdb' upserts into the messages table of duckdb_file
+        self.output = output
+        self.duckdb_file = duckdb_file
+        self.sink = None
+        self.state = None
         self.download_folder = download_folder
-        self.pass_regex = r'```\s*([^\s`]+)\s*```'
-
-        # CHANGED: Define the CSV headers in one place
-        self.csv_fieldnames = [
-            'channel_name', 'channel_id', 'sender_name', 'sender_id', 'date',
-            'message_id', 'message', 'raw_text', 'file_name', 'file_size', 'pass_value'
-        ]
+        # Files downloaded at once while paging continues
+        self.download_workers = download_workers
+        # One dashboard for all concurrent downloads, redrawn twice a second
+        self.progress = ProgressTracker()
+        self.rules = rules or DEFAULT_RULESET
+        # Remembers how far each channel has been scanned, so reruns only page new messages
+        self.state_db = state_db
+
+        # CHANGED: Define the CSV headers in one place, mapped to MessageRecord fields / rule names
+        # columns=[...] keeps only those (plus the channel_id/message_id upsert key); the rest are never computed
+        self.csv_columns = select_columns(column_fields({
+            'channel_name': 'channel_name', 'channel_id': 'channel_id', 'sender_name': 'sender_name',
+            'sender_id': 'sender_id', 'date': 'date', 'message_id': 'message_id', 'message': 'text',
+            'raw_text': 'raw_text', 'file_name': 'file_name', 'file_size': 'file_size', 'pass_value': 'pass_value',
+        }, self.rules), columns, required=('channel_id', 'message_id'))
+        self.csv_fieldnames = list(self.csv_columns)
+        self._fields = frozenset(self.csv_columns.values())
+        self._to_row = row_getter(list(self.csv_columns.values()), self.rules)
 
         os.makedirs(self.download_folder, exist_ok=True)
         logging.info(f'Download folder set to {self.download_folder}')
 
-        # CHANGED: Create the CSV and write headers if it doesn't exist
-        self._init_csv()
+    def _open_sink(self, on_flush):
+        if self.output == 'duckdb':
+            create_sql = """
+                CREATE TABLE IF NOT EXISTS messages (
+                    channel_name VARCHAR, channel_id BIGINT, sender_name VARCHAR, sender_id BIGINT,
+                    date TIMESTAMPTZ, message_id BIGINT, message VARCHAR, raw_text VARCHAR,
+                    file_name VARCHAR, file_size BIGINT, pass_value VARCHAR,
+                    PRIMARY KEY (channel_id, message_id)
+                )
+            """
+            return DuckDBSink(self.duckdb_file, 'messages', self.csv_fieldnames, create_sql, on_flush=on_flush)
+        return CsvSink(
+            self.csv_file, self.csv_fieldnames,
+            max_rows=self.csv_flush_rows, fsync=self.csv_fsync, on_flush=on_flush,
+        )
 
-    def _init_csv(self):
-        """Creates the CSV file with headers if it doesn't exist."""
-        try:
-            # Check if file is empty
-            file_exists = os.path.isfile(self.csv_file) and os.path.getsize(self.csv_file) > 0
-            if not file_exists:
-                with open(self.csv_file, mode='w', newline='', encoding='utf-8') as f:
-                    writer = csv.DictWriter(f, fieldnames=self.csv_fieldnames)
-                    writer.writeheader()
-                logging.info(f"Initialized CSV file with headers: {self.csv_file}")
-        except Exception as e:
-            logging.error(f"Failed to initialize CSV file: {e}")
-            print(f"ERROR: Failed to initialize CSV file: {e}")
+    def _parse_messages(self, message, channel_name, channel_id) -> tuple:
+        """Helper function to parse a single message object into a row in csv_fieldnames order."""
+        return self._to_row(extract(message, channel_name, channel_id, self.rules, SENDERS, self._fields))
+
+    def _job(self, message, channel_id) -> tuple:
+        """(channel id, message id, file name, media, size): what _download needs for one file."""
+        return channel_id, message.id, message.file.name or f"file_{message.id}", message.media, message.file.size
+
+    def _parse_with_job(self, message, channel_name, channel_id) -> tuple:
+        """Row for the sink plus a download job (see _job), or None without a file."""
+        row = self._parse_messages(message, channel_name, channel_id)
+        job = None
+        if self.download_workers and message.file:
+            job = self._job(message, channel_id)
+            # The watermark moves past this message before the file arrives: keep it queued until it does
+            self.state.record(channel_id, message.id, size=message.file.size, status=STATUS_QUEUED)
+        return row, job
+
+    async def _requeued_jobs(self, entity, writer: BackgroundWriter) -> list:
+        """Jobs for files an earlier run queued but never downloaded."""
+        queued = await writer.run(self.state.queued_ids, entity.id)
+        if not queued:
+            return []
+        logging.info(f"Re-queuing {len(queued)} unfinished downloads")
+        jobs = []
+        # Fetched again: the media's file references may have expired since
+        messages = await self.limiter.call(self.telegram_client.get_messages, entity, ids=queued)
+        for message_id, message in zip(queued, messages):
+            if message and message.file:
+                jobs.append(self._job(message, entity.id))
+            else:
+                # Deleted since: stop fetching it on every run
+                self.state.record(entity.id, message_id, status=STATUS_SKIPPED)
+        return jobs
 
-    def _append_to_csv(self, message_data: Dict):
-        """Appends a single message's data to the CSV file."""
+    async def _download(self, job) -> None:
+        channel_id, message_id, file_name, media, size = job
         try:
-            with open(self.csv_file, mode='a', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=self.csv_fieldnames)
-                writer.writerow(message_data)
-            # Log to file
-            logging.info(f"Appended message {message_data['message_id']} to CSV.")
-            # Print to terminal
-            print(f"Saved info for message {message_data['message_id']} to CSV.")
+            file_path = os.path.join(self.download_folder, file_name)
+
+            if await asyncio.to_thread(os.path.exists, file_path):
+                logging.info(f"File already exists, skipping: {file_path}")
+                print(f"File already exists, skipping: {file_name}")
+                self.state.record(channel_id, message_id, size=size)
+                return
+
+            logging.info(f"Downloading file: {file_name}")
+
+            # Shown on the shared dashboard; the callback only updates counters
+            with self.progress.track(file_name, size) as transfer:
+                await self.limiter.call(
+                    download_media,
+                    self.telegram_client,
+                    media,
+                    file_path,
+                    progress_callback=transfer.update,
+                )
+
+            logging.info(f"Successfully downloaded: {file_name}")
+            self.state.record(channel_id, message_id, size=size)
+
+        except FloodWaitError as e:
+            # self.limiter already paused and retried; the job stays queued in self.state for the next run
+            logging.error(f"Flood wait error persisted ({e.seconds}s), retrying {file_name} on the next run.")
+            print(f"ERROR: Flood wait error persisted ({e.seconds}s), retrying {file_name} on the next run.")
+            raise
         except Exception as e:
-            logging.error(f"Failed to append message {message_data['message_id']} to CSV: {e}")
-            print(f"ERROR: Failed to save message {message_data['message_id']} to CSV: {e}")
-
-    def _parse_messages(self, message, channel_name, channel_id):
-        """Helper function to parse a single message object into a dictionary."""
-        pass_regex = re.search(self.pass_regex, message.text) if message.text else None
-
-        sender_name: Optional[str] = None
-        sender_id: Optional[int] = None
-        if message.sender:
-            if isinstance(message.sender, User):
-                sender_name = message.sender.username
-            elif isinstance(message.sender, Channel):
-                sender_name = message.sender.title
-            sender_id = message.sender.id
-
-        return {
-            'channel_name': channel_name,
-            'channel_id': channel_id,
-            'sender_name': sender_name,
-            'sender_id': sender_id,
-            'date': message.date.isoformat() if message.date else None,
-            'message_id': message.id if message.id else None,
-            'message': message.text,
-            'raw_text': message.raw_text,
-            'file_name': message.file.name if message.file else None,
-            'file_size': message.file.size if message.file else None,
-            'pass_value': pass_regex.group(1) if pass_regex else None,
-        }
+            logging.error(f"Failed to download file {file_name}, retrying on the next run: {e}")
+            print(f"ERROR: Failed to download file {file_name}, retrying on the next run: {e}")
+            raise
 
     async def fetch_messages(self, limit: Optional[int] = 100) -> None: # CHANGED: No return value
-        """Fetches, saves, and downloads messages one by one."""
+        """Pages, parses, saves and downloads messages as concurrent pipeline stages."""
+        await self._scrape(lambda entity, marks: iter_incremental(
+            self.telegram_client, entity, marks, limit=limit, limiter=self.limiter))
+
+    async def listen(self, limit: Optional[int] = 100, flush_interval: float = 0.5) -> None:
+        """Catches up like fetch_messages, then saves new messages as they are posted until cancelled.
 
+        Rows are written in micro-batches of up to csv_flush_rows rows, at
+        most flush_interval seconds apart, through the same parse/persist/download path.
+        """
+        await self._scrape(lambda entity, marks: iter_live(
+            self.telegram_client, [entity], marks, limit=limit, limiter=self.limiter),
+            flush_interval=flush_interval)
+
+    async def _scrape(self, make_source, flush_interval: Optional[float] = None) -> None:
         logging.info(f"Connecting to Telegram...")
         print(f"Connecting to Telegram...")
 
         async with self.telegram_client:
+            # Watermarks are committed only after the rows they cover are flushed
+            # Also holds each download job as queued until its file is saved
+            self.state = state = SQLiteDownloadState(self.state_db, batch_size=None, commit_interval=None)
+            # CSV/DuckDB writes and the state commits they trigger run on the writer thread
+            writer = BackgroundWriter()
+            self.sink = ThreadedSink(writer, lambda: self._open_sink(on_flush=state.commit))
+            lag = LoopLagMonitor()
+            lag.start()
+            # TELEGRAM_METRICS_PORT / TELEGRAM_METRICS_JSON publish pipeline counters during the run
+            reporter = MetricsReporter.from_env()
+            await reporter.start()
             try:
-                entity = await self.telegram_client.get_entity(self.target_channel)
+                entity = await self.entity_cache.resolve(self.telegram_client, self.target_channel, self.limiter)
                 logging.info(f"Found channel: {entity.title}")
                 print(f"Found channel: {entity.title}")
 
-                async for message in self.telegram_client.iter_messages(entity, limit=limit):
-                    # 1. Parse the message data
-                    parsed_data = self._parse_messages(
-                        message=message, channel_name=entity.title, channel_id=entity.id
-                    )
-
-                    # 2. Append data to CSV *BEFORE* downloading
-                    self._append_to_csv(parsed_data)
-
-                    # 3. Download the file (if it exists)
-                    if message.file:
-                        file_name = message.file.name or f"file_{message.id}"
-                        try:
-                            file_path = os.path.join(self.download_folder, file_name)
-
-                            if os.path.exists(file_path):
-                                logging.info(f"File already exists, skipping: {file_path}")
-                                print(f"File already exists, skipping: {file_name}")
-                                continue
-
-                            logging.info(f"Downloading file: {file_name}")
-
-                            progress_func = self._get_progress_callback(file_name)
-
-                            await message.download_media(
-                                file=file_path,
-                                progress_callback=progress_func,
-                            )
-
-                            print() # Newline after progress bar
-
-                            logging.info(f"Successfully downloaded: {file_name}")
-
-                        except FloodWaitError as e:
-                            logging.warning(f"Flood wait error. Sleeping for {e.seconds} seconds.")
-                            print(f"Flood wait error. Sleeping for {e.seconds} seconds.")
-                            await asyncio.sleep(e.seconds)
-                        except Exception as e:
-                            logging.error(f"Failed to download file {file_name}: {e}")
-                            print(f"ERROR: Failed to download file {file_name}: {e}")
+                pending_jobs = await self._requeued_jobs(entity, writer) if self.download_workers else []
+
+                # Messages sit in queues for a while; watermarks advance once their rows are written.
+                # They are applied on the writer thread behind those rows, so a sink flush never commits
+                # a watermark for rows still buffered in self.sink.
+                marks = DeferredWatermarks(state)
+                pipeline = MessagePipeline(
+                    make_source(entity, marks),
+                    lambda message: self._parse_with_job(message, entity.title, entity.id),
+                    self.sink,
+                    download=self._download,
+                    download_workers=self.download_workers,
+                    batch_size=self.csv_flush_rows,
+                    on_persisted=lambda count: self.sink.then(marks.apply, marks.take(count)),
+                    flush_interval=flush_interval,
+                    # Senders a page didn't include are looked up in one request per page, if any column needs them
+                    prepare=(lambda messages: SENDERS.resolve_missing(self.telegram_client, messages, self.limiter))
+                    if self._fields & SENDER_FIELDS else None,
+                    pending_jobs=pending_jobs,
+                )
+                stats = await pipeline.run()
+                logging.info(f"Saved {stats.rows} messages, downloaded {stats.downloads} files"
+                             f" ({stats.failed_downloads} failed, left queued for the next run)")
 
             except ChannelPrivateError:
+                self.entity_cache.invalidate(self.target_channel)
                 logging.error(f"Error: The channel '{self.target_channel}' is private or you don't have access.")
             except ValueError:
                 logging.error(f"Error: Channel '{self.target_channel}' not found. Is the name correct?")
             except Exception as e:
                 logging.error(f"An unexpected error occurred: {e}")
+            finally:
+                self.sink.close()
+                writer.close()
+                state.close()
+                await self.progress.stop()
+                await reporter.stop()
+                await lag.stop()
+                logging.info(f"Event loop lag: p99 {lag.p99 * 1000:.1f} ms, max {lag.max_lag * 1000:.1f} ms")
 
         logging.info(f"Finished fetching messages.")
         print(f"Finished fetching messages.")
@@ -168,70 +248,6 @@ class TelegramScraper:
 
     # REMOVED: save_to_csv method is no longer needed
 
-    def _get_progress_callback(self, file_name: str):
-        """
-        Returns a callback function to show download progress in the terminal and log file.
-        (This is your advanced function, left unchanged)
-        """
-        start_time = time.time()
-        last_log_time = start_time
-        last_logged_percent_bucket = -10  # so 0% will log
-
-        def safe_div(a, b, default=0.0):
-            try:
-                return a / b if b else default
-            except Exception:
-                return default
-
-        def progress_callback(received_bytes: int, total_bytes: int):
-            nonlocal last_log_time, last_logged_percent_bucket
-            now = time.time()
-            elapsed_time = max(now - start_time, 1e-6)
-
-            speed_mbps = (received_bytes / (1024 * 1024)) / elapsed_time
-            received_mb = received_bytes / (1024 * 1024)
-            total_mb = (total_bytes / (1024 * 1024)) if total_bytes else 0.0
-
-            has_total = bool(total_bytes)
-            percentage = safe_div(received_bytes * 100.0, total_bytes, 0.0) if has_total else 0.0
-
-            remaining_bytes = (total_bytes - received_bytes) if has_total else None
-            eta_seconds = (remaining_bytes / (speed_mbps * 1024 * 1024)) if (has_total and speed_mbps > 1e-9) else 0
-
-            if has_total:
-                progress_str = (
-                    f"[{file_name[:20]}...] {percentage:6.1f}% "
-                    f"({received_mb:6.1f} / {total_mb:.1f} MB) "
-                    f"@ {speed_mbps:5.1f} MB/s "
-                    f"ETA: {eta_seconds:4.0f}s"
-                )
-            else:
-                progress_str = (
-                    f"[{file_name[:20]}...] {received_mb:6.1f} MB "
-                    f"@ {speed_mbps:5.1f} MB/s"
-                )
-
-            print(progress_str.ljust(80), end='\r', flush=True)
-
-            # Throttled logging to file so speed is visible in scraper.log
-            percent_bucket = int(percentage // 10) if has_total else None
-            should_log_by_time = (now - last_log_time) >= 1.0
-            should_log_by_percent = (has_total and percent_bucket is not None and percent_bucket > last_logged_percent_bucket)
-            is_complete = has_total and received_bytes == total_bytes
-
-            if should_log_by_time or should_log_by_percent or is_complete:
-                logging.info(f"Downloading {file_name}: {progress_str.strip()}")
-                last_log_time = now
-                if has_total and percent_bucket is not None:
-                    last_logged_percent_bucket = percent_bucket
-
-            if has_total and received_bytes == total_bytes:
-                # Print a newline so the last progress line doesn't overwrite subsequent prints
-                print()
-
-        return progress_callback
-
-
     async def run(self, limit: Optional[int] = 100):
         """Main execution flow."""
         # CHANGED: No return value, no save_to_csv call
@@ -239,6 +255,8 @@ class TelegramScraper:
 
 
 if __name__ == '__main__':
+    # Turn SIGTERM into KeyboardInterrupt so buffered CSV rows are flushed on shutdown
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
         api_id = config('TELEGRAM_API_ID')
         api_hash = config('TELEGRAM_APP_API_HASH')
@@ -249,16 +267,37 @@ if __name__ == '__main__':
             logging.error("Missing required configuration (TELEGRAM_API_ID, TELEGRAM_APP_API_HASH, CHANNEL_NAME)")
             print("ERROR: Missing required configuration. Check scraper.log for details.")
         else:
-            scraper = TelegramScraper(
+            scraper_kwargs = dict(
                 api_id=int(api_id),
                 api_hash=api_hash,
                 telegram_session=telegram_session,
-                target_channel=channel_name,
                 download_folder='telegram_downloads',
-                csv_file='telegram_data.csv'
+                csv_file='telegram_data.csv',
+                output=config('OUTPUT', default='csv'),
+                rules=load_rules(config('EXTRACT_RULES', default='')),
+                # COLUMNS=message_id,date,file_size exports just those (the channel_id/message_id key is always kept)
+                columns=config('COLUMNS', default='', cast=lambda v: [c.strip() for c in v.split(',') if c.strip()]) or None,
             )
-
-            asyncio.run(scraper.run(limit=3))
+            # CHANNEL_NAME=a,b,c scrapes the channels in parallel worker processes (SCRAPER_PROCESSES, default: one per core)
+            channels = [name.strip() for name in channel_name.split(',') if name.strip()]
+            if len(channels) > 1:
+                coordinator = ShardCoordinator(
+                    TelegramScraper, channels, processes=config('SCRAPER_PROCESSES', default=0, cast=int) or None,
+                    **scraper_kwargs,
+                )
+                coordinator.run(limit=3)
+            else:
+                scraper = TelegramScraper(target_channel=channel_name, **scraper_kwargs)
+                # LISTEN=1 keeps running and saves new posts as they arrive, flushed every LISTEN_FLUSH_MS
+                if config('LISTEN', default=False, cast=bool):
+                    try:
+                        asyncio.run(scraper.listen(
+                            limit=3, flush_interval=config('LISTEN_FLUSH_MS', default=500, cast=int) / 1000))
+                    except KeyboardInterrupt:
+                        logging.info("Stopped listening.")
+                        print("Stopped listening.")
+                else:
+                    asyncio.run(scraper.run(limit=3))
 
     except KeyError as e:
         logging.error(f"Configuration error: Missing environment variable {e}")
@@ -2,11 +2,24 @@ import os
 import re
 import logging
 import asyncio
-import sqlite3
 
 from telethon import TelegramClient
 from decouple import config
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence
+
+from download_scheduler import DownloadOrder
+from entity_cache import EntityCache
+from extract_rules import RuleSet, load_rules
+from io_writer import BackgroundWriter, LoopLagMonitor, ThreadedSink
+from media_filter import MediaFilter
+from media_store import MediaStore
+from message_fields import DEFAULT_RULESET, SENDER_FIELDS, column_fields, extract, row_getter, select_columns
+from metrics import MetricsReporter
+from parallel_download import download_media
+from pipeline import MessagePipeline
+from rate_limit import AdaptiveRateLimiter
+from senders import SenderCache, SenderInfo
+from sinks import DuckDBSink, SqliteSink
 
 os.makedirs('logs', exist_ok=True)
 
@@ -24,159 +37,203 @@ logger.addHandler(stream_handler)
 
 class TelegramScraper:
 
-    def __init__(self, api_id: int, api_hash: str, session_name: str, target_channel: str, download_folder: str = 'telegram_downloads'):
-
-        self.client = TelegramClient(session_name, api_id, api_hash)
+    # Table column -> MessageRecord field or extraction rule name
+    COLUMN_FIELDS = {
+        'channel_name': 'channel_name', 'channel_id': 'channel_id', 'message_id': 'message_id',
+        'sender_id': 'sender_id', 'message_text': 'text', 'message_raw_text': 'raw_text',
+        'message_date': 'date', 'file_name': 'file_name', 'file_size': 'file_size', 'pass_match': 'pass_value',
+    }
+
+    def __init__(self, api_id: int, api_hash: str, session_name: str, target_channel: str, download_folder: str = 'telegram_downloads',
+                 batch_size: int = 500, download_queue_size: int = 100, storage: str = 'sqlite',
+                 rules: Optional[RuleSet] = None, columns: Optional[Sequence[str]] = None,
+                 media_filter: Optional[MediaFilter] = None, media_only: bool = False, download_order: str = 'shortest'):
+
+        # Flood waits are handled by self.limiter, which pauses paging and all download workers together
+        self.client = TelegramClient(session_name, api_id, api_hash, flood_sleep_threshold=0)
+        # Resolves target_channel locally after the first run
+        self.entity_cache = EntityCache.for_session(session_name)
+        self.limiter = AdaptiveRateLimiter(session=session_name)
         self.target_channel = target_channel
         self.download_folder = download_folder
-        self.pass_regex = r'```\s*([^\s`]+)\s*```'
-        self.messages = []
+        # Media already fetched for any channel under download_folder is hardlinked instead of re-downloaded
+        self.media_store = MediaStore(download_folder)
+        # Media that doesn't match (by default stickers and link previews) is stored as a row but not downloaded;
+        # with media_only, messages without matching media aren't stored either and the server pre-filters by kind
+        self.media_filter = media_filter or MediaFilter()
+        self.media_only = media_only
+        self.rules = rules or DEFAULT_RULESET
+        # Extra extraction rules become extra columns; columns=[...] stores (and computes) only those
+        self.column_fields = select_columns(column_fields(self.COLUMN_FIELDS, self.rules), columns,
+                                            required=('channel_id', 'message_id'))
+        self.columns = tuple(self.column_fields)
+        self._fields = frozenset(self.column_fields.values())
+        self._to_row = row_getter(list(self.column_fields.values()), self.rules)
         self.entity = None
+        # Rows per SQLite transaction / pending downloads before paging waits for the workers
+        self.batch_size = batch_size
+        self.download_queue_size = download_queue_size
+        # Which queued download a free worker takes: 'shortest' (smallest file), 'newest' or 'fifo'
+        self.download_order = DownloadOrder(download_order)
+        # 'sqlite' or 'duckdb'
+        self.storage = storage
+        self.message_count = 0
+        # Own cache rather than the shared SENDERS: run() drains new senders into the senders table
+        self.senders = SenderCache(track_new=True)
 
     def _sanitize_filename(self, name: str) -> str:
         if not name:
             return 'unknown'
         return re.sub(r'[\\/*?:"<>|]', "_", name)
 
-    def _parse_messages(self, message, channel_name: str, channel_id: str) -> Dict[str, str]:
-        match = re.search(self.pass_regex, message.text) if message.text else None
-
-        pass_match_text = match.group(1) if match else None
-
-        return {
-            'channel_name': channel_name,
-            'channel_id': channel_id,
-            'message_id': message.id,
-            'sender': message.sender.username if message.sender else None,
-            'message_text': message.text,
-            'message_raw_text': message.raw_text,
-            'message_date': message.date.isoformat() if message.date else None,
-            'file_name': message.file.name if message.file else None,
-            'file_size': message.file.size if message.file else None,
-            'pass_match': pass_match_text
-        }
-
-    async def _fetch_messages(self, limit=10):
+    def _parse_messages(self, message, channel_name: str, channel_id: str) -> tuple:
+        """Returns the message as a row in self.columns order."""
+        return self._to_row(extract(message, channel_name, channel_id, self.rules, self.senders, self._fields))
+
+    async def _resolve_entity(self) -> bool:
         try:
-            self.entity = await self.client.get_entity(self.target_channel)
+            self.entity = await self.entity_cache.resolve(self.client, self.target_channel, self.limiter)
             logging.info(f"Fetching messages from {self.target_channel}")
+            return True
         except ValueError:
             logging.info(f'Channel not found: {self.target_channel}')
-            return
         except Exception as e:
             logging.error(f'Error while fetching messages: {self.target_channel} {e}')
-        async for message in  self.client.iter_messages(self.target_channel, limit=limit):
-            logging.info(f'Message id found {message.id}')
-            self.messages.append(message)
-
-    def save_to_sqlite(self, db_name: str = 'telegra_messages.db', table_name: str = 'messages'):
-
-        if not self.messages:
-            logging.info(f"No messages found for channel: {self.target_channel}")
-            return
-
-        if not self.entity:
-            logging.error(f'No entity found for channel: {self.target_channel}')
-            return
-
-        parsed_messages = []
-        for msg in self.messages:
-            parse_data = self._parse_messages(msg, self.entity.title, self.entity.id)
-            parsed_messages.append(parse_data)
+        return False
+
+    def _parse_with_job(self, message) -> tuple:
+        """Row for the sink plus a (message id, file name, media, size) download job if media_filter wants the file."""
+        row = self._parse_messages(message, self.entity.title, self.entity.id)
+        if not self.media_filter.matches(message):
+            return row, None
+        if message.file and message.file.name:
+            file_name = message.file.name
+        else:
+            file_name = f'media_from_message_{message.id}{(message.file.ext or "") if message.file else ""}'
+        return row, (message.id, file_name, message.media, message.file.size if message.file else None)
 
+    def open_sqlite_sink(self, db_name: str = 'telegra_messages.db', table_name: str = 'messages') -> SqliteSink:
         db_path = os.path.join(self.download_folder, db_name)
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
-        conn = None
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            cursor.execute(f"""
-                            CREATE TABLE IF NOT EXISTS {table_name} (
-                                CHANNEL_NAME TEXT,
-                                CHANNEL_ID TEXT,
-                                MESSAGE_ID INTEGER,
-                                SENDER TEXT,
-                                MESSAGE_TEXT TEXT,
-                                MESSAGE_RAW_TEXT TEXT,
-                                MESSAGE_DATE TEXT,
-                                FILE_NAME TEXT,
-                                FILE_SIZE INTEGER,
-                                PASS_MATCH TEXT,
-                                UNIQUE(CHANNEL_ID, MESSAGE_ID)
-                            )
-                        """)
-
-            cols = parsed_messages[0].keys()
-            placeholders = ", ".join(["?"] * len(cols))
-            data_to_insert = [tuple(msg[col] for col in cols) for msg in parsed_messages]
-
-            insert_query = f"INSERT OR IGNORE INTO {table_name} ({', '.join(cols)}) VALUES ({placeholders})"
-
-
-            cursor.executemany(insert_query, data_to_insert)
-            conn.commit()
-            logging.info(f'Successfully saved messages to {db_path}')
-
-        except sqlite3.Error as e:
-            logging.error(f"Error while saving messages: {e}")
-        finally:
-            if conn:
-                conn.close()
-
-    async def _download_worker(self, semaphore: asyncio.Semaphore, message, download_path: str):
-        async with semaphore:
-            try:
-                file_name = message.file.name if message.file and message.file.name else f'media_from_message_{message.id}'
-                full_path = os.path.join(download_path, file_name)
-                if os.path.exists(full_path):
-                    logging.info(f'File {file_name} already exists in {download_path}')
-                    return
-                logging.info(f'Starting download {file_name}')
-                await message.download_media(file=download_path)
-                logging.info(f'Successfully downloaded file {file_name}')
-            except Exception as e:
-                logging.error(f'Failed to download file: {message.id} {e}')
-
-    async def _download_files(self, concurrent_limit: int = 4):
-        if not self.messages:
-            logging.info(f"No messages found for channel: {self.target_channel}")
-            return
-        if not self.entity:
-            logging.error(f'No entity found for channel: {self.target_channel}')
-
-        logging.info(f"Starting download process for {len(self.messages)} messages...")
-
-        safe_channel_name = self._sanitize_filename(self.entity.title)
-        channel_download_path = os.path.join(self.download_folder, safe_channel_name)
-        os.makedirs(channel_download_path, exist_ok=True)
-
-        sem = asyncio.Semaphore(concurrent_limit)
-        tasks = []
-
-        logging.info(f"Queuing {len(self.messages)} messages for download with limit {concurrent_limit}...")
+        create_sql = f"""
+                        CREATE TABLE IF NOT EXISTS {table_name} (
+                            CHANNEL_NAME TEXT,
+                            CHANNEL_ID TEXT,
+                            MESSAGE_ID INTEGER,
+                            SENDER_ID INTEGER,
+                            MESSAGE_TEXT TEXT,
+                            MESSAGE_RAW_TEXT TEXT,
+                            MESSAGE_DATE TEXT,
+                            FILE_NAME TEXT,
+                            FILE_SIZE INTEGER,
+                            PASS_MATCH TEXT,
+                            UNIQUE(CHANNEL_ID, MESSAGE_ID)
+                        )
+                    """
+        return SqliteSink(db_path, table_name, self.columns, create_sql, max_rows=self.batch_size)
+
+    def open_duckdb_sink(self, db_name: str = 'telegram_messages.duckdb', table_name: str = 'messages') -> DuckDBSink:
+        db_path = os.path.join(self.download_folder, db_name)
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
-        for message in self.messages:
-            if message.media:
-                task = asyncio.create_task(
-                    self._download_worker(sem, message, channel_download_path)
+        create_sql = f"""
+                        CREATE TABLE IF NOT EXISTS {table_name} (
+                            CHANNEL_NAME VARCHAR,
+                            CHANNEL_ID BIGINT,
+                            MESSAGE_ID BIGINT,
+                            SENDER_ID BIGINT,
+                            MESSAGE_TEXT VARCHAR,
+                            MESSAGE_RAW_TEXT VARCHAR,
+                            MESSAGE_DATE TIMESTAMPTZ,
+                            FILE_NAME VARCHAR,
+                            FILE_SIZE BIGINT,
+                            PASS_MATCH VARCHAR,
+                            PRIMARY KEY (CHANNEL_ID, MESSAGE_ID)
+                        )
+                    """
+        return DuckDBSink(db_path, table_name, self.columns, create_sql, max_rows=max(self.batch_size, 10_000))
+
+    def open_sink(self):
+        if self.storage == 'duckdb':
+            return self.open_duckdb_sink()
+        return self.open_sqlite_sink(db_name='telegram_messages.db', table_name='messages')
+
+    def open_sender_sink(self):
+        """Senders table next to messages; join on SENDER_ID instead of storing names in every row."""
+        if self.storage == 'duckdb':
+            create_sql = """
+                CREATE TABLE IF NOT EXISTS senders (
+                    SENDER_ID BIGINT PRIMARY KEY, KIND VARCHAR, USERNAME VARCHAR, NAME VARCHAR
                 )
-                tasks.append(task)
-
-        if tasks:
-            await asyncio.gather(*tasks)
-            logging.info('All downloads completed')
-        else:
-            logging.info("No media found in fetched messages.")
-
+            """
+            return DuckDBSink(os.path.join(self.download_folder, 'telegram_messages.duckdb'), 'senders',
+                              SenderInfo._fields, create_sql, key_columns=('sender_id',))
+        create_sql = """
+            CREATE TABLE IF NOT EXISTS senders (
+                SENDER_ID INTEGER PRIMARY KEY, KIND TEXT, USERNAME TEXT, NAME TEXT
+            )
+        """
+        return SqliteSink(os.path.join(self.download_folder, 'telegram_messages.db'), 'senders',
+                          SenderInfo._fields, create_sql, replace=True)
+
+    def _store_senders(self, sink) -> None:
+        # Only senders first seen (or renamed) since the last batch
+        for info in self.senders.drain_new():
+            sink.write(info)
+
+    async def _download(self, job, download_path: str):
+        message_id, file_name, media, _ = job
+        full_path = os.path.join(download_path, file_name)
+        if await asyncio.to_thread(os.path.exists, full_path):
+            logging.info(f'File {file_name} already exists in {download_path}')
+            return
+        logging.info(f'Starting download {file_name}')
+        try:
+            path, _ = await self.media_store.fetch(
+                media, full_path, lambda path: self.limiter.call(download_media, self.client, media, path))
+        except Exception as e:
+            logging.error(f'Failed to download file: {message_id} {e}')
+            raise
+        logging.info(f'Successfully downloaded file {path}')
 
-    async def run(self):
+    async def run(self, limit: int = 20, concurrent_limit: int = 4):
+        """Pages history while earlier pages are parsed, stored in batches and downloaded by concurrent_limit workers."""
         async with self.client:
-            await self._fetch_messages(limit=20)
-            if self.entity:
-                self.save_to_sqlite(db_name='telegram_messages.db', table_name='messages')
-                await self._download_files(concurrent_limit=4)
+            if not await self._resolve_entity():
+                return
+
+            channel_download_path = os.path.join(self.download_folder, self._sanitize_filename(self.entity.title))
+            os.makedirs(channel_download_path, exist_ok=True)
+            logging.info(f"Starting {concurrent_limit} download workers...")
+
+            # Database writes run on their own thread so downloads keep streaming during commits
+            with BackgroundWriter() as writer, ThreadedSink(writer, self.open_sink) as sink, \
+                    ThreadedSink(writer, self.open_sender_sink) as sender_sink:
+                async with LoopLagMonitor() as lag, MetricsReporter.from_env():
+                    server_filter = self.media_filter.server_filter() if self.media_only else None
+                    source = self.limiter.iter_messages(self.client, self.entity, limit=limit, filter=server_filter)
+                    if self.media_only:
+                        source = self.media_filter.select(source)
+                    pipeline = MessagePipeline(
+                        source,
+                        self._parse_with_job,
+                        sink,
+                        download=lambda job: self._download(job, channel_download_path),
+                        download_workers=concurrent_limit,
+                        batch_size=self.batch_size,
+                        download_queue_size=self.download_queue_size,
+                        download_order=lambda job: self.download_order.key(job[3], job[0]),
+                        # Senders a page didn't include are looked up in one request per page
+                        prepare=(lambda messages: self.senders.resolve_missing(self.client, messages, self.limiter))
+                        if self._fields & SENDER_FIELDS else None,
+                        on_persisted=lambda count: self._store_senders(sender_sink),
+                    )
+                    stats = await pipeline.run()
+            logging.info(f'Event loop lag: p99 {lag.p99 * 1000:.1f} ms, max {lag.max_lag * 1000:.1f} ms')
+            self.message_count = stats.messages
+            logging.info(f'Successfully saved {stats.rows} messages to {self.storage}')
+            logging.info(f'All downloads completed ({stats.downloads} ok, {stats.failed_downloads} failed)')
 
 if '__main__' == __name__:
 
@@ -194,7 +251,15 @@ if '__main__' == __name__:
         api_hash=api_hash,
         session_name=session_name,
         target_channel=target_channel,
-        download_folder='telegram_downloads'
+        download_folder='telegram_downloads',
+        storage=config('STORAGE', default='sqlite'),
+        rules=load_rules(config('EXTRACT_RULES', default='')),
+        # COLUMNS=message_id,message_date,file_size stores just those (plus the channel_id/message_id key)
+        columns=config('COLUMNS', default='', cast=lambda v: [c.strip() for c in v.split(',') if c.strip()]) or None,
+        # TELEGRAM_MEDIA_KINDS, TELEGRAM_MEDIA_MIN_SIZE, ... as for download_file.py
+        media_filter=MediaFilter.from_env(),
+        media_only=config('MEDIA_ONLY', default=False, cast=bool),
+        download_order=config('DOWNLOAD_ORDER', default='shortest'),
     )
 
     asyncio.run(scraper.run())
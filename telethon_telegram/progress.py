@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import sys
+import time
+from typing import Optional, TextIO
+
+logger = logging.getLogger("downloader.progress")
+
+MB = 1024 * 1024
+
+
+def _format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '--:--'
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f'{hours}:{rest // 60:02d}:{rest % 60:02d}' if hours else f'{rest // 60:02d}:{rest % 60:02d}'
+
+
+class Transfer:
+    """Byte counter for one download; ``update`` is the progress callback and only stores two ints."""
+
+    __slots__ = ('tracker', 'name', 'received', 'total', 'started')
+
+    def __init__(self, tracker: "ProgressTracker", name: str, total: Optional[int]) -> None:
+        self.tracker = tracker
+        self.name = name
+        self.received = 0
+        self.total = total or 0
+        self.started = time.monotonic()
+
+    def update(self, received: int, total: int) -> None:
+        self.received = received
+        if total:
+            self.total = total
+
+    def close(self, failed: bool = False) -> None:
+        self.tracker._finish(self, failed)
+
+    def __enter__(self) -> "Transfer":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close(failed=exc_type is not None)
+
+
+class ProgressTracker:
+    """Aggregates every concurrent download into one dashboard redrawn ``refresh`` times a second at most.
+
+    Progress callbacks just update counters on their ``Transfer``; a
+    single task renders the totals (MB/s, ETA) and the ``max_rows``
+    largest active transfers. On a non-terminal stream nothing is drawn.
+    A summary is logged every ``log_interval`` seconds and ``snapshot()``
+    returns the same numbers for other reporting.
+    """
+
+    def __init__(self, refresh: float = 0.5, stream: TextIO = sys.stderr, max_rows: int = 8,
+                 log_interval: float = 10.0, smoothing: float = 0.3) -> None:
+        self.refresh = refresh
+        self.stream = stream
+        self.max_rows = max_rows
+        self.log_interval = log_interval
+        self.smoothing = smoothing
+        self.interactive = hasattr(stream, 'isatty') and stream.isatty()
+        self.active: dict[int, Transfer] = {}
+        self.completed = 0
+        self.failed = 0
+        self.completed_bytes = 0
+        self.speed = 0.0
+        self._last_bytes = 0
+        self._last_tick = time.monotonic()
+        self._last_log = self._last_tick
+        self._lines = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def track(self, name: str, total: Optional[int] = None) -> Transfer:
+        """Register a transfer; use it as a context manager or call ``close()`` when it ends."""
+        transfer = Transfer(self, name, total)
+        self.active[id(transfer)] = transfer
+        if self._task is None:
+            try:
+                self._task = asyncio.get_running_loop().create_task(self._run(), name='progress-dashboard')
+            except RuntimeError:
+                pass
+        return transfer
+
+    def _finish(self, transfer: Transfer, failed: bool) -> None:
+        if self.active.pop(id(transfer), None) is None:
+            return
+        self.completed_bytes += transfer.received
+        if failed:
+            self.failed += 1
+        else:
+            self.completed += 1
+
+    @property
+    def received_bytes(self) -> int:
+        return self.completed_bytes + sum(t.received for t in self.active.values())
+
+    def snapshot(self) -> dict:
+        remaining = sum(max(t.total - t.received, 0) for t in self.active.values())
+        return {
+            'active': len(self.active),
+            'completed': self.completed,
+            'failed': self.failed,
+            'received_bytes': self.received_bytes,
+            'remaining_bytes': remaining,
+            'bytes_per_second': self.speed,
+            'eta_seconds': remaining / self.speed if self.speed > 0 else None,
+        }
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.refresh)
+                self.tick()
+        except asyncio.CancelledError:
+            self.tick()
+            raise
+
+    def tick(self) -> None:
+        """Update the speed estimate, redraw the dashboard and log a summary when due."""
+        now = time.monotonic()
+        received = self.received_bytes
+        elapsed = now - self._last_tick
+        # Ignore very short intervals (e.g. the final frame), they make the rate jump
+        if elapsed >= self.refresh / 2:
+            instant = (received - self._last_bytes) / elapsed
+            self.speed = instant if not self.speed else self.smoothing * instant + (1 - self.smoothing) * self.speed
+            self._last_bytes = received
+            self._last_tick = now
+
+        if self.interactive:
+            self._render()
+        if now - self._last_log >= self.log_interval:
+            self._last_log = now
+            snap = self.snapshot()
+            logger.info("Downloads: %d active, %d done, %d failed, %.1f MB at %.2f MB/s, ETA %s",
+                        snap['active'], snap['completed'], snap['failed'], snap['received_bytes'] / MB,
+                        snap['bytes_per_second'] / MB, _format_eta(snap['eta_seconds']))
+
+    def _render(self) -> None:
+        snap = self.snapshot()
+        lines = [
+            f"{snap['active']} active | {snap['completed']} done | {snap['failed']} failed | "
+            f"{snap['received_bytes'] / MB:.1f} MB @ {snap['bytes_per_second'] / MB:.2f} MB/s | "
+            f"ETA {_format_eta(snap['eta_seconds'])}"
+        ]
+        transfers = sorted(self.active.values(), key=lambda t: t.total, reverse=True)
+        now = time.monotonic()
+        for t in transfers[:self.max_rows]:
+            speed = t.received / max(now - t.started, 1e-6)
+            percent = f'{t.received * 100 / t.total:5.1f}%' if t.total else '    ?'
+            lines.append(f"  {t.name[:40]:<40} {percent} {t.received / MB:8.1f}/{t.total / MB:.1f} MB "
+                         f"{speed / MB:6.2f} MB/s")
+        if len(transfers) > self.max_rows:
+            lines.append(f"  ... and {len(transfers) - self.max_rows} more")
+
+        # Move back over the previous frame and redraw it in one write
+        prefix = f'\x1b[{self._lines}F' if self._lines else ''
+        self.stream.write(prefix + '\x1b[J' + '\n'.join(lines) + '\n')
+        self.stream.flush()
+        self._lines = len(lines)
+
+    async def stop(self) -> None:
+        """Draw the final frame and stop refreshing."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def __aenter__(self) -> "ProgressTracker":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.stop()
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import math
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from telethon.errors import FloodWaitError
+
+import metrics
+
+logger = logging.getLogger("downloader.rate_limit")
+
+T = TypeVar("T")
+
+# Telethon requests history in pages of up to 100 messages
+HISTORY_PAGE_SIZE = 100
+# Calls that move a whole file; timed as transfers rather than API request latency
+TRANSFER_METHODS = frozenset({'download_media', 'download_file', 'upload_file'})
+
+
+class AdaptiveRateLimiter:
+    """Token bucket shared by every API call, tuned by FloodWait responses (AIMD).
+
+    Each successful call raises the rate slightly (additive increase, about
+    ``increase`` requests/s per second of traffic); a ``FloodWaitError``
+    halves it (multiplicative decrease) and pauses *all* callers for the
+    requested time. The failed call is then retried, so nothing is skipped.
+    Create clients with ``flood_sleep_threshold=0`` so Telethon reports
+    every flood wait instead of sleeping on it privately. Waits longer than
+    ``max_wait`` seconds are raised right away, and so is every call made
+    while such a pause lasts, so the caller can hand the work to another
+    session instead. ``session`` labels this limiter's rate gauge, so the
+    limiters of a session pool are reported side by side.
+    """
+
+    def __init__(self, rate: float = 5.0, min_rate: float = 0.2, max_rate: float = 30.0, burst: float = 5.0,
+                 increase: float = 0.2, decrease: float = 0.5, max_retries: int = 5,
+                 max_wait: Optional[float] = None, session: str = 'default') -> None:
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0.0
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        metrics.limiter_rate.labels(session).set_function(lambda: self.rate)
+
+    async def acquire(self) -> None:
+        """Wait for a token; callers are served in FIFO order."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    if self._too_long(self._paused_until - now):
+                        # Fail fast; the session is benched and its work can go elsewhere
+                        raise FloodWaitError(request=None, capture=math.ceil(self._paused_until - now))
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_flood_wait(self, seconds: float) -> None:
+        self.flood_waits += 1
+        self.flood_wait_seconds += seconds
+        metrics.flood_waits.inc()
+        metrics.flood_wait_seconds.inc(seconds)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        logger.warning("Flood wait of %ss; pausing all requests, rate now %.2f req/s", seconds, self.rate)
+
+    def _too_long(self, seconds: float) -> bool:
+        return self.max_wait is not None and seconds > self.max_wait
+
+    async def call(self, func: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """Run ``await func(*args, **kwargs)`` under the limiter, retrying after flood waits."""
+        name = getattr(func, '__name__', 'call')
+        latency = (metrics.transfer_seconds if name in TRANSFER_METHODS else metrics.api_seconds).labels(name)
+        for attempt in range(self.max_retries + 1):
+            await self.acquire()
+            started = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self.on_flood_wait(e.seconds)
+                if attempt == self.max_retries or self._too_long(e.seconds):
+                    raise
+                continue
+            finally:
+                latency.observe(time.perf_counter() - started)
+            self.on_success()
+            return result
+        raise AssertionError("unreachable")
+
+    async def iter_messages(self, client, entity, limit: Optional[int] = None, **kwargs) -> AsyncIterator:
+        """``client.iter_messages`` that takes a token per history page and resumes after flood waits.
+
+        On a flood wait the iteration restarts just past the last message
+        handed out (``offset_id``, or ``min_id`` when ``reverse=True``).
+        """
+        reverse = kwargs.get("reverse", False)
+        latency = metrics.api_seconds.labels('iter_messages')
+        yielded = 0
+        retries = 0
+        while limit is None or yielded < limit:
+            remaining = None if limit is None else limit - yielded
+            iterator = client.iter_messages(entity, limit=remaining, **kwargs).__aiter__()
+            try:
+                count = 0
+                while True:
+                    page_start = count % HISTORY_PAGE_SIZE == 0
+                    if page_start:
+                        await self.acquire()
+                        started = time.perf_counter()
+                    try:
+                        message = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        if page_start:
+                            # The first message of a page waits for the whole GetHistory request
+                            latency.observe(time.perf_counter() - started)
+                    count += 1
+                    yielded += 1
+                    retries = 0
+                    if count % HISTORY_PAGE_SIZE == 0:
+                        self.on_success()
+                    yield message
+                    if reverse:
+                        kwargs["min_id"] = message.id
+                    else:
+                        kwargs["offset_id"] = message.id
+            except FloodWaitError as e:
+                self.on_flood_wait(e.seconds)
+                retries += 1
+                if retries > self.max_retries or self._too_long(e.seconds):
+                    raise
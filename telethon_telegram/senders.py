@@ -0,0 +1,152 @@
+import logging
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional
+
+from telethon.errors import RPCError
+from telethon.tl.types import Chat, ChatForbidden, User
+from telethon.utils import resolve_id
+
+import metrics
+from rate_limit import AdaptiveRateLimiter
+
+logger = logging.getLogger("scraper.senders")
+
+# Looked up per message, so keep the children instead of calling labels() each time
+_HITS = metrics.cache_lookups.labels('senders', 'hit')
+_MISSES = metrics.cache_lookups.labels('senders', 'miss')
+
+
+class SenderInfo(NamedTuple):
+    """One row of the normalized senders table."""
+    sender_id: int
+    kind: str
+    username: Optional[str]
+    # First and last name for users, title for chats and channels
+    name: Optional[str]
+
+
+def describe(entity) -> SenderInfo:
+    username = getattr(entity, 'username', None)
+    if isinstance(entity, User):
+        name = ' '.join(filter(None, (entity.first_name, entity.last_name))) or None
+        return SenderInfo(entity.id, 'user', username, name)
+    kind = 'chat' if isinstance(entity, (Chat, ChatForbidden)) else 'channel'
+    return SenderInfo(entity.id, kind, username, getattr(entity, 'title', None))
+
+
+def bare_id(sender_id: int) -> int:
+    """``message.sender_id`` is a marked peer id (-100... for channels); entities carry the bare one."""
+    return resolve_id(sender_id)[0]
+
+
+class SenderCache:
+    """Bounded LRU of ``SenderInfo`` by sender id; ``SENDERS`` is the one scrapers share by default.
+
+    ``remember`` is called with each message's sender entity and only
+    builds a new ``SenderInfo`` for an unseen or renamed sender.
+    ``resolve_missing`` fills in senders a page of messages didn't carry
+    (``message.sender`` is None but ``sender_id`` is set) with one batched
+    ``get_entity`` call for the ids the session holds access hashes for;
+    ids that can't be resolved (or a failed lookup) are remembered as
+    such, so they aren't retried on every page. With ``track_new``,
+    ``drain_new`` hands out senders added or changed since the last call,
+    for upserting into a senders table instead of repeating names in
+    every message row; leave it off unless something drains them, and
+    give a scraper that does its own cache rather than ``SENDERS``.
+    ``hits``/``misses`` are also exported as
+    ``scraper_cache_lookups_total{cache="senders"}``.
+    """
+
+    def __init__(self, maxsize: int = 50_000, track_new: bool = False) -> None:
+        self.maxsize = maxsize
+        self.track_new = track_new
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[int, Optional[SenderInfo]] = OrderedDict()
+        self._new: dict[int, SenderInfo] = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, sender_id: int) -> bool:
+        return sender_id in self._items
+
+    def _store(self, sender_id: int, info: Optional[SenderInfo]) -> None:
+        self._items[sender_id] = info
+        self._items.move_to_end(sender_id)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def get(self, sender_id: Optional[int]) -> Optional[SenderInfo]:
+        """Cached sender for a ``message.sender_id`` (marked or bare)."""
+        if sender_id is None:
+            return None
+        sender_id = bare_id(sender_id)
+        info = self._items.get(sender_id)
+        if info is None:
+            self.misses += 1
+            _MISSES.inc()
+            return None
+        self.hits += 1
+        _HITS.inc()
+        self._items.move_to_end(sender_id)
+        return info
+
+    def remember(self, entity) -> SenderInfo:
+        cached = self._items.get(entity.id)
+        if cached is not None and cached.username == getattr(entity, 'username', None):
+            self.hits += 1
+            _HITS.inc()
+            self._items.move_to_end(entity.id)
+            return cached
+        self.misses += 1
+        _MISSES.inc()
+        info = describe(entity)
+        if self.track_new and info != cached:
+            self._new[info.sender_id] = info
+        self._store(info.sender_id, info)
+        return info
+
+    def drain_new(self) -> list[SenderInfo]:
+        new = list(self._new.values())
+        self._new.clear()
+        return new
+
+    async def resolve_missing(self, client, messages: Iterable,
+                              limiter: Optional[AdaptiveRateLimiter] = None) -> int:
+        """Look up, in one request, the senders ``messages`` reference but don't include; returns how many."""
+        missing = {getattr(m, 'sender_id', None) for m in messages if m.sender is None} - {None}
+        missing = [sender_id for sender_id in missing if bare_id(sender_id) not in self._items]
+        if not missing:
+            return 0
+        peers = []
+        for sender_id in missing:
+            try:
+                # Offline: only the session's entity table, never a network lookup per id
+                peers.append(client.session.get_input_entity(sender_id))
+            except (ValueError, TypeError):
+                # No access hash known, so Telegram couldn't resolve it either
+                self._store(bare_id(sender_id), None)
+        if not peers:
+            return 0
+        try:
+            # One batched lookup (a request per peer type at most)
+            if limiter is not None:
+                entities = await limiter.call(client.get_entity, peers)
+            else:
+                entities = await client.get_entity(peers)
+        except (ValueError, RPCError) as e:
+            # Missing senders only cost their names; never the run
+            logger.warning("Could not resolve %d senders: %s", len(peers), e)
+            entities = []
+        for entity in entities:
+            self.remember(entity)
+        for sender_id in missing:
+            if bare_id(sender_id) not in self._items:
+                self._store(bare_id(sender_id), None)
+        logger.debug("Resolved %d of %d missing senders", len(entities), len(missing))
+        return len(entities)
+
+
+# Shared by the scrapers of one process
+SENDERS = SenderCache()
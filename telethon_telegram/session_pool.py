@@ -0,0 +1,137 @@
+import asyncio
+import contextlib
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional, Sequence
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from rate_limit import AdaptiveRateLimiter
+
+logger = logging.getLogger("downloader.sessions")
+
+
+@dataclass
+class Session:
+    """One account: its client, its own limiter and the dialogs it can see (entities are per account)."""
+    name: str
+    client: Any
+    limiter: AdaptiveRateLimiter
+    dialogs: dict = field(default_factory=dict)
+    completed: int = 0
+    requeued: int = 0
+    cooldown_until: float = 0.0
+
+
+class SessionPool:
+    """Spreads dialogs over several accounts, each with its own flood limits.
+
+    Every session lists its own dialogs, since an entity (access hash) is
+    only valid for the account that fetched it. Idle sessions take the next
+    pending dialog they can access, preferring dialogs few other sessions
+    can serve. A flood wait longer than ``max_wait`` puts the dialog back
+    for another session (resume state keeps the work done so far) and
+    benches the session until the wait is over; ``handoff`` does the same
+    for single jobs, such as downloads. All sessions share the
+    caller's state store, so results merge in one place.
+    """
+
+    def __init__(self, session_names: Sequence[str], api_id: int, api_hash: str, max_wait: float = 60.0,
+                 client_factory: Optional[Callable[[str], Any]] = None) -> None:
+        if client_factory is None:
+            def client_factory(name: str):
+                return TelegramClient(name, api_id, api_hash, flood_sleep_threshold=0)
+        self.sessions = [Session(name, client_factory(name), AdaptiveRateLimiter(max_wait=max_wait, session=name))
+                         for name in session_names]
+        self._stack = contextlib.AsyncExitStack()
+
+    async def __aenter__(self) -> "SessionPool":
+        for session in self.sessions:
+            await self._stack.enter_async_context(session.client)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self._stack.aclose()
+        for session in self.sessions:
+            logger.info("Session %s: %d dialogs done, %d handed off after flood waits",
+                        session.name, session.completed, session.requeued)
+
+    async def load_dialogs(self, wanted: Callable[[Any], bool]) -> None:
+        for session in self.sessions:
+            session.dialogs = {dialog.id: dialog async for dialog in session.client.iter_dialogs() if wanted(dialog)}
+            logger.info("Session %s sees %d dialogs", session.name, len(session.dialogs))
+
+    def handoff(self, session: Session, dialog_id: int, seconds: float) -> Optional[Session]:
+        """Bench ``session`` for ``seconds`` and return another session that can serve ``dialog_id`` now, if any.
+
+        For work that outlives the dialog's history scan, such as downloads
+        already scheduled when the flood wait hits.
+        """
+        now = time.monotonic()
+        session.cooldown_until = max(session.cooldown_until, now + seconds)
+        ready = [other for other in self.sessions
+                 if other is not session and dialog_id in other.dialogs and other.cooldown_until <= now]
+        if not ready:
+            return None
+        session.requeued += 1
+        # The least flood-waited account is the most likely to stay usable
+        return min(ready, key=lambda other: other.limiter.flood_wait_seconds)
+
+    async def run(self, handler: Callable[[Session, Any], Awaitable[None]], wanted: Callable[[Any], bool]) -> None:
+        """Call ``handler(session, dialog)`` once per wanted dialog, across all sessions."""
+        await self.load_dialogs(wanted)
+        eligible: dict[int, list[Session]] = {}
+        for session in self.sessions:
+            for dialog_id in session.dialogs:
+                eligible.setdefault(dialog_id, []).append(session)
+        pending = set(eligible)
+        running = 0
+        changed = asyncio.Condition()
+
+        def pick(session: Session) -> Optional[int]:
+            candidates = [dialog_id for dialog_id in pending if dialog_id in session.dialogs]
+            if not candidates:
+                return None
+            # Dialogs only this session can reach go first; others may still be taken by someone else
+            return min(candidates, key=lambda dialog_id: (len(eligible[dialog_id]), dialog_id))
+
+        async def worker(session: Session) -> None:
+            nonlocal running
+            while True:
+                async with changed:
+                    while True:
+                        dialog_id = pick(session)
+                        if dialog_id is not None or (not pending and not running):
+                            break
+                        await changed.wait()
+                    if dialog_id is None:
+                        return
+                    pending.discard(dialog_id)
+                    running += 1
+                try:
+                    await handler(session, session.dialogs[dialog_id])
+                    session.completed += 1
+                except FloodWaitError as e:
+                    session.requeued += 1
+                    session.cooldown_until = time.monotonic() + e.seconds
+                    logger.warning("Session %s flood-waited %ss; handing dialog %s to another session",
+                                   session.name, e.seconds, dialog_id)
+                    async with changed:
+                        pending.add(dialog_id)
+                except Exception as e:
+                    logger.exception("Session %s failed on dialog %s: %s", session.name, dialog_id, e)
+                finally:
+                    async with changed:
+                        running -= 1
+                        changed.notify_all()
+                # Sit out the flood wait instead of grabbing work we can't serve yet,
+                # but don't hold up the run once the other sessions have finished everything
+                remaining = session.cooldown_until - time.monotonic()
+                if remaining > 0:
+                    async with changed:
+                        with contextlib.suppress(asyncio.TimeoutError):
+                            await asyncio.wait_for(changed.wait_for(lambda: not pending and not running), remaining)
+
+        await asyncio.gather(*(worker(session) for session in self.sessions))
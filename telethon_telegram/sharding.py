@@ -0,0 +1,253 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional, Sequence
+
+from sinks import _add_missing_columns, _quote
+
+logger = logging.getLogger("scraper.sharding")
+
+# Environment of the coordinator that must not be shared by every worker
+_COORDINATOR_ONLY_ENV = ('TELEGRAM_METRICS_PORT', 'TELEGRAM_METRICS_JSON')
+
+
+def shard_path(path: str, index: int) -> str:
+    """``data.csv`` -> ``data.shard3.csv``: where worker ``index`` writes before the merge."""
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{index}{ext}'
+
+
+def _shard_session(session: str, index: int) -> str:
+    """Per-worker copy of a Telethon session file, so the processes don't lock one SQLite file."""
+    name = f'{session}.shard{index}'
+    source, target = f'{session}.session', f'{name}.session'
+    if os.path.exists(source) and not os.path.exists(target):
+        shutil.copyfile(source, target)
+    elif not os.path.exists(target):
+        logger.warning("No session file %s to copy; worker %d will have to sign in", source, index)
+    return name
+
+
+def _counters() -> dict:
+    import metrics
+    return {
+        'messages': int(metrics.messages_paged.value),
+        'rows': int(metrics.rows_persisted.value),
+        'downloads': int(metrics.downloads.labels('ok').value),
+        'failed_downloads': int(metrics.downloads.labels('failed').value),
+        'bytes': int(metrics.downloaded_bytes.value),
+    }
+
+
+async def _report_progress(events, index: int, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        events.put(('progress', index, None, _counters()))
+
+
+async def _work(index: int, scraper_cls, scraper_kwargs: dict, tasks, events, limit: Optional[int],
+                interval: float) -> None:
+    from progress import ProgressTracker
+
+    scraper = scraper_cls(target_channel='', **scraper_kwargs)
+    # Several processes can't share one terminal dashboard; totals go to the coordinator instead
+    scraper.progress = ProgressTracker(stream=io.StringIO())
+    reporter = asyncio.create_task(_report_progress(events, index, interval))
+    try:
+        while True:
+            channel = await asyncio.to_thread(tasks.get)
+            if channel is None:
+                return
+            scraper.target_channel = channel
+            events.put(('start', index, channel, _counters()))
+            await scraper.run(limit=limit)
+            events.put(('done', index, channel, _counters()))
+    finally:
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+
+
+def _worker_main(index: int, scraper_cls, scraper_kwargs: dict, tasks, events, limit: Optional[int],
+                 interval: float) -> None:
+    for name in _COORDINATOR_ONLY_ENV:
+        os.environ.pop(name, None)
+    try:
+        asyncio.run(_work(index, scraper_cls, scraper_kwargs, tasks, events, limit, interval))
+    except Exception as e:
+        logging.getLogger("scraper.sharding").exception("Worker %d failed: %s", index, e)
+    finally:
+        events.put(('exit', index, None, _counters()))
+
+
+@dataclass
+class ShardReport:
+    channels: int = 0
+    completed: list = field(default_factory=list)
+    seconds: float = 0.0
+    workers: dict = field(default_factory=dict)
+
+    def totals(self) -> dict:
+        totals: dict[str, int] = {}
+        for counters in self.workers.values():
+            for key, value in counters.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+
+class ShardCoordinator:
+    """Runs one scraper per channel across worker processes and merges their outputs.
+
+    Each of the ``processes`` workers has its own interpreter, event loop
+    and Telegram client (a copy of ``telegram_session``), so parsing, rule
+    extraction and encoding use one core per worker instead of sharing the
+    GIL. Channels are handed out from a queue as workers become free, so a
+    large channel doesn't hold up a fixed partition. Workers write to
+    ``shard_path(csv_file/duckdb_file, index)`` and share ``state_db``
+    (SQLite in WAL mode handles the concurrent commits); ``run()`` merges
+    the shard outputs into the configured files once every worker is done.
+
+    ``scraper_cls`` is ``practice_5.TelegramScraper`` or anything with its
+    constructor and ``run(limit)``; it must be importable by name, since
+    workers are started with the ``spawn`` method.
+    """
+
+    def __init__(self, scraper_cls, channels: Sequence[str], processes: Optional[int] = None,
+                 progress_interval: float = 5.0, **scraper_kwargs: Any) -> None:
+        self.scraper_cls = scraper_cls
+        self.channels = list(dict.fromkeys(channels))
+        self.processes = max(1, min(processes or os.cpu_count() or 1, len(self.channels)))
+        self.progress_interval = progress_interval
+        self.scraper_kwargs = scraper_kwargs
+        self.output = scraper_kwargs.get('output', 'csv')
+        self.csv_file = scraper_kwargs.get('csv_file', 'telegram_messages.csv')
+        self.duckdb_file = scraper_kwargs.get('duckdb_file', 'telegram_messages.duckdb')
+        self.telegram_session = scraper_kwargs.pop('telegram_session')
+
+    def _worker_kwargs(self, index: int) -> dict:
+        return {
+            **self.scraper_kwargs,
+            'telegram_session': _shard_session(self.telegram_session, index),
+            'csv_file': shard_path(self.csv_file, index),
+            'duckdb_file': shard_path(self.duckdb_file, index),
+        }
+
+    def run(self, limit: Optional[int] = None) -> ShardReport:
+        """Scrape every channel, wait for all workers, then merge their outputs."""
+        report = ShardReport(channels=len(self.channels))
+        if not self.channels:
+            return report
+        ctx = multiprocessing.get_context('spawn')
+        tasks, events = ctx.Queue(), ctx.Queue()
+        for channel in self.channels:
+            tasks.put(channel)
+        for _ in range(self.processes):
+            tasks.put(None)
+
+        started = time.monotonic()
+        workers = {
+            index: ctx.Process(
+                target=_worker_main, name=f'scraper-shard-{index}',
+                args=(index, self.scraper_cls, self._worker_kwargs(index), tasks, events, limit,
+                      self.progress_interval),
+            )
+            for index in range(self.processes)
+        }
+        logger.info("Scraping %d channels with %d worker processes", len(self.channels), self.processes)
+        for process in workers.values():
+            process.start()
+
+        running = set(workers)
+        last_log = time.monotonic()
+        try:
+            while running:
+                try:
+                    kind, index, channel, counters = events.get(timeout=self.progress_interval)
+                except queue.Empty:
+                    # A worker killed outright never sends 'exit'
+                    for index in [i for i in running if workers[i].exitcode is not None]:
+                        logger.error("Worker %d died with exit code %s", index, workers[index].exitcode)
+                        running.discard(index)
+                    continue
+                report.workers[index] = counters
+                if kind == 'start':
+                    logger.info("Worker %d: scraping %s", index, channel)
+                elif kind == 'done':
+                    report.completed.append(channel)
+                    logger.info("Worker %d: finished %s (%d/%d channels)",
+                                index, channel, len(report.completed), len(self.channels))
+                elif kind == 'exit':
+                    running.discard(index)
+                if time.monotonic() - last_log >= self.progress_interval:
+                    last_log = time.monotonic()
+                    self._log_totals(report, started)
+        finally:
+            for process in workers.values():
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+        report.seconds = time.monotonic() - started
+        self._log_totals(report, started)
+        self.merge_outputs()
+        return report
+
+    def _log_totals(self, report: ShardReport, started: float) -> None:
+        totals = report.totals()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info("Shards: %d/%d channels, %d messages (%.0f/s), %d rows, %d files (%d failed), %.1f MB",
+                    len(report.completed), report.channels, totals.get('messages', 0),
+                    totals.get('messages', 0) / elapsed, totals.get('rows', 0), totals.get('downloads', 0),
+                    totals.get('failed_downloads', 0), totals.get('bytes', 0) / (1024 * 1024))
+
+    def merge_outputs(self) -> None:
+        """Fold every shard file into the configured output and delete it."""
+        for index in range(self.processes):
+            if self.output == 'duckdb':
+                self._merge_duckdb(shard_path(self.duckdb_file, index))
+            else:
+                self._merge_csv(shard_path(self.csv_file, index))
+
+    def _merge_csv(self, part: str) -> None:
+        if not os.path.exists(part):
+            return
+        has_header = os.path.exists(self.csv_file) and os.path.getsize(self.csv_file) > 0
+        with open(part, 'rb') as src, open(self.csv_file, 'ab') as dst:
+            if has_header:
+                src.readline()
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.remove(part)
+        logger.info("Merged %s into %s", part, self.csv_file)
+
+    def _merge_duckdb(self, part: str) -> None:
+        if not os.path.exists(part):
+            return
+        import duckdb
+
+        conn = duckdb.connect(self.duckdb_file)
+        try:
+            conn.execute(f"ATTACH '{part}' AS shard (READ_ONLY)")
+            columns = [row[0] for row in conn.execute("DESCRIBE shard.messages").fetchall()]
+            exists = conn.execute("SELECT count(*) FROM duckdb_tables() "
+                                  "WHERE database_name = current_database() AND table_name = 'messages'").fetchone()[0]
+            if exists:
+                _add_missing_columns(conn, 'messages', columns, 'VARCHAR')
+            else:
+                # Same DDL as the shard, primary key included, so the upsert below has its conflict target
+                conn.execute(conn.execute("SELECT sql FROM duckdb_tables() "
+                                          "WHERE database_name = 'shard' AND table_name = 'messages'").fetchone()[0])
+            col_list = ', '.join(map(_quote, columns))
+            updates = ', '.join(f'{_quote(col)} = excluded.{_quote(col)}' for col in columns
+                                if col not in ('channel_id', 'message_id'))
+            conn.execute(f"INSERT INTO messages ({col_list}) SELECT {col_list} FROM shard.messages "
+                         f"ON CONFLICT (channel_id, message_id) "
+                         + (f"DO UPDATE SET {updates}" if updates else "DO NOTHING"))
+            conn.execute("DETACH shard")
+        finally:
+            conn.close()
+        os.remove(part)
+        logger.info("Merged %s into %s", part, self.duckdb_file)
@@ -0,0 +1,375 @@
+import atexit
+import csv
+import io
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Mapping, Optional, Sequence
+
+logger = logging.getLogger("scraper.sinks")
+
+
+def _quote(identifier: str) -> str:
+    """SQL identifier quoting (SQLite and DuckDB); column names can come from the rules config."""
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _add_missing_columns(conn, table: str, columns: Sequence[str], column_type: str) -> None:
+    """Add columns (e.g. for newly configured extraction rules) that an existing table lacks."""
+    existing = {d[0].lower() for d in conn.execute(f"SELECT * FROM {table} LIMIT 0").description}
+    for column in columns:
+        if column.lower() not in existing:
+            logger.info("Adding column %s to %s", column, table)
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {_quote(column)} {column_type}")
+
+
+class CsvSink:
+    """Long-lived CSV writer that buffers rows and appends them in batches.
+
+    Rows are sequences in ``columns`` order. The buffer is written out when
+    it reaches ``max_rows`` rows or ``max_bytes`` characters, or when a
+    write happens more than ``max_interval`` seconds after the last flush.
+    ``checkpoint()`` forces everything buffered onto disk (with ``fsync``
+    if enabled); call it before any step that must not overtake the rows,
+    such as downloading the file a row describes. The sink is also
+    flushed on ``close()`` and at interpreter exit. ``on_flush`` runs after
+    each batch is written, e.g. to commit resume state that must not get
+    ahead of the rows. An existing file with a different header (columns
+    or rules changed) is renamed with a timestamp suffix rather than
+    appended to.
+    """
+
+    def __init__(self, path: str, columns: Sequence[str], max_rows: int = 500, max_bytes: int = 1 << 20,
+                 max_interval: float = 2.0, fsync: bool = False,
+                 on_flush: Optional[Callable[[], None]] = None) -> None:
+        self.path = path
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.fsync = fsync
+        self.on_flush = on_flush
+
+        new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+        if not new_file:
+            with open(path, newline='', encoding='utf-8') as f:
+                header = next(csv.reader(f), [])
+            if header != self.columns:
+                # Appending would misalign every new row; keep the old file under another name
+                stem, ext = os.path.splitext(path)
+                rotated = f"{stem}-{time.strftime('%Y%m%d%H%M%S')}{ext}"
+                os.replace(path, rotated)
+                logger.warning("CSV header of %s is %s, not %s; moved it to %s and starting a new file",
+                               path, header, self.columns, rotated)
+                new_file = True
+        self._file = open(path, mode='a', newline='', encoding='utf-8')
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._rows = 0
+        self._last_flush = time.monotonic()
+        self.closed = False
+
+        if new_file:
+            self._writer.writerow(self.columns)
+            self.checkpoint()
+            logger.info("Initialized CSV file with headers: %s", path)
+        atexit.register(self.close)
+
+    def __enter__(self) -> "CsvSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def write(self, row: Sequence) -> None:
+        self._writer.writerow(row)
+        self._rows += 1
+        if (self._rows >= self.max_rows
+                or self._buffer.tell() >= self.max_bytes
+                or time.monotonic() - self._last_flush >= self.max_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if self._buffer.tell():
+            self._file.write(self._buffer.getvalue())
+            self._file.flush()
+            logger.debug("Flushed %d rows to %s", self._rows, self.path)
+            self._buffer.seek(0)
+            self._buffer.truncate()
+            self._rows = 0
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def checkpoint(self) -> None:
+        self.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.checkpoint()
+        finally:
+            self._file.close()
+            atexit.unregister(self.close)
+
+
+class SqliteSink:
+    """Batched SQLite writer: rows are inserted with one prepared statement per batch.
+
+    Same interface as ``CsvSink``. The database runs in WAL mode and every
+    batch is a single transaction; rows conflicting with an existing key
+    are ignored, or replace the stored row with ``replace=True``.
+    """
+
+    def __init__(self, db_path: str, table: str, columns: Sequence[str], create_sql: str,
+                 max_rows: int = 500, max_interval: float = 2.0, replace: bool = False) -> None:
+        self.db_path = db_path
+        self.table = table
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+        self.rows_written = 0
+
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(create_sql)
+        _add_missing_columns(self.conn, table, self.columns, 'TEXT')
+        self.conn.commit()
+
+        placeholders = ", ".join(["?"] * len(self.columns))
+        self._insert_sql = f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO {table} ({', '.join(map(_quote, self.columns))}) VALUES ({placeholders})"
+        self._batch: list[Sequence] = []
+        self._last_flush = time.monotonic()
+        self.closed = False
+
+    def __enter__(self) -> "SqliteSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def write(self, row: Sequence) -> None:
+        self._batch.append(row)
+        if len(self._batch) >= self.max_rows or time.monotonic() - self._last_flush >= self.max_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._batch:
+            return
+        with self.conn:
+            self.conn.executemany(self._insert_sql, self._batch)
+        self.rows_written += len(self._batch)
+        logger.debug("Inserted %d rows into %s", len(self._batch), self.table)
+        self._batch.clear()
+
+    def checkpoint(self) -> None:
+        self.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+
+class ParquetSink:
+    """Columnar sink that writes a partitioned Parquet dataset.
+
+    Rows (sequences in ``columns`` order) are appended to per-partition
+    column buffers and written out as compressed Parquet files under
+    ``root/channel=<id>/day=<YYYY-MM-DD>/`` once a partition holds
+    ``row_group_size`` rows, or when more than ``max_buffered_rows`` rows are
+    buffered in total. ``date_column`` may hold ISO strings or datetimes.
+    Every file is written with the same ``schema`` (column -> polars dtype;
+    unlisted columns are strings), so a column that is all None in one
+    partition doesn't become a Null column there. DuckDB can read the result with
+    ``read_parquet('root/**/*.parquet', hive_partitioning = true)``.
+    """
+
+    def __init__(self, root: str, columns: Sequence[str], channel_column: str = 'channel_id',
+                 date_column: str = 'date', row_group_size: int = 100_000, max_buffered_rows: int = 500_000,
+                 compression: str = 'zstd', compression_level: Optional[int] = None, file_prefix: str = 'part',
+                 schema: Optional[Mapping[str, Any]] = None) -> None:
+        import polars as pl
+
+        self._pl = pl
+        self.root = root
+        self.columns = list(columns)
+        unknown = set(schema or ()) - set(self.columns)
+        if unknown:
+            raise ValueError(f"Schema names unknown columns {sorted(unknown)}")
+        self.schema = {column: (schema or {}).get(column, pl.String) for column in self.columns}
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self.compression = compression
+        self.compression_level = compression_level
+        # Unique per run so appending never overwrites earlier files
+        self.file_prefix = f"{file_prefix}-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        self._channel_idx = self.columns.index(channel_column)
+        self._date_idx = self.columns.index(date_column)
+        self._partitions: dict[tuple[str, str], list[list]] = {}
+        self._buffered = 0
+        self._files = 0
+        self.rows_written = 0
+        self.closed = False
+
+    def __enter__(self) -> "ParquetSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def write(self, row: Sequence) -> None:
+        date = row[self._date_idx]
+        day = (date if isinstance(date, str) else date.isoformat())[:10] if date else 'unknown'
+        key = (str(row[self._channel_idx]), day)
+        buffers = self._partitions.get(key)
+        if buffers is None:
+            buffers = self._partitions[key] = [[] for _ in self.columns]
+        for column, value in zip(buffers, row):
+            column.append(value)
+        self._buffered += 1
+
+        if len(buffers[0]) >= self.row_group_size:
+            self._write_partition(key)
+        elif self._buffered >= self.max_buffered_rows:
+            self._write_partition(max(self._partitions, key=lambda k: len(self._partitions[k][0])))
+
+    def _write_partition(self, key: tuple[str, str]) -> None:
+        buffers = self._partitions.pop(key)
+        rows = len(buffers[0])
+        if not rows:
+            return
+        channel, day = key
+        folder = os.path.join(self.root, f'channel={channel}', f'day={day}')
+        os.makedirs(folder, exist_ok=True)
+        self._files += 1
+        path = os.path.join(folder, f'{self.file_prefix}-{self._files:05d}.parquet')
+
+        frame = self._pl.DataFrame(dict(zip(self.columns, buffers)), schema=self.schema, strict=False)
+        frame.write_parquet(
+            path,
+            compression=self.compression,
+            compression_level=self.compression_level,
+            row_group_size=self.row_group_size,
+        )
+        self._buffered -= rows
+        self.rows_written += rows
+        logger.debug("Wrote %d rows to %s", rows, path)
+
+    def flush(self) -> None:
+        for key in list(self._partitions):
+            self._write_partition(key)
+
+    def checkpoint(self) -> None:
+        self.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+
+
+class DuckDBSink:
+    """Bulk DuckDB sink with upsert on ``key_columns``.
+
+    Each batch of rows becomes one Polars frame that is registered with
+    DuckDB (an Arrow scan, no per-row conversion) and merged with a single
+    ``INSERT ... SELECT ... ON CONFLICT DO UPDATE``. ``create_sql`` must
+    declare a primary key or unique constraint on ``key_columns``.
+    Registering Polars frames needs ``pyarrow`` installed next to ``duckdb``.
+    """
+
+    def __init__(self, db_path: str, table: str, columns: Sequence[str], create_sql: str,
+                 key_columns: Sequence[str] = ('channel_id', 'message_id'), max_rows: int = 50_000,
+                 max_interval: float = 5.0, on_flush: Optional[Callable[[], None]] = None) -> None:
+        import duckdb
+        import polars as pl
+
+        self._pl = pl
+        self.db_path = db_path
+        self.table = table
+        self.columns = list(columns)
+        self.key_columns = list(key_columns)
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+        self.on_flush = on_flush
+        self.rows_written = 0
+        self.ingest_seconds = 0.0
+
+        self.conn = duckdb.connect(db_path)
+        self.conn.execute(create_sql)
+        _add_missing_columns(self.conn, table, self.columns, 'VARCHAR')
+
+        col_list = ', '.join(map(_quote, self.columns))
+        updates = ', '.join(f'{_quote(col)} = excluded.{_quote(col)}' for col in self.columns if col not in key_columns)
+        self._upsert_sql = (
+            f"INSERT INTO {table} ({col_list}) SELECT {col_list} FROM _ingest_batch "
+            f"ON CONFLICT ({', '.join(map(_quote, key_columns))}) "
+            # A projection of just the key columns has nothing to update
+            + (f"DO UPDATE SET {updates}" if updates else "DO NOTHING")
+        )
+        self._batch: list[Sequence] = []
+        self._last_flush = time.monotonic()
+        self.closed = False
+
+    def __enter__(self) -> "DuckDBSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    @property
+    def ingest_rate(self) -> float:
+        """Rows per second spent inside DuckDB inserts."""
+        return self.rows_written / self.ingest_seconds if self.ingest_seconds else 0.0
+
+    def write(self, row: Sequence) -> None:
+        self._batch.append(row)
+        if len(self._batch) >= self.max_rows or time.monotonic() - self._last_flush >= self.max_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if self._batch:
+            started = time.perf_counter()
+            frame = self._pl.DataFrame(
+                self._batch, schema=self.columns, orient='row', strict=False, infer_schema_length=None,
+            )
+            # A key may appear only once per upsert statement; the latest row wins
+            frame = frame.unique(subset=self.key_columns, keep='last', maintain_order=True)
+            self.conn.register('_ingest_batch', frame)
+            try:
+                self.conn.execute(self._upsert_sql)
+            finally:
+                self.conn.unregister('_ingest_batch')
+            self.ingest_seconds += time.perf_counter() - started
+            self.rows_written += len(self._batch)
+            logger.debug("Upserted %d rows into %s (%.0f rows/s overall)", len(self._batch), self.table, self.ingest_rate)
+            self._batch.clear()
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def checkpoint(self) -> None:
+        self.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+            logger.info("Ingested %d rows into %s at %.0f rows/s", self.rows_written, self.table, self.ingest_rate)
+        finally:
+            self.conn.close()